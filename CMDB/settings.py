@@ -87,6 +87,44 @@ DATABASES = {
 }
 
 
+# Relay nodes post the reports of a whole rack to assets/report/batch/ in one request
+DATA_UPLOAD_MAX_MEMORY_SIZE = 32 * 1024 * 1024
+
+# With the spool enabled the report views only queue the reports and answer 202,
+# run `python manage.py drain_report_spool` to apply them
+ASSET_REPORT_SPOOL = {
+    'enabled': False,
+    'path': os.path.join(BASE_DIR, 'spool', 'reports.sqlite3'),
+    'lease': 300,
+}
+
+# Process wide name -> id cache of Manufacturer, IDC, BusinessUnit and Tag used by the report handlers
+ASSET_LOOKUP_CACHE = {
+    'maxsize': 1024,
+    'ttl': 300,
+}
+
+# EventLog rows are buffered per process and written with bulk_create, size 0 writes them at once
+ASSET_EVENT_LOG_BUFFER = {
+    'size': 200,
+    'interval': 5.0,
+    'max_pending': 10000,
+}
+
+# Query count, SQL time and wall time of every report phase, exposed on assets/metrics/.
+# timing_header adds a Server-Timing header with the breakdown to the report responses
+ASSET_REPORT_METRICS = {
+    'enabled': True,
+    'timing_header': False,
+}
+
+# Collector timings of reports sent with `main.py --profile`. An unchanged report writes them at most once per
+# 'unchanged_interval' seconds and asset, changed reports always
+ASSET_COLLECTOR_PROFILES = {
+    'unchanged_interval': 3600,
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
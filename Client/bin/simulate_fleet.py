@@ -0,0 +1,211 @@
+"""
+Agentless load generator: simulate a fleet of N agents reporting to the CMDB server.
+
+Every simulated agent has its own SN and a payload which drifts a little from report to report
+(IP addresses, OS release). By default each agent reports every --interval seconds with --jitter;
+with --rate the reports arrive as an open-loop Poisson process instead, independent of how fast
+the server answers, which is what finds the saturation point of the report endpoint.
+
+    python simulate_fleet.py --agents 5000 --interval 60 --jitter 0.2 --duration 300
+    python simulate_fleet.py --agents 20000 --rate 400 --duration 120 --output result.json
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import sys
+import time
+import urllib.parse
+from collections import Counter
+
+BASE_DIR = os.path.dirname(os.getcwd())
+sys.path.append(BASE_DIR)
+from conf import settings
+
+# shape of linux_data in report_assets.py
+TEMPLATE = {
+    "asset_type": "server",
+    "manufacturer": "innotek GmbH",
+    "model": "VirtualBox",
+    "wake_up_type": "Power Switch",
+    "os_distribution": "Ubuntu",
+    "os_release": "Ubuntu 16.04.3 LTS",
+    "os_type": "Linux",
+    "cpu_count": "2",
+    "cpu_core_count": "4",
+    "cpu_model": "Intel(R) Core(TM) i5-2300 CPU @ 2.80GHz",
+    "ram_size": 3.858997344970703,
+}
+
+
+class Agent(object):
+
+    def __init__(self, index, rnd, drift):
+        self.rnd = rnd
+        self.drift = drift
+        self.data = copy.deepcopy(TEMPLATE)
+        self.data['sn'] = 'SIM-%06d' % index
+        self.data['ram'] = [{"slot": "DIMM%s" % i, "capacity": 16, "model": "DDR4"}
+                            for i in range(rnd.choice([4, 8, 16]))]
+        self.data['physical_disk_driver'] = [{"model": "VBOX HARDDISK", "capacity": 960,
+                                              "sn": "SIMDISK-%06d-%s" % (index, i)}
+                                             for i in range(rnd.choice([2, 4, 12]))]
+        self.data['nic'] = [{"name": "eth%s" % i, "model": "unknown", "net_mask": ["255.255.0.0"],
+                             "mac": "02:00:%02x:%02x:%02x:%02x" % ((index >> 16) & 0xff, (index >> 8) & 0xff,
+                                                                   index & 0xff, i),
+                             "ip_address": "10.%s.%s.%s" % (i, (index >> 8) & 0xff, index & 0xff)}
+                            for i in range(rnd.choice([2, 4]))]
+
+    def report(self):
+        """
+        :return: encoded body of the next report, with some drift
+        """
+        if self.rnd.random() < self.drift:
+            nic = self.rnd.choice(self.data['nic'])
+            nic['ip_address'] = '172.16.%s.%s' % (self.rnd.randint(0, 255), self.rnd.randint(1, 254))
+        if self.rnd.random() < self.drift / 10:
+            self.data['os_release'] = 'Ubuntu 16.04.%s LTS' % self.rnd.randint(3, 7)
+        return urllib.parse.urlencode({"asset_data": json.dumps(self.data)}).encode()
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = []
+        # requests which got no response (timeout, refused, reset), a slow failure is as bad as a slow answer
+        self.failure_latencies = []
+        self.status = Counter()
+        self.errors = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.started = time.time()
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        failures = sorted(self.failure_latencies)
+
+        def pct(p, values=latencies):
+            if not values:
+                return 0.0
+            return values[min(len(values) - 1, int(p / 100.0 * len(values)))] * 1000
+
+        elapsed = time.time() - self.started
+        return {
+            'elapsed': elapsed,
+            'completed': len(latencies),
+            'per_sec': len(latencies) / elapsed if elapsed else 0.0,
+            'status': dict(self.status),
+            'errors': dict(self.errors),
+            'p50_ms': pct(50),
+            'p90_ms': pct(90),
+            'p99_ms': pct(99),
+            'p999_ms': pct(99.9),
+            'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+            'failed': len(failures),
+            'failed_p50_ms': pct(50, failures),
+            'failed_p99_ms': pct(99, failures),
+            'failed_max_ms': failures[-1] * 1000 if failures else 0.0,
+            'max_in_flight': self.max_in_flight,
+        }
+
+
+async def post(host, port, path, body, timeout, stats):
+    stats.in_flight += 1
+    stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+    start = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        request = ('POST %s HTTP/1.1\r\nHost: %s:%s\r\nContent-Type: application/x-www-form-urlencoded\r\n'
+                   'Content-Length: %s\r\nConnection: close\r\n\r\n' % (path, host, port, len(body))).encode()
+        writer.write(request + body)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        await asyncio.wait_for(reader.read(), timeout)
+        status = int(status_line.split()[1])
+        stats.latencies.append(time.perf_counter() - start)
+        stats.status[status] += 1
+        if status >= 500:
+            stats.errors['HTTP %s' % status] += 1
+    except asyncio.TimeoutError:
+        stats.failure_latencies.append(time.perf_counter() - start)
+        stats.errors['timeout'] += 1
+    except (OSError, IndexError, ValueError) as e:
+        stats.failure_latencies.append(time.perf_counter() - start)
+        stats.errors[type(e).__name__] += 1
+    finally:
+        stats.in_flight -= 1
+        if writer is not None:
+            writer.close()
+
+
+async def scheduled_agent(agent, args, stats, deadline):
+    # spread the first reports over one interval, like agents started at random times
+    await asyncio.sleep(random.uniform(0, args.interval))
+    while time.time() < deadline:
+        await post(args.server, args.port, args.url, agent.report(), args.timeout, stats)
+        await asyncio.sleep(args.interval * random.uniform(1 - args.jitter, 1 + args.jitter))
+
+
+async def open_loop(agents, args, stats, deadline):
+    tasks = set()
+    while time.time() < deadline:
+        agent = random.choice(agents)
+        task = asyncio.ensure_future(post(args.server, args.port, args.url, agent.report(), args.timeout, stats))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        await asyncio.sleep(random.expovariate(args.rate))
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def progress(stats, every):
+    while True:
+        await asyncio.sleep(every)
+        s = stats.summary()
+        print('%6.0fs  %8s done %7.1f/s  in flight %5s  p50 %7.1fms  p99 %7.1fms  failed p99 %7.1fms  errors %s' % (
+            s['elapsed'], s['completed'], s['per_sec'], stats.in_flight, s['p50_ms'], s['p99_ms'],
+            s['failed_p99_ms'], s['errors']))
+
+
+async def main(args):
+    rnd = random.Random(args.seed)
+    agents = [Agent(i, rnd, args.drift) for i in range(args.agents)]
+    stats = Stats()
+    deadline = time.time() + args.duration
+    reporter = asyncio.ensure_future(progress(stats, args.progress))
+    if args.rate:
+        await open_loop(agents, args, stats, deadline)
+    else:
+        await asyncio.gather(*[scheduled_agent(agent, args, stats, deadline) for agent in agents])
+    reporter.cancel()
+    return stats.summary()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Simulate a fleet of CMDB agents')
+    parser.add_argument('--agents', type=int, default=1000, help='number of simulated agents')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between two reports of one agent')
+    parser.add_argument('--jitter', type=float, default=0.2, help='relative jitter of the interval')
+    parser.add_argument('--rate', type=float, help='open-loop arrival rate in reports per second')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--drift', type=float, default=0.05, help='chance that a report changes something')
+    parser.add_argument('--timeout', type=float, default=settings.Params['request_timeout'])
+    parser.add_argument('--server', default=settings.Params['server'])
+    parser.add_argument('--port', type=int, default=settings.Params['port'])
+    parser.add_argument('--url', default=settings.Params['url'])
+    parser.add_argument('--progress', type=float, default=5, help='seconds between two progress lines')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the summary to this JSON file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = asyncio.run(main(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -5,7 +5,114 @@ Params = {
     'server': "192.168.0.106",
     'port': 8000,
     'url': '/assets/report/',
+    'batch_url': '/assets/report/batch/',
+    'delta_url': '/assets/report/delta/',
     'request_timeout': 30,
+    # 'gzip', 'deflate', 'json', or 'form' for servers which only take the asset_data form field
+    'report_format': 'gzip',
+}
+
+# Daemon Config
+# `main.py daemon` reports every 'interval' seconds, each run shifted by a random 0 - 'splay' seconds
+DAEMON = {
+    'interval': 3600,
+    'splay': 300,
+}
+
+# Collector Plugins
+# Switch a collector of plugins/__init__.py off with False, collectors not listed use 'default'
+COLLECTORS = {
+    'default': True,
+    'system': True,
+    'os': True,
+    'cpu': True,
+    'ram': True,
+    'nic': True,
+    'disk': True,
+}
+
+# Collector Config
+# Seconds a single collector may run before its section is left out of the report,
+# 'total' bounds the whole collection
+COLLECT_TIMEOUT = {
+    'default': 60,
+    'disk': 30,
+    'total': 120,
+}
+
+# NIC Collector
+# Virtual interfaces (veth, docker, tap ...) are counted per name prefix in 'nic_summary' ('summarize'),
+# left out ('skip') or reported one by one ('report'). Bonds and the 'include' patterns are always reported
+NIC = {
+    'virtual': 'summarize',
+    'include': ('bond*', 'team*', 'br*', 'vlan*'),
+    'exclude': ('lo',),
+}
+
+# Time every collector and command and report it in 'collect_meta', the same as the --profile option
+PROFILE = False
+
+# Low Impact Mode, also switched on with the --low-impact option
+# The agent and its commands run with the lowest CPU and IO priority ('nice', 'ionice_class' 3 = idle).
+# One collection may use 'cpu_budget' seconds of CPU (agent and commands) and 'wall_budget' seconds;
+# collectors with cost 'high' wait up to 'load_wait' seconds while the load average per CPU is above 'max_load',
+# and are skipped for this run if it stays there; the wall budget starts after that wait.
+# The 'essential' collectors identify the host, they are never skipped and not bound by the wall budget
+LOW_IMPACT = {
+    'enabled': False,
+    'nice': 19,
+    'ionice_class': 3,
+    'cpu_budget': 2.0,
+    'wall_budget': 30,
+    'max_load': 1.0,
+    'load_wait': 60,
+    'essential': ('system', 'os'),
+}
+
+# Static Hardware Facts Cache
+# system, cpu, ram and disk are collected again after 'ttl' seconds,
+# or earlier when the boot id, the kernel version or the devices in /sys change
+FACT_CACHE = {
+    'enabled': True,
+    'path': os.path.join(os.path.dirname(os.getcwd()), 'cache', 'facts.json'),
+    'ttl': 24 * 3600,
+    'sections': ('system', 'cpu', 'ram', 'disk'),
+}
+
+# Delta Reports
+# Once the server acknowledged a report, only the sections and components which changed are sent.
+# The acknowledged report is kept in 'path'
+DELTA = {
+    'enabled': True,
+    'path': os.path.join(os.path.dirname(os.getcwd()), 'cache', 'last_report.json'),
+}
+
+# Offline Spool
+# Reports which could not be sent wait here, at most one per SN, and are replayed as one gzip batch.
+# Retries wait 'backoff' seconds, doubling per failure up to 'max_backoff'
+SPOOL = {
+    'path': os.path.join(os.path.dirname(os.getcwd()), 'spool'),
+    'max_entries': 100,
+    'backoff': 60,
+    'max_backoff': 3600,
+}
+
+# Site Relay
+# `main.py relay` listens on 'listen' for the reports of the agents of one site, whose Params point here,
+# keeps the newest report per SN and forwards them upstream as gzip batches of 'batch_size' every 'interval' seconds.
+# Upstream is 'upstream_server':'upstream_port', or the server of Params when they are None
+RELAY = {
+    'listen': ('0.0.0.0', 8000),
+    'upstream_server': None,
+    'upstream_port': None,
+    'interval': 60,
+    'batch_size': 500,
+    # JSON bytes per batch, below DATA_UPLOAD_MAX_MEMORY_SIZE of the server (32MB)
+    'batch_bytes': 16 * 1024 * 1024,
+    'max_pending': 50000,
+    'max_body': 2621440,
+    'max_backoff': 1800,
+    'spool_path': os.path.join(os.path.dirname(os.getcwd()), 'spool', 'relay'),
 }
 
 # Log File Config
@@ -0,0 +1,139 @@
+import os
+import json
+import hashlib
+from conf import settings
+
+# report keys which change on every run and are not part of the hardware state
+VOLATILE_KEYS = ('collect_meta',)
+
+# component sections and the fields the server identifies one component by
+COMPONENT_KEYS = {
+    'ram': ('slot',),
+    'physical_disk_driver': ('sn',),
+    'nic': ('model', 'mac'),
+}
+
+
+def _canonical(value):
+    if isinstance(value, dict):
+        return dict((str(k), _canonical(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        items = [_canonical(v) for v in value]
+        return sorted(items, key=lambda v: json.dumps(v, sort_keys=True, default=str))
+    return value
+
+
+def fingerprint(data):
+    """
+    The same fingerprint the server computes (asset_handler.report_fingerprint), the version token of a report.
+    Any difference turns every delta into a resync, assets/tests.py checks that both agree
+    """
+    data = dict((key, value) for key, value in data.items() if key not in VOLATILE_KEYS)
+    raw = json.dumps(_canonical(data), sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _component_delta(old_items, new_items, fields):
+    """
+    :return: {"upsert": [...], "delete": [[key values]]}, {} if nothing changed,
+             None if the keys are not unique and the whole section has to be sent
+    """
+    old = dict((tuple(item.get(f) for f in fields), item) for item in old_items)
+    new = dict((tuple(item.get(f) for f in fields), item) for item in new_items)
+    if len(old) != len(old_items) or len(new) != len(new_items):
+        return None
+
+    change = dict()
+    upsert = [item for key, item in new.items() if old.get(key) != item]
+    delete = [list(key) for key in old if key not in new]
+    if upsert:
+        change['upsert'] = upsert
+    if delete:
+        change['delete'] = delete
+    return change
+
+
+def make_delta(old, new):
+    """
+    What changed between the last acknowledged report and the new one
+    :return: {"changed": {key: value}, "removed": [key], "components": {section: {"upsert", "delete"}}}
+    """
+    changed = dict()
+    components = dict()
+    for key, value in new.items():
+        if key in COMPONENT_KEYS and isinstance(value, list) and isinstance(old.get(key), list) \
+                and all(isinstance(item, dict) for item in old[key] + value):
+            change = _component_delta(old[key], value, COMPONENT_KEYS[key])
+            if change is None:
+                changed[key] = value
+            elif change:
+                components[key] = change
+        elif key not in old or old[key] != value:
+            changed[key] = value
+
+    delta = dict()
+    if changed:
+        delta['changed'] = changed
+    removed = [key for key in old if key not in new]
+    if removed:
+        delta['removed'] = removed
+    if components:
+        delta['components'] = components
+    return delta
+
+
+class DeltaState(object):
+    """
+    The last report the server acknowledged and its version token, kept on disk between runs
+    """
+
+    def __init__(self, path=None):
+        self.path = path or settings.DELTA['path']
+
+    def base(self, sn):
+        """
+        :return: (token, report) of the asset, None if there is none
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            token, report = state['token'], state['report']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(report, dict) or report.get('sn') != sn or fingerprint(report) != token:
+            return None
+        return token, report
+
+    def acknowledge(self, report, token, message):
+        """
+        Keep the report as the base of the next delta if the server answered with its token
+        :param message: response text of the server
+        :return: the message to log
+        """
+        try:
+            reply = json.loads(message)
+        except ValueError:
+            # a server without delta support answers with plain text
+            reply = None
+        if not isinstance(reply, dict):
+            self.clear()
+            return message
+
+        # a site relay answers without a token, it keeps no report to apply a delta to: without a base
+        # the next run sends the full report at once instead of a delta the relay would answer with 409
+        if reply.get('token') and reply['token'] == token:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = '%s.%s.tmp' % (self.path, os.getpid())
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'token': token, 'report': report}, f)
+            os.replace(tmp, self.path)
+        else:
+            self.clear()
+        return reply.get('message', message)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import hashlib
+import platform
+from conf import settings
+
+
+class FactCache(object):
+    """
+    Static hardware facts (DMI, CPU, DIMMs, disks) kept on disk between runs,
+    so report_data does not spawn the root-only commands every time.
+    The whole cache is dropped when the TTL expires or when a cheap signal changes:
+    boot id, kernel version or the device lists in /sys.
+    """
+
+    def __init__(self, path=None, ttl=None, sections=None):
+        conf = settings.FACT_CACHE
+        self.path = path or conf['path']
+        self.ttl = conf['ttl'] if ttl is None else ttl
+        self.sections = sections or conf['sections']
+
+    @staticmethod
+    def signature():
+        """
+        Values which are cheap to read and change with the hardware
+        :return: {name: value}
+        """
+        def read(path):
+            try:
+                with open(path) as f:
+                    return f.read().strip()
+            except OSError:
+                return ''
+
+        def listing(path):
+            try:
+                names = sorted(os.listdir(path))
+            except OSError:
+                names = []
+            return hashlib.sha1(' '.join(names).encode()).hexdigest()
+
+        return {
+            'boot_id': read('/proc/sys/kernel/random/boot_id'),
+            'kernel': platform.release(),
+            'cpus': read('/sys/devices/system/cpu/present'),
+            'block': listing('/sys/block'),
+            'pci': listing('/sys/bus/pci/devices'),
+        }
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def load(self):
+        """
+        :return: {section name: facts} for the sections still valid, {} if the cache is stale
+        """
+        cache = self._read()
+        if not isinstance(cache, dict) or cache.get('signature') != self.signature():
+            return dict()
+
+        now = time.time()
+        sections = dict()
+        for name, entry in (cache.get('sections') or {}).items():
+            age = now - entry.get('time', 0)
+            # a clock set backwards counts as expired as well
+            if name in self.sections and 0 <= age < self.ttl:
+                sections[name] = entry['data']
+        return sections
+
+    def save(self, results):
+        """
+        Store the static sections of a collection, sections from earlier runs which are still valid are kept
+        :param results: {section name: facts}, only the collectors which finished
+        """
+        signature = self.signature()
+        cache = self._read()
+        if not isinstance(cache, dict) or cache.get('signature') != signature:
+            cache = dict()
+        entries = cache.get('sections') or {}
+
+        now = time.time()
+        for name, data in results.items():
+            if name in self.sections:
+                entries[name] = {'time': now, 'data': data}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        # serial numbers are in here, readable by the owner only
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'signature': signature, 'sections': entries}, f)
+        os.replace(tmp, self.path)
@@ -1,8 +1,13 @@
-import json
 import time
-import urllib.parse
-import urllib.request
+import random
+import signal
+import threading
 from core import info_collection
+from core.delta import DeltaState, fingerprint, make_delta
+from core.low_impact import LIMITS
+from core.profiler import PROFILER
+from core.spool import OfflineSpool
+from core.transport import Transport, TransportError, encode_report
 from conf import settings
 
 
@@ -10,6 +15,16 @@ class ArgvHandler(object):
 
     def __init__(self, args):
         self.args = args
+        # options may come before or after the command, i.e. main.py --profile report_data
+        self.options = [arg for arg in args[1:] if arg.startswith('--')]
+        self.commands = [arg for arg in args[1:] if not arg.startswith('--')]
+        if '--profile' in self.options:
+            PROFILER.enabled = True
+        if '--low-impact' in self.options:
+            LIMITS.enabled = True
+        if LIMITS.enabled:
+            # before any thread or command is started, they inherit the priority
+            LIMITS.apply_priority()
         self.parse_args()
 
     def parse_args(self):
@@ -18,8 +33,8 @@ class ArgvHandler(object):
         :return:
         """
 
-        if len(self.args) > 1 and hasattr(self, self.args[1]):
-            func = getattr(self, self.args[1])
+        if self.commands and hasattr(self, self.commands[0]):
+            func = getattr(self, self.commands[0])
             func()
         else:
             self.help_msg()
@@ -38,6 +53,16 @@ class ArgvHandler(object):
         collect_data        测试收集硬件信息的功能
 
         report_data         收集硬件信息并汇报
+
+        daemon              常驻后台, 按计划定时汇报
+
+        relay               机房中继, 接收本机房客户端的汇报, 按SN去重后压缩批量转发给服务器
+
+        list_collectors     列出采集插件及其状态
+
+        --profile           附加选项, 记录每个采集插件和命令的耗时, 写入 collect_meta 汇报
+
+        --low-impact        附加选项, 以最低CPU和IO优先级运行, 限制CPU和时间预算, 负载高时推迟重型采集
         '''
         print(msg)
 
@@ -52,6 +77,24 @@ class ArgvHandler(object):
         asset_data = info.collect()
         print(asset_data)
 
+    @staticmethod
+    def list_collectors():
+        """
+        Print the registered collectors, whether they are enabled and can run on this host
+        :return:
+        """
+
+        import plugins
+        for collector in plugins.REGISTRY:
+            if not collector.enabled():
+                state = 'disabled'
+            elif collector.applicable():
+                state = 'active'
+            else:
+                state = 'not applicable'
+            print('%-10s %-8s %-16s %s.%s' % (collector.name, collector.cost, state, collector.module,
+                                             collector.function))
+
     @staticmethod
     def report_data():
         """
@@ -62,26 +105,179 @@ class ArgvHandler(object):
         # Collect
         info = info_collection.InfoCollection()
         asset_data = info.collect()
-        # Pack info in dict and convert to json format
-        data = {"asset_data": json.dumps(asset_data)}
-        url = "http://%s:%s%s" % (settings.Params['server'], settings.Params['port'], settings.Params['url'])
+        transport = Transport()
+        try:
+            ArgvHandler.send(transport, asset_data, OfflineSpool())
+        finally:
+            transport.close()
+
+    @staticmethod
+    def send(transport, asset_data, spool):
+        """
+        Send one report over the given connection and record the result in the log file.
+        A report the server could not take is kept in the offline spool, after a successful send
+        the spooled reports are replayed.
+        :param transport: core.transport.Transport
+        :param asset_data: collected info
+        :param spool: core.spool.OfflineSpool
+        :return:
+        """
+
+        url = transport.url(settings.Params['url'])
         print('Sending data to : [%s] ...... ' % url)
         try:
-            # use builtin urllib.request lib to send post request
-            # encode data and convert to bytes
-            data_encode = urllib.parse.urlencode(data).encode()
-            response = urllib.request.urlopen(url=url, data=data_encode, timeout=settings.Params['request_timeout'])
+            message = ArgvHandler.post_report(transport, asset_data)
             # \033[31;1m is color code which make the 'SEND COMPLETE' red
             # Similar as \033[0m
             print("\033[31;1mSend Complete! \033[0m ")
-            message = response.read().decode()
             print("返回结果：%s" % message)
         except Exception as e:
-            # ???
             message = 'Send Failed' + "  Error:  {}".format(e)
             print("\033[31;1mSend Failed, Error: %s\033[0m" % e)
-        # ???
+            # a rejected report (4xx) would be rejected again
+            if not isinstance(e, TransportError) or e.status >= 500:
+                spool.put(asset_data)
+                spool.failed()
+                message += ', spooled'
+        else:
+            spool.discard(asset_data.get('sn'))
+            spool.replay(transport)
         with open(settings.PATH, 'ab') as f:
             log = 'Send Time: %s \t Server Address: %s \t Response: %s \n' % (time.strftime('%Y-%m-%d %H:%M:%S'), url, message)
             f.write(log.encode())
             print("Log has been successfully recorded")
+
+    @staticmethod
+    def post_report(transport, asset_data):
+        """
+        Send only the changes since the last report the server acknowledged, the full report
+        when there is none or the server asks for it (409, or 404 from a server without delta support)
+        :return: message of the server
+        """
+        report_format = settings.Params['report_format']
+        state = DeltaState()
+        token = fingerprint(asset_data)
+        base = None
+        if settings.DELTA['enabled'] and report_format != 'form':
+            base = state.base(asset_data.get('sn'))
+
+        if base:
+            delta = make_delta(base[1], asset_data)
+            delta.update(sn=asset_data.get('sn'), base=base[0], token=token)
+            body, headers = encode_report(delta, report_format)
+            try:
+                status, message = transport.post(settings.Params['delta_url'], body, headers)
+                return state.acknowledge(asset_data, token, message)
+            except TransportError as e:
+                if e.status not in (404, 409):
+                    raise
+                print("Server asked for the full report")
+                state.clear()
+
+        # JSON body, gzip compressed unless the server only understands the old form field
+        body, headers = encode_report(asset_data, report_format)
+        headers['Accept'] = 'application/json'
+        status, message = transport.post(settings.Params['url'], body, headers)
+        return state.acknowledge(asset_data, token, message)
+
+    @staticmethod
+    def daemon():
+        """
+        Stay resident and report every DAEMON['interval'] seconds, each run delayed by a random splay
+        so that the hosts started by the same cron or deploy do not hit the server at the same second.
+        The connection to the server is kept open between runs, spooled reports are replayed in between
+        with backoff. SIGTERM / SIGINT stop the loop after the current report.
+        :return:
+        """
+
+        conf = settings.DAEMON
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)
+
+        for name in ('SIGTERM', 'SIGINT', 'SIGHUP'):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), stop)
+
+        info = info_collection.InfoCollection()
+        transport = Transport()
+        spool = OfflineSpool()
+        period = time.monotonic()
+        print('Reporting every %ss, splay %ss' % (conf['interval'], conf['splay']))
+        try:
+            while not stopping:
+                due = period + random.uniform(0, conf['splay'])
+                period += conf['interval']
+                # short sleeps, a signal only sets the flag
+                while not stopping:
+                    now = time.monotonic()
+                    if now >= due:
+                        break
+                    time.sleep(max(0.0, min(1.0, due - now)))
+                    # reports left over from an outage go out as soon as their backoff has passed
+                    if spool.due():
+                        spool.replay(transport)
+                if stopping:
+                    break
+                ArgvHandler.send(transport, info.collect(), spool)
+                # a run longer than the interval must not make the next runs fire back to back
+                period = max(period, time.monotonic())
+        finally:
+            transport.close()
+        print('Stopped by signal %s' % stopping[0])
+
+    @staticmethod
+    def relay():
+        """
+        Site relay: take the reports of the agents of one site and forward them upstream in batches
+        every RELAY['interval'] seconds, so that the site needs one WAN connection instead of one per host.
+        Reports spooled by the last run are forwarded first. SIGTERM / SIGINT stop listening,
+        the pending reports are forwarded once more and spooled if that fails.
+        :return:
+        """
+
+        # http.server is only needed here, not on every agent run
+        from core.relay import Relay
+
+        conf = settings.RELAY
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)
+
+        for name in ('SIGTERM', 'SIGINT', 'SIGHUP'):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), stop)
+
+        relay = Relay()
+        restored = relay.restore()
+        if restored:
+            print('Restored %s spooled reports' % restored)
+        server = relay.listen(tuple(conf['listen']))
+        listener = threading.Thread(target=server.serve_forever, daemon=True)
+        listener.start()
+        print('Relaying reports from %s:%s to %s every %ss' % (tuple(conf['listen']) + (
+            relay.transport.url(settings.Params['batch_url']), conf['interval'])))
+
+        next_run = time.monotonic() + conf['interval']
+        try:
+            while not stopping:
+                time.sleep(1)
+                # a full batch goes out without waiting for the timer
+                if time.monotonic() < next_run and len(relay.pending) < conf['batch_size']:
+                    continue
+                next_run = time.monotonic() + conf['interval']
+                if relay.due():
+                    forwarded = relay.forward()
+                    if forwarded:
+                        print('Forwarded %s reports, %s' % (forwarded, relay.stats))
+        finally:
+            server.shutdown()
+            server.server_close()
+            relay.forward()
+            saved = relay.save()
+            relay.transport.close()
+        if saved:
+            print('Spooled %s reports' % saved)
+        print('Stopped by signal %s' % stopping[0])
@@ -1,34 +1,118 @@
 import sys
+import time
 import platform
+import threading
+import plugins
+from conf import settings
+from core.fact_cache import FactCache
+from core.low_impact import LIMITS
+from core.profiler import PROFILER
 
 
 class InfoCollection(object):
 
     def collect(self):
         # Collect Platform Info
-        # 首先判断当前平台，根据平台的不同，执行不同的方法
-        try:
-            func = getattr(self, platform.system().lower())
-            info_data = func()
-            formatted_data = self.build_report_data(info_data)
-            return formatted_data
-        except AttributeError:
+        # 首先判断当前平台，找出可以在当前平台运行并且已启用的采集插件
+        found = plugins.collectors()
+        if not found:
             sys.exit("Program does not support current system: [%s]! " % platform.system())
 
-    @staticmethod
-    def linux():
-        from plugins.collect_linux_info import collect
-        return collect()
+        PROFILER.start()
+        LIMITS.start()
+        cache = FactCache() if settings.FACT_CACHE['enabled'] else None
+        sections = cache.load() if cache else dict()
+        # static sections come from the cache, their plugins are not even imported
+        pending = [collector for collector in found if collector.name not in sections]
+        # on a busy host the heavy collectors wait, or are left out of this report
+        pending, skipped = LIMITS.admit(pending)
+        results, errors = self.run_collectors(pending)
+        errors.update(skipped)
+        if cache and results:
+            try:
+                cache.save(results)
+            except OSError as e:
+                print("Can not write fact cache: %s" % e)
+        PROFILER.cached(name for name in sections if name not in results)
+        sections.update(results)
+        info_data = self.merge(sections, errors)
+        if PROFILER.enabled:
+            # left out of the report fingerprint by the server
+            info_data['collect_meta'] = {'profile': PROFILER.report()}
+        formatted_data = self.build_report_data(info_data)
+        return formatted_data
 
     @staticmethod
-    def darwin():
-        from plugins.collect_darwin_info import collect
-        return collect()
+    def run_collectors(collectors):
+        """
+        Run every collector in its own thread, each one with its own deadline.
+        A collector which times out or fails leaves its section out of the report
+        and is listed in 'collect_errors' instead, so one hung command never blocks the agent.
+        :param collectors: [plugins.Collector]
+        :return: ({section name: facts}, {section name: error})
+        """
+        timeouts = settings.COLLECT_TIMEOUT
+        results = dict()
+        errors = dict()
+
+        def target(name, func):
+            try:
+                with PROFILER.collector(name):
+                    results[name] = func()
+            except Exception as e:
+                results[name] = e
+
+        # import everything before the first collector starts
+        loaded = []
+        for collector in collectors:
+            try:
+                loaded.append((collector, collector.load()))
+            except Exception as e:
+                errors[collector.name] = 'error: %s' % e
+
+        start = time.monotonic()
+        deadline = start + timeouts['total']
+        budget = LIMITS.remaining_wall()
+        # the essential collectors are bound by their own timeout only, the others by the wall budget as well
+        limited = deadline if budget is None else min(deadline, start + budget)
+        threads = []
+        for collector, func in loaded:
+            if collector.threaded:
+                # daemon threads, a hung collector must not keep the interpreter alive
+                thread = threading.Thread(target=target, args=(collector.name, func),
+                                          name='collect-%s' % collector.name, daemon=True)
+                thread.start()
+            else:
+                target(collector.name, func)
+                thread = None
+            threads.append((collector.name, thread))
+
+        sections = dict()
+        for name, thread in threads:
+            if thread is not None:
+                timeout = timeouts.get(name, timeouts['default'])
+                end = deadline if LIMITS.essential(name) else limited
+                thread.join(max(0, min(start + timeout, end) - time.monotonic()))
+            result = results.get(name)
+            if name not in results or thread is not None and thread.is_alive():
+                errors[name] = 'timeout after %ss' % round(time.monotonic() - start, 1)
+            elif isinstance(result, Exception):
+                errors[name] = 'error: %s' % result
+            else:
+                sections[name] = result
+        return sections, errors
 
     @staticmethod
-    def windows():
-        from plugins.collect_window_info import collect
-        return collect()
+    def merge(sections, errors):
+        """
+        One flat report out of the sections, failed collectors listed under 'collect_errors'
+        """
+        data = dict()
+        for name in sorted(sections):
+            data.update(sections[name])
+        if errors:
+            data['collect_errors'] = errors
+        return data
 
     @staticmethod
     def build_report_data(data):
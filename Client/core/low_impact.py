@@ -0,0 +1,135 @@
+import os
+import time
+import ctypes
+import platform
+import subprocess
+from conf import settings
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+# ioprio_set(2) has no wrapper in libc
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+
+class LowImpact(object):
+    """
+    Keep the agent out of the way of latency sensitive workloads:
+    lowest CPU and IO priority for the agent and every command it starts (children inherit both),
+    a CPU and wall time budget per collection, and heavy collectors held back while the host is busy.
+    """
+
+    def __init__(self):
+        self.conf = settings.LOW_IMPACT
+        self.enabled = self.conf['enabled']
+        self._wall = None
+        self._cpu = None
+
+    def apply_priority(self):
+        """
+        nice and ionice for this process; call it before any thread or command is started, they inherit it
+        """
+        if hasattr(os, 'nice'):
+            current = os.nice(0)
+            os.nice(max(0, self.conf['nice'] - current))
+        if platform.system() == 'Linux':
+            if not self._ioprio_set(self.conf['ionice_class']):
+                # unknown architecture, let the command do the syscall
+                subprocess.run(['ionice', '-c', str(self.conf['ionice_class']), '-p', str(os.getpid())],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @staticmethod
+    def _ioprio_set(io_class):
+        number = IOPRIO_SET.get(platform.machine())
+        if number is None:
+            return False
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, io_class << IOPRIO_CLASS_SHIFT) == 0
+        except (OSError, AttributeError):
+            return False
+
+    def start(self):
+        """
+        A new collection starts, its budget is full again
+        """
+        self._wall = time.monotonic()
+        self._cpu = self._cpu_time()
+
+    @staticmethod
+    def _cpu_time():
+        used = time.process_time()
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            used += usage.ru_utime + usage.ru_stime
+        return used
+
+    def remaining_wall(self):
+        """
+        :return: seconds left of the wall time budget, None when not limited
+        """
+        if not self.enabled or self._wall is None:
+            return None
+        return max(0.0, self.conf['wall_budget'] - (time.monotonic() - self._wall))
+
+    def exhausted(self):
+        """
+        :return: reason if the CPU or wall time budget of this collection is used up, '' otherwise
+        """
+        if not self.enabled or self._wall is None:
+            return ''
+        used = self._cpu_time() - self._cpu
+        if used >= self.conf['cpu_budget']:
+            return 'cpu budget of %ss used up' % self.conf['cpu_budget']
+        if self.remaining_wall() <= 0:
+            return 'wall budget of %ss used up' % self.conf['wall_budget']
+        return ''
+
+    @staticmethod
+    def load_per_cpu():
+        if not hasattr(os, 'getloadavg'):
+            return 0.0
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+    def essential(self, name):
+        """
+        :return: True for the collectors which identify the host, a report without them is useless
+        """
+        return name in self.conf.get('essential', ())
+
+    def admit(self, collectors):
+        """
+        Hold heavy collectors back while the load average per CPU is above max_load,
+        for at most load_wait seconds; if the host stays busy they are skipped this time.
+        The essential collectors are never held back, and the waiting does not count against the wall budget.
+        :param collectors: [plugins.Collector]
+        :return: (collectors to run, {name: reason} of the skipped ones)
+        """
+        if not self.enabled:
+            return collectors, dict()
+        heavy = [c for c in collectors if c.cost == 'high' and not self.essential(c.name)]
+        if not heavy:
+            return collectors, dict()
+
+        started = time.monotonic()
+        deadline = started + self.conf['load_wait']
+        load = self.load_per_cpu()
+        while load > self.conf['max_load'] and time.monotonic() < deadline:
+            time.sleep(min(5.0, max(0.0, deadline - time.monotonic())))
+            load = self.load_per_cpu()
+        if self._wall is not None:
+            # the collection starts after the wait
+            self._wall += time.monotonic() - started
+        if load <= self.conf['max_load']:
+            return collectors, dict()
+
+        skipped = dict((c.name, 'skipped: load %.2f per cpu' % load) for c in heavy)
+        return [c for c in collectors if c not in heavy], skipped
+
+
+LIMITS = LowImpact()
@@ -0,0 +1,100 @@
+import time
+import threading
+from contextlib import contextmanager
+from conf import settings
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+
+def _children_cpu():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+class Profiler(object):
+    """
+    Wall and CPU time of every collector and wall time of every command it runs, for the collect_meta section.
+    Collectors run in threads: CPU time is counted per thread, commands are attributed to the collector
+    of the thread which started them. The CPU time of the commands themselves is only known for all of them together.
+    """
+
+    def __init__(self):
+        self.enabled = settings.PROFILE
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        self.collectors = dict()
+        self.commands = []
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._children = _children_cpu()
+
+    @contextmanager
+    def collector(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._local.name = name
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.collectors[name] = {'wall_ms': _ms(time.perf_counter() - wall),
+                                         'cpu_ms': _ms(time.thread_time() - cpu)}
+            self._local.name = None
+
+    @contextmanager
+    def command(self, cmd):
+        if not self.enabled:
+            yield
+            return
+        entry = {'collector': getattr(self._local, 'name', None), 'command': ' '.join(cmd), 'failed': False}
+        wall = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            entry['failed'] = True
+            raise
+        finally:
+            entry['wall_ms'] = _ms(time.perf_counter() - wall)
+            with self._lock:
+                self.commands.append(entry)
+
+    def cached(self, names):
+        for name in names:
+            self.collectors[name] = {'wall_ms': 0, 'cpu_ms': 0, 'cached': True}
+
+    def report(self):
+        """
+        :return: the profile section of collect_meta
+        """
+        for entry in self.commands:
+            collector = self.collectors.get(entry['collector'])
+            if collector is not None:
+                collector['commands'] = collector.get('commands', 0) + 1
+                collector['command_ms'] = round(collector.get('command_ms', 0) + entry['wall_ms'], 1)
+        children = _children_cpu()
+        return {
+            'collectors': self.collectors,
+            'commands': self.commands,
+            'wall_ms': _ms(time.perf_counter() - self._wall),
+            'cpu_ms': _ms(time.process_time() - self._cpu),
+            'commands_cpu_ms': _ms(children - self._children) if children is not None else None,
+        }
+
+
+PROFILER = Profiler()
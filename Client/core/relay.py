@@ -0,0 +1,260 @@
+import json
+import time
+import zlib
+import random
+import threading
+import urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from conf import settings
+from core.spool import OfflineSpool
+from core.transport import Transport, TransportError, encode_report
+
+
+class Relay(object):
+    """
+    Site relay: agents of one IDC report here instead of to the server.
+    Reports are kept per SN, a newer one replaces the pending one, and are forwarded upstream
+    as gzip compressed batches every RELAY['interval'] seconds over one keep-alive connection.
+    Failed forwards back off exponentially with jitter, batches the server rejects are dropped;
+    on shutdown the pending reports go to the relay's offline spool and are picked up again on the next start.
+    """
+
+    def __init__(self):
+        self.conf = settings.RELAY
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'received': 0, 'replaced': 0, 'dropped': 0, 'forwarded': 0, 'rejected': 0, 'batches': 0,
+                      'failures': 0}
+        self.failures = 0
+        self.next_try = 0
+        self.spooled = set()
+        self.spool = OfflineSpool(path=self.conf['spool_path'], max_entries=self.conf['max_pending'])
+        # upstream defaults to the server of Params
+        self.transport = Transport(self.conf['upstream_server'], self.conf['upstream_port'])
+
+    def listen(self, address):
+        """
+        :return: HTTP server answering the agents for this relay, not yet serving
+        """
+        handler = type('RelayHandler', (RelayHandler,), {'relay': self})
+        server = ThreadingHTTPServer(address, handler)
+        server.daemon_threads = True
+        return server
+
+    def add(self, reports):
+        """
+        Queue reports, the newest report of an SN wins
+        :return: number of reports accepted
+        """
+        accepted = 0
+        with self.lock:
+            for report in reports:
+                if not isinstance(report, dict) or not report.get('sn'):
+                    continue
+                sn = str(report['sn'])
+                if self.pending.pop(sn, None) is not None:
+                    self.stats['replaced'] += 1
+                self.pending[sn] = report
+                accepted += 1
+            self.stats['received'] += accepted
+            while len(self.pending) > self.conf['max_pending']:
+                # the oldest report goes, its agent reports again anyway
+                self.pending.popitem(last=False)
+                self.stats['dropped'] += 1
+        return accepted
+
+    def due(self):
+        with self.lock:
+            return bool(self.pending) and time.time() >= self.next_try
+
+    def batches(self, items):
+        """
+        Split into batches of at most RELAY['batch_size'] reports and RELAY['batch_bytes'] of JSON,
+        the server rejects a body which decompresses to more than its DATA_UPLOAD_MAX_MEMORY_SIZE
+        """
+        batch, size = [], 0
+        for sn, report in items:
+            length = len(json.dumps(report))
+            if batch and (len(batch) >= self.conf['batch_size'] or size + length > self.conf['batch_bytes']):
+                yield batch
+                batch, size = [], 0
+            batch.append((sn, report))
+            size += length
+        if batch:
+            yield batch
+
+    def forward(self):
+        """
+        Send everything pending upstream in batches.
+        A batch the server rejects (4xx) would be rejected again and is dropped,
+        on any other error it and the batches after it are requeued and retried with backoff.
+        :return: number of reports forwarded
+        """
+        with self.lock:
+            reports, self.pending = self.pending, OrderedDict()
+
+        forwarded = 0
+        items = list(reports.items())
+        sent = 0
+        for batch in self.batches(items):
+            body, headers = encode_report({'reports': [report for sn, report in batch]}, 'gzip')
+            try:
+                self.transport.post(settings.Params['batch_url'], body, headers)
+            except TransportError as e:
+                if e.status >= 500:
+                    self._failed(items[sent:], e)
+                    break
+                print("\033[31;1mServer rejected %s reports, dropped, Error: %s\033[0m" % (len(batch), e))
+                self.stats['rejected'] += len(batch)
+            except Exception as e:
+                self._failed(items[sent:], e)
+                break
+            else:
+                forwarded += len(batch)
+                self.stats['batches'] += 1
+            sent += len(batch)
+            self._unspool(sn for sn, report in batch)
+        else:
+            self.failures = 0
+            self.next_try = 0
+
+        self.stats['forwarded'] += forwarded
+        return forwarded
+
+    def _failed(self, items, error):
+        print("\033[31;1mForward of %s reports failed, Error: %s\033[0m" % (len(items), error))
+        self._requeue(items)
+        self._backoff()
+
+    def _unspool(self, sns):
+        """
+        Reports restored from the spool stay there until they reached the server or were rejected
+        """
+        for sn in sns:
+            if sn in self.spooled:
+                self.spool.discard(sn)
+                self.spooled.discard(sn)
+
+    def _requeue(self, items):
+        with self.lock:
+            # a report which arrived while forwarding is newer than the failed one
+            for sn, report in reversed(items):
+                if sn not in self.pending:
+                    self.pending[sn] = report
+                    self.pending.move_to_end(sn, last=False)
+
+    def _backoff(self):
+        self.failures += 1
+        self.stats['failures'] += 1
+        delay = min(self.conf['max_backoff'], self.conf['interval'] * 2 ** self.failures)
+        self.next_try = time.time() + delay / 2 + random.uniform(0, delay / 2)
+
+    def restore(self):
+        """
+        Reports spooled by the previous run
+        """
+        entries = self.spool.entries()
+        self.add(report for path, mtime, report in entries)
+        # the files are removed once forwarded, a relay killed before that finds them again
+        self.spooled.update(str(report.get('sn')) for path, mtime, report in entries)
+        return len(entries)
+
+    def save(self):
+        """
+        Keep what could not be forwarded for the next start
+        """
+        with self.lock:
+            reports, self.pending = list(self.pending.values()), OrderedDict()
+        self.spool.extend(reports)
+        return len(reports)
+
+
+def read_reports(handler, limit):
+    """
+    Reports of one request to the relay: the JSON body (optionally gzip / deflate compressed)
+    or the legacy asset_data form field, a single report, a list or {"reports": [...]}
+    :raise ValueError: unreadable body
+    """
+    length = int(handler.headers.get('Content-Length') or 0)
+    if length > limit:
+        raise ValueError("Request body is larger than %s bytes" % limit)
+    raw = handler.rfile.read(length)
+
+    encoding = (handler.headers.get('Content-Encoding') or 'identity').strip().lower()
+    if encoding in ('gzip', 'deflate'):
+        if encoding == 'gzip':
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            wbits = zlib.MAX_WBITS if raw[:1] and raw[0] & 0x0f == 8 else -zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits)
+        try:
+            raw = decompressor.decompress(raw, limit)
+        except zlib.error as e:
+            raise ValueError("Corrupt %s data: %s" % (encoding, e))
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("Decompressed data is too large or truncated")
+    elif encoding != 'identity':
+        raise ValueError("Unsupported Content-Encoding: %s" % encoding)
+
+    content_type = (handler.headers.get('Content-Type') or '').split(';')[0].strip()
+    if content_type == 'application/x-www-form-urlencoded':
+        raw = urllib.parse.parse_qs(raw.decode()).get('asset_data', [''])[0]
+    data = json.loads(raw if isinstance(raw, str) else raw.decode())
+    if isinstance(data, dict) and isinstance(data.get('reports'), list):
+        return data['reports']
+    return data if isinstance(data, list) else [data]
+
+
+class RelayHandler(BaseHTTPRequestHandler):
+    """
+    Answers agents like the server would, on the same paths
+    """
+    protocol_version = 'HTTP/1.1'
+    relay = None
+
+    def _reply(self, status, message, json_reply=None):
+        if json_reply is not None and 'application/json' in (self.headers.get('Accept') or ''):
+            body = json.dumps(json_reply).encode()
+            content_type = 'application/json'
+        else:
+            body = message.encode()
+            content_type = 'text/plain; charset=utf-8'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        if path == settings.Params['delta_url']:
+            # the relay keeps no state to apply a delta to, agents fall back to full reports
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            return self._reply(409, "Please send the full report!",
+                               {'status': 'resync', 'message': "Please send the full report!", 'token': None})
+        if path not in (settings.Params['url'], settings.Params['batch_url']):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            return self._reply(404, "Not Found")
+        try:
+            reports = read_reports(self, self.relay.conf['max_body'])
+        except ValueError as e:
+            # the connection can not be reused after an unread body
+            self.close_connection = True
+            return self._reply(400, str(e))
+
+        accepted = self.relay.add(reports)
+        message = "Asset info has been queued by the relay!"
+        if path == settings.Params['batch_url']:
+            return self._reply(202, json.dumps({'accepted': accepted}), {'accepted': accepted})
+        if not accepted:
+            return self._reply(200, "Asset SN number not founded, Please check your data!",
+                               {'status': 'failed', 'message': "Asset SN number not founded!", 'token': None})
+        return self._reply(202, message, {'status': 'queued', 'message': message, 'token': None})
+
+    def do_GET(self):
+        self._reply(200, json.dumps(dict(self.relay.stats, pending=len(self.relay.pending))))
+
+    def log_message(self, format, *args):
+        # one line per agent report would flood the console of a busy relay
+        pass
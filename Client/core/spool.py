@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import random
+import hashlib
+from conf import settings
+from core.transport import TransportError, encode_report
+
+
+class OfflineSpool(object):
+    """
+    Reports which could not be sent, one file per SN: a newer report of the same asset replaces the pending one.
+    The spool holds at most SPOOL['max_entries'] reports, the oldest are dropped first.
+    Pending reports are replayed as one gzip compressed batch to the batch endpoint,
+    retries back off exponentially with jitter so that hosts do not all come back at the same second.
+    """
+
+    STATE_FILE = 'state.json'
+
+    def __init__(self, path=None, max_entries=None):
+        conf = settings.SPOOL
+        self.path = path or conf['path']
+        self.max_entries = max_entries or conf['max_entries']
+        self.backoff = conf['backoff']
+        self.max_backoff = conf['max_backoff']
+
+    def _file(self, sn):
+        return os.path.join(self.path, '%s.json' % hashlib.sha1(str(sn).encode()).hexdigest())
+
+    def _write(self, path, data):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _names(self):
+        try:
+            return [name for name in os.listdir(self.path)
+                    if name.endswith('.json') and name != self.STATE_FILE]
+        except FileNotFoundError:
+            return []
+
+    def entries(self):
+        """
+        :return: [(file, mtime, report)], oldest first
+        """
+        entries = []
+        for name in self._names():
+            path = os.path.join(self.path, name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                with open(path) as f:
+                    entries.append((path, mtime, json.load(f)))
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                # half written by a crashed agent
+                self._remove(path)
+        entries.sort(key=lambda entry: entry[1])
+        return entries
+
+    def put(self, report):
+        """
+        Keep a report for later, replacing an older one of the same SN
+        """
+        self.extend([report])
+
+    def extend(self, reports):
+        """
+        Keep several reports, the directory is trimmed once afterwards
+        """
+        for report in reports:
+            self._write(self._file(report.get('sn')), report)
+        entries = self.entries()
+        for path, mtime, pending in entries[:max(0, len(entries) - self.max_entries)]:
+            self._remove(path)
+
+    def discard(self, sn):
+        """
+        A newer report of this SN reached the server, the pending one is obsolete
+        """
+        self._remove(self._file(sn))
+
+    def _state(self):
+        try:
+            with open(os.path.join(self.path, self.STATE_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'failures': 0, 'next_try': 0}
+
+    def failed(self):
+        """
+        Push the next replay back: backoff * 2 ** failures, capped, half of it random
+        """
+        state = self._state()
+        state['failures'] += 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (state['failures'] - 1))
+        state['next_try'] = time.time() + delay / 2 + random.uniform(0, delay / 2)
+        self._write(os.path.join(self.path, self.STATE_FILE), state)
+
+    def due(self):
+        """
+        :return: True if reports are pending and the backoff has passed
+        """
+        return bool(self._names()) and time.time() >= self._state()['next_try']
+
+    def replay(self, transport):
+        """
+        Send all pending reports in one batch.
+        A batch the server rejects (4xx) would be rejected again and is dropped,
+        on a server error (5xx) or a connection error it stays and is retried with backoff.
+        :param transport: core.transport.Transport
+        :return: number of reports delivered
+        """
+        entries = self.entries()
+        if not entries:
+            return 0
+
+        body, headers = encode_report({'reports': [report for path, mtime, report in entries]}, 'gzip')
+        try:
+            transport.post(settings.Params['batch_url'], body, headers)
+        except Exception as e:
+            if not isinstance(e, TransportError) or e.status >= 500:
+                print("\033[31;1mReplay of %s spooled reports failed, Error: %s\033[0m" % (len(entries), e))
+                self.failed()
+                return 0
+            print("\033[31;1mServer rejected %s spooled reports, dropped, Error: %s\033[0m" % (len(entries), e))
+            self._clear(entries)
+            return 0
+
+        self._clear(entries)
+        print("Replayed %s spooled reports" % len(entries))
+        return len(entries)
+
+    def _clear(self, entries):
+        """
+        Remove the replayed entries and reset the backoff
+        """
+        for path, mtime, report in entries:
+            # a report spooled again while the batch was on its way stays
+            try:
+                if os.stat(path).st_mtime_ns == mtime:
+                    self._remove(path)
+            except FileNotFoundError:
+                pass
+        self._remove(os.path.join(self.path, self.STATE_FILE))
@@ -0,0 +1,97 @@
+import gzip
+import json
+import zlib
+import http.client
+import urllib.parse
+from conf import settings
+
+
+def encode_report(data, report_format='gzip'):
+    """
+    Request body and headers for a report or a batch of reports
+    :param data: report dict, or {'reports': [...]}
+    :param report_format: 'gzip', 'deflate' or 'json' for a JSON body, 'form' for the legacy asset_data field
+    :return: (body bytes, headers)
+    """
+    if report_format == 'form':
+        body = urllib.parse.urlencode({"asset_data": json.dumps(data)}).encode()
+        return body, {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    body = json.dumps(data, separators=(',', ':')).encode()
+    headers = {'Content-Type': 'application/json'}
+    if report_format == 'gzip':
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    elif report_format == 'deflate':
+        body = zlib.compress(body)
+        headers['Content-Encoding'] = 'deflate'
+    return body, headers
+
+
+class TransportError(Exception):
+    """
+    The server answered with an error status
+    """
+
+    def __init__(self, status, message):
+        super().__init__('HTTP %s: %s' % (status, message))
+        self.status = status
+        self.message = message
+
+
+class Transport(object):
+    """
+    One persistent HTTP/1.1 connection to the CMDB server.
+    Opened on the first request and reopened once if the server closed it while idle.
+    """
+
+    # the server dropped an idle keep-alive connection
+    RECONNECT_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                        BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+    def __init__(self, server=None, port=None, timeout=None):
+        self.server = server or settings.Params['server']
+        self.port = port or settings.Params['port']
+        self.timeout = timeout or settings.Params['request_timeout']
+        self.connection = None
+
+    def url(self, path):
+        return "http://%s:%s%s" % (self.server, self.port, path)
+
+    def _request(self, method, path, body, headers):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.server, self.port, timeout=self.timeout)
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        message = response.read().decode(errors='replace')
+        if response.will_close:
+            self.close()
+        return response.status, message
+
+    def post(self, path, body, headers=None):
+        """
+        :param path: i.e. settings.Params['url']
+        :param body: bytes
+        :return: (status, response text)
+        :raise TransportError: status 400 and above
+        """
+        headers = dict(headers or {})
+        for attempt in (1, 2):
+            try:
+                status, message = self._request('POST', path, body, headers)
+                break
+            except self.RECONNECT_ERRORS:
+                self.close()
+                if attempt == 2:
+                    raise
+            except Exception:
+                self.close()
+                raise
+        if status >= 400:
+            raise TransportError(status, message)
+        return status, message
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,93 @@
+import os
+import shutil
+import platform
+import importlib
+
+# relative cost of one run, expensive collectors are started first so that they overlap with the cheap ones
+COST = {'low': 0, 'medium': 1, 'high': 2}
+
+
+class Collector(object):
+    """
+    One section of the report and where its collecting function lives.
+    Only the declaration is kept here, the module is imported when the collector is enabled and applicable.
+    """
+
+    def __init__(self, name, module, function, platforms, requires=(), commands=(), cost='low', threaded=True):
+        """
+        :param name: section name, also the switch in settings.COLLECTORS
+        :param module: module path, i.e. 'plugins.collect_linux_info'
+        :param function: function of the module returning a dict
+        :param platforms: platform.system().lower() values the collector runs on
+        :param requires: files or directories which have to exist
+        :param commands: programs which have to be installed
+        :param cost: 'low', 'medium' or 'high'
+        :param threaded: False if the collector has to run in the main thread
+        """
+        self.name = name
+        self.module = module
+        self.function = function
+        self.platforms = tuple(platforms)
+        self.requires = tuple(requires)
+        self.commands = tuple(commands)
+        self.cost = cost
+        self.threaded = threaded
+
+    def __repr__(self):
+        return '<Collector %s: %s.%s>' % (self.name, self.module, self.function)
+
+    def enabled(self):
+        # imported here, the package has to stay importable without the Client dir on sys.path (test discovery)
+        from conf import settings
+        switches = settings.COLLECTORS
+        return switches.get(self.name, switches.get('default', True))
+
+    def applicable(self, system=None):
+        system = system or platform.system().lower()
+        return system in self.platforms \
+            and all(os.path.exists(path) for path in self.requires) \
+            and all(shutil.which(command) for command in self.commands)
+
+    def load(self):
+        """
+        Import the module on first use
+        :return: the collecting function
+        """
+        module = importlib.import_module(self.module)
+        # a module may keep state for one collection, i.e. the parsed dmidecode output
+        if hasattr(module, 'reset'):
+            module.reset()
+        return getattr(module, self.function)
+
+
+REGISTRY = []
+
+
+def register(collector):
+    """
+    Add a collector, i.e. from a site specific module imported in conf/settings
+    """
+    REGISTRY[:] = [c for c in REGISTRY if not (c.name == collector.name and c.platforms == collector.platforms)]
+    REGISTRY.append(collector)
+    return collector
+
+
+def collectors(system=None):
+    """
+    The enabled collectors which can run on this host, most expensive first
+    """
+    found = [c for c in REGISTRY if c.enabled() and c.applicable(system)]
+    return sorted(found, key=lambda c: -COST.get(c.cost, 0))
+
+
+LINUX = 'plugins.collect_linux_info'
+
+register(Collector('system', LINUX, 'get_system_info', ['linux'], cost='medium'))
+register(Collector('os', LINUX, 'get_os_info', ['linux']))
+register(Collector('cpu', LINUX, 'get_cpu_info', ['linux'], requires=['/proc/cpuinfo']))
+register(Collector('ram', LINUX, 'get_ram_info', ['linux'], requires=['/proc/meminfo'], cost='high'))
+register(Collector('nic', LINUX, 'get_nic_info', ['linux'], cost='medium'))
+register(Collector('disk', LINUX, 'get_disk_info', ['linux'], requires=['/sys/block'], cost='medium'))
+register(Collector('darwin', 'plugins.collect_darwin_info', 'collect', ['darwin']))
+# wmi needs COM initialised in the calling thread
+register(Collector('windows', 'plugins.collect_window_info', 'collect', ['windows'], cost='high', threaded=False))
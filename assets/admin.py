@@ -1,36 +1,75 @@
+import json
+
 from django.contrib import admin
+from django.contrib import messages
+from django.utils.html import format_html
 
 # Register your models here.
 from assets import models
 from assets import asset_handler
 
 
+def json_display(value):
+    # CompressedJSONField is a BinaryField, which the change form does not show at all
+    if value is None:
+        return '-'
+    return format_html('<pre>{}</pre>', json.dumps(value, indent=2, ensure_ascii=False, sort_keys=True))
+
+
 # ModelAdmin类是一个模型在admin页面里的展示方法，如果你对默认的admin页面满意，那么你完全不需要定义这个类，直接使用最原始的样子也行。
 # 通常，它们保存在app的admin.py文件里
 class NewAssetAdmin(admin.ModelAdmin):
     list_display = ['asset_type', 'sn', 'model', 'manufacturer', 'c_time', 'm_time']
     list_filter = ['asset_type', 'manufacturer', 'c_time']
     search_fields = ('sn',)
+    readonly_fields = ['report_data']
+
+    def report_data(self, obj):
+        return json_display(obj.data)
+
+    report_data.short_description = 'Asset Data'
+
+    def get_queryset(self, request):
+        # the compressed raw report is not needed on the list page
+        return super().get_queryset(request).defer('data')
 
     # the member of the list should be exactly the same as the function name
     actions = ['approve_selected_new_assets']
 
     def approve_selected_new_assets(self, request, queryset):
-        selected = request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
-        success_upline_number = 0
-        for asset_id in selected:
-            obj = asset_handler.ApprovedAsset(request, asset_id)
-            ret = obj.asset_upline()
-            if ret:
-                success_upline_number += 1
+        # the queryset also covers "select all N" across pages, the POSTed checkboxes only the current page
+        selected = list(queryset.values_list('id', flat=True))
+        obj = asset_handler.BulkApprovedAsset(request, selected)
+        success_upline_number = obj.asset_upline()
 
         self.message_user(request, "Approved. %s new asset(s) has been online" % success_upline_number)
+        if obj.failed:
+            failed = ["%s: %s" % (sn, reason) for sn, reason in sorted(obj.failed.items())]
+            self.message_user(request, "%s new asset(s) failed. %s" % (len(failed), "; ".join(failed[:20])),
+                              level=messages.WARNING)
 
     approve_selected_new_assets.short_description = "Approved the new selected asset(s)"
 
 
 class AssetAdmin(admin.ModelAdmin):
     list_display = ['asset_type', 'name', 'status', 'approved_by', 'c_time', 'm_time']
+    readonly_fields = ['last_report']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('report')
+
+    def last_report(self, obj):
+        return json_display(obj.report)
+
+    last_report.short_description = 'Last Report'
+
+
+class CollectorProfileAdmin(admin.ModelAdmin):
+    list_display = ['asset', 'collector', 'wall_ms', 'cpu_ms', 'commands', 'command_ms', 'cached', 'm_time']
+    list_filter = ['collector', 'cached']
+    search_fields = ('asset__sn', 'asset__name')
+    ordering = ['-wall_ms']
+    list_select_related = ['asset']
 
 
 # admin/ can show these models after these registration steps
@@ -41,6 +80,7 @@ admin.site.register(models.StorageDevice)
 admin.site.register(models.SecurityDevice)
 admin.site.register(models.BusinessUnit)
 admin.site.register(models.Contract)
+admin.site.register(models.CollectorProfile, CollectorProfileAdmin)
 admin.site.register(models.CPU)
 admin.site.register(models.Disk)
 admin.site.register(models.EventLog)
@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 
 
 class AssetsConfig(AppConfig):
     name = 'assets'
+
+    def ready(self):
+        from assets import lookup_cache
+        for model in lookup_cache.CACHES:
+            post_save.connect(lookup_cache.invalidate, sender=model, dispatch_uid='lookup_cache_save')
+            post_delete.connect(lookup_cache.invalidate, sender=model, dispatch_uid='lookup_cache_delete')
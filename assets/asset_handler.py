@@ -1,15 +1,178 @@
+import hashlib
 import json
+import time
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+from assets import event_writer
+from assets import lookup_cache
+from assets import metrics
 from assets import models
 
+# sqlite can not bind more than 999 parameters in one statement, IN clauses and bulk writes are chunked
+BATCH_SIZE = 500
+
+# Disk.interface_type values, anything else is stored as 'unknown'
+DISK_INTERFACE_TYPES = [choice for choice, label in models.Disk.disk_interface_type_choice]
+
+
+def check_report(data):
+    """
+    Validate one report
+    :param data: decoded asset_data
+    :return: error message, None if the report is acceptable
+    """
+    if not data:
+        return "No Data"
+    if not isinstance(data, dict):
+        return "Data type should be Dictionary"
+    if not data.get('sn'):
+        return "Asset SN number not founded, Please check your data!"
+    if not isinstance(data['sn'], (str, int)):
+        return "Asset SN number should be a string"
+    asset_type = data.get('asset_type')
+    if not asset_type:
+        return "Asset type not founded, Please check your data!"
+    # UpdateAsset has one _<type>_update method per asset type a report can describe
+    if not isinstance(asset_type, str) or not hasattr(UpdateAsset, '_%s_update' % asset_type):
+        return "Asset type %s is not supported" % asset_type
+    return None
+
+
+def _canonical(value):
+    if isinstance(value, dict):
+        return dict((str(k), _canonical(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        # component lists come in whatever order the agent collected them
+        items = [_canonical(v) for v in value]
+        return sorted(items, key=lambda v: json.dumps(v, sort_keys=True, default=str))
+    return value
+
+
+# report keys which change on every run and are not part of the hardware state, i.e. the --profile timings
+VOLATILE_KEYS = ('collect_meta',)
+
+
+def report_fingerprint(data):
+    """
+    Canonical hash of a report, the same hardware always gives the same fingerprint.
+    The agent computes it as well (Client/core/delta.py), assets/tests.py checks that both agree
+    :param data: decoded asset_data
+    :return: sha256 hex digest
+    """
+    data = dict((key, value) for key, value in data.items() if key not in VOLATILE_KEYS)
+    raw = json.dumps(_canonical(data), sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def touch_if_unchanged(asset, data):
+    """
+    If the report is the same as the last applied one, only bump last_seen of the asset
+    :return: True if nothing else has to be written
+    """
+    if asset.report_hash and asset.report_hash == report_fingerprint(data):
+        models.Asset.objects.filter(id=asset.id).update(last_seen=timezone.now())
+        return True
+    return False
+
+
+def apply_report(request, data, reraise=False):
+    """
+    Apply one validated report, either update the online asset or put it into the approval zone.
+    Used by the report view and by the spool workers, which pass request=None.
+    :param reraise: let a DatabaseError of the update propagate instead of answering 'failed',
+        the spool workers keep the report for another try
+    :return: (status, message)
+    """
+    asset_obj = models.Asset.objects.select_related('server', 'cpu', 'manufacturer').defer('report') \
+        .filter(sn=data['sn']).first()
+    if asset_obj:
+        if touch_if_unchanged(asset_obj, data):
+            record_profiles({asset_obj.id: data}, unchanged=True)
+            return 'unchanged', "Asset info is unchanged!"
+        record_profiles({asset_obj.id: data})
+        if UpdateAsset(request, asset_obj, data, reraise=reraise).result:
+            return 'updated', "Asset info has been updated!"
+        return 'failed', "Asset info update failed!"
+    obj = NewAsset(request, data)
+    return 'new', obj.add_to_new_assets_zone()
+
+
+# asset id -> time.monotonic() its timings were last written by this process
+_profiled = dict()
+
+
+def record_profiles(reports, unchanged=False):
+    """
+    Keep the collector timings of reports sent with --profile, replacing the ones of the previous report.
+    Reports without timings cost no query. The timings of unchanged reports are sampled, written at most once
+    per ASSET_COLLECTOR_PROFILES['unchanged_interval'] seconds per asset, so an agent left in profiling mode
+    does not turn the cheap unchanged path into a delete and an insert per report.
+    :param reports: {asset id: report}
+    :param unchanged: the reports only bumped last_seen
+    """
+    interval = getattr(settings, 'ASSET_COLLECTOR_PROFILES', {}).get('unchanged_interval', 3600)
+    now = time.monotonic()
+    if len(_profiled) > 100000:
+        for asset_id, written in list(_profiled.items()):
+            if now - written >= interval:
+                del _profiled[asset_id]
+    rows = []
+    for asset_id, data in reports.items():
+        meta = data.get('collect_meta')
+        profile = meta.get('profile') if isinstance(meta, dict) else None
+        if not isinstance(profile, dict):
+            continue
+        if unchanged and asset_id in _profiled and now - _profiled[asset_id] < interval:
+            continue
+        _profiled[asset_id] = now
+        for name, timing in (profile.get('collectors') or {}).items():
+            if not isinstance(timing, dict):
+                continue
+            rows.append(models.CollectorProfile(
+                asset_id=asset_id, collector=str(name)[:64], wall_ms=timing.get('wall_ms') or 0,
+                cpu_ms=timing.get('cpu_ms'), commands=timing.get('commands') or 0,
+                command_ms=timing.get('command_ms') or 0, cached=bool(timing.get('cached'))))
+        cpu_ms = profile.get('cpu_ms')
+        if cpu_ms is not None and profile.get('commands_cpu_ms') is not None:
+            cpu_ms += profile['commands_cpu_ms']
+        rows.append(models.CollectorProfile(
+            asset_id=asset_id, collector=models.CollectorProfile.TOTAL, wall_ms=profile.get('wall_ms') or 0,
+            cpu_ms=cpu_ms, commands=len(profile.get('commands') or []),
+            command_ms=sum(c.get('wall_ms') or 0 for c in profile.get('commands') or [])))
+    if not rows:
+        return
+
+    asset_ids = set(row.asset_id for row in rows)
+    try:
+        with transaction.atomic():
+            models.CollectorProfile.objects.filter(asset_id__in=asset_ids).delete()
+            models.CollectorProfile.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    except Exception as e:
+        # timings are nice to have, they never fail a report
+        print(e)
+
+
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
 class NewAsset(object):
     def __init__(self, request, data):
         self.request = request
         self.data = data
 
-    def add_to_new_assets_zone(self):
-        defaults = {
-            'data': json.dumps(self.data),
+    def zone_defaults(self):
+        """
+        Columns of the approval zone row built from the report
+        :return:
+        """
+        return {
+            'data': self.data,
             'asset_type': self.data.get('asset_type'),
             'manufacturer': self.data.get('manufacturer'),
             'model': self.data.get('model'),
@@ -21,8 +184,12 @@ class NewAsset(object):
             'os_release': self.data.get('os_release'),
             'os_type': self.data.get('os_type'),
         }
+
+    def add_to_new_assets_zone(self):
+        defaults = self.zone_defaults()
         # Each models has one manager, which named objects as default
-        models.NewAssetApprovalZone.objects.update_or_create(sn=self.data['sn'], defaults=defaults)
+        with metrics.phase('NewAsset', 'zone'):
+            models.NewAssetApprovalZone.objects.update_or_create(sn=self.data['sn'], defaults=defaults)
         return 'Asset has been added or updated to new asset approval zone.'
 
     def log(log_type, msg=None, asset=None, new_asset=None, request=None):
@@ -56,7 +223,8 @@ class NewAsset(object):
             event.asset = asset
             event.detail = "Update Failed! \n%s" % (msg)
 
-        event.save()
+        # 失败事件立即写入，其他事件缓冲后批量写入
+        event_writer.writer.add(event, critical=log_type in event_writer.CRITICAL_EVENTS)
 
 
 class ApprovedAsset:
@@ -67,7 +235,7 @@ class ApprovedAsset:
     def __init__(self, request, asset_id):
         self.request = request
         self.new_asset = models.NewAssetApprovalZone.objects.get(id=asset_id)
-        self.data = json.loads(self.new_asset.data)
+        self.data = self.new_asset.data
 
     def asset_upline(self):
         func = getattr(self, "_%s_upline" % self.new_asset.asset_type)
@@ -75,13 +243,16 @@ class ApprovedAsset:
         return ret
 
     def _server_upline(self):
-        asset = self._create_asset()
+        with metrics.phase('ApprovedAsset', 'asset'):
+            asset = self._create_asset()
         try:
-            self._create_manufacturer(asset)
-            self._create_server(asset)
-            self._create_CPU(asset)
-            self._create_RAM(asset)
-            self._create_nic(asset)
+            for name, func in (('manufacturer', self._create_manufacturer),
+                               ('server', self._create_server),
+                               ('cpu', self._create_CPU),
+                               ('ram', self._create_RAM),
+                               ('nic', self._create_nic)):
+                with metrics.phase('ApprovedAsset', name):
+                    func(asset)
             self._delete_original_asset()
         except Exception as e:
             asset.delete()
@@ -115,8 +286,7 @@ class ApprovedAsset:
         """
         m = self.new_asset.manufacturer
         if m:
-            manufacturer_obj, _ = models.Manufacturer.objects.get_or_create(name=m)
-            asset.manufacturer = manufacturer_obj
+            asset.manufacturer = lookup_cache.MANUFACTURERS.get(m)
             asset.save()
 
     def _create_server(self, asset):
@@ -183,7 +353,7 @@ class ApprovedAsset:
             disk.slot = disk_dict.get('slot')
             disk.capacity = disk_dict.get('capacity', 0)
             iface = disk_dict.get('interface_type')
-            if iface in ['SATA', 'SAS', 'SCSI', 'SSD', 'unknown']:
+            if iface in DISK_INTERFACE_TYPES:
                 disk.interface_type = iface
 
             disk.save()
@@ -213,6 +383,7 @@ class ApprovedAsset:
             if nic_dict.get('net_mask'):
                 if len(nic_dict.get('net_mask')) > 0:
                     nic.net_mask = nic_dict.get('net_mask')[0]
+            nic.bonding = _bond_name(nic_dict)
             nic.save()
 
     def _delete_original_asset(self):
@@ -225,16 +396,277 @@ class ApprovedAsset:
         self.new_asset.delete()
 
 
+class ComponentDiff:
+    """
+    Set based diff of one component type (RAM, disk, NIC) of an asset.
+    使用集合数据类型中差的概念，处理不同的情况：
+    如果新数据有，但原数据没有，则新增；
+    如果新数据没有，但原数据有，则删除原来多余的部分；
+    如果新的和原数据都有，且字段有变化，则更新，没有变化的不写数据库。
+    Rows are compared as plain value tuples, every set is applied with a single bulk statement.
+    """
+
+    def __init__(self, model, key_fields, value_fields, clean):
+        """
+        :param model: component model, with a foreign key to Asset
+        :param key_fields: fields which identify one component of an asset
+        :param value_fields: fields which are updated
+        :param clean: function which turns one reported component into {field: value}
+        """
+        self.model = model
+        self.key_fields = tuple(key_fields)
+        self.value_fields = tuple(value_fields)
+        self.clean = clean
+        self.fields = [model._meta.get_field(name) for name in self.key_fields + self.value_fields]
+        # ram_set, disk_set, nic_set
+        self.accessor = model._meta.get_field('asset').remote_field.get_accessor_name()
+
+    def normalize(self, item):
+        """
+        Convert one reported component into a (key, values) tuple comparable with what is read from the database
+        """
+        values = self.clean(item)
+        row = []
+        for field in self.fields:
+            value = field.to_python(values.get(field.name))
+            if value == '' and field.null:
+                value = None
+            row.append(value)
+        size = len(self.key_fields)
+        return tuple(row[:size]), tuple(row[size:])
+
+    def old_rows(self, asset):
+        """
+        :return: {key: (id, values)} of the stored components, read from the prefetched set if there is one
+        """
+        rows = dict()
+        for obj in getattr(asset, self.accessor).all():
+            key = tuple(getattr(obj, name) for name in self.key_fields)
+            rows[key] = (obj.id, tuple(getattr(obj, name) for name in self.value_fields))
+        return rows
+
+    def diff(self, old, new):
+        """
+        :param old: {key: (id, values)}
+        :param new: {key: values}
+        :return: keys to insert, ids to delete, (id, key) to update
+        """
+        to_create = [key for key in new if key not in old]
+        to_delete = [old[key][0] for key in old if key not in new]
+        to_update = [(old[key][0], key) for key in new if key in old and old[key][1] != new[key]]
+        return to_create, to_delete, to_update
+
+    def sync(self, asset, report_data, section):
+        """
+        Apply the reported components to the asset
+        :param asset:
+        :param report_data: the whole report
+        :param section: key of the component list in the report, the components are left alone if it is missing
+        :return: number of inserted, deleted and updated rows
+        """
+        if section not in report_data:
+            return 0, 0, 0
+
+        new = dict()
+        for item in report_data[section] or []:
+            key, values = self.normalize(item)
+            new[key] = values
+
+        to_create, to_delete, to_update = self.diff(self.old_rows(asset), new)
+
+        if to_delete:
+            self.model.objects.filter(id__in=to_delete).delete()
+        if to_create:
+            self.model.objects.bulk_create([self.build(asset, key, new[key]) for key in to_create],
+                                           batch_size=BATCH_SIZE)
+        if to_update:
+            self.model.objects.bulk_update([self.build(asset, key, new[key], pk) for pk, key in to_update],
+                                           self.value_fields, batch_size=BATCH_SIZE)
+        return len(to_create), len(to_delete), len(to_update)
+
+    def build(self, asset, key, values, pk=None):
+        obj = self.model(id=pk, asset=asset)
+        for name, value in zip(self.key_fields + self.value_fields, key + values):
+            setattr(obj, name, value)
+        return obj
+
+
+def reported(data, *keys):
+    """
+    Only the keys present in the report. A client whose collector timed out leaves that section out
+    (and names it in 'collect_errors'), the stored values are kept then.
+    """
+    return {key: data[key] for key in keys if key in data}
+
+
+def save_changed(obj, values):
+    """
+    Assign the reported values to a model instance and save only the fields which changed
+    :param obj: model instance
+    :param values: {field name: reported value}
+    :return: names of the changed fields
+    """
+    changed = []
+    for name, value in values.items():
+        field = obj._meta.get_field(name)
+        value = field.to_python(value)
+        if value == '' and field.null:
+            value = None
+        if getattr(obj, name) != value:
+            setattr(obj, name, value)
+            changed.append(name)
+    if changed:
+        obj.save(update_fields=changed)
+    return changed
+
+
+def _clean_ram(item):
+    return {
+        'slot': item.get('slot'),
+        'sn': item.get('sn'),
+        'model': item.get('model'),
+        'manufacturer': item.get('manufacturer'),
+        'capacity': item.get('capacity', 0),
+    }
+
+
+def _clean_disk(item):
+    interface_type = item.get('interface_type', 'unknown')
+    if interface_type not in DISK_INTERFACE_TYPES:
+        interface_type = 'unknown'
+    return {
+        'sn': item.get('sn'),
+        'slot': item.get('slot'),
+        'model': item.get('model'),
+        'manufacturer': item.get('manufacturer'),
+        'capacity': item.get('capacity', 0),
+        'interface_type': interface_type,
+    }
+
+
+def _clean_nic(item):
+    if item.get('net_mask') and len(item.get('net_mask')) > 0:
+        net_mask = item.get('net_mask')[0]
+    else:
+        net_mask = ""
+    return {
+        'model': item.get('model'),
+        'mac': item.get('mac'),
+        'name': item.get('name'),
+        'ip_address': item.get('ip_address'),
+        'net_mask': net_mask,
+        'bonding': _bond_name(item),
+    }
+
+
+def _bond_name(item):
+    # the bond a NIC is a member of; older clients send 0 / 1 here
+    bonding = item.get('bonding')
+    return bonding if isinstance(bonding, str) else None
+
+
+# component sets of an asset, prefetched before an update
+COMPONENT_SETS = ('ram_set', 'disk_set', 'nic_set')
+
+RAM_DIFF = ComponentDiff(models.RAM, ['slot'], ['sn', 'model', 'manufacturer', 'capacity'], _clean_ram)
+DISK_DIFF = ComponentDiff(models.Disk, ['sn'], ['slot', 'model', 'manufacturer', 'capacity', 'interface_type'],
+                          _clean_disk)
+NIC_DIFF = ComponentDiff(models.NIC, ['model', 'mac'], ['name', 'ip_address', 'net_mask', 'bonding'], _clean_nic)
+
+# report section -> diff, a delta report addresses components by the same keys
+DELTA_COMPONENTS = {
+    'ram': RAM_DIFF,
+    'physical_disk_driver': DISK_DIFF,
+    'nic': NIC_DIFF,
+}
+
+
+def report_token(status, data):
+    """
+    Version token of the stored state after a report, the base of the next delta report
+    :return: report fingerprint, None if nothing is stored for the asset (approval zone, failed update)
+    """
+    if status in ('updated', 'unchanged'):
+        return report_fingerprint(data)
+    return None
+
+
+def merge_delta(report, delta):
+    """
+    Rebuild a full report from the stored one and a delta report
+    :param report: last applied report
+    :param delta: {"changed": {key: value}, "removed": [key],
+                   "components": {section: {"upsert": [component], "delete": [[key values]]}}}
+    :return: the full report
+    :raise ValueError: malformed delta
+    """
+    data = dict(report)
+    data.update(delta.get('changed') or {})
+    for key in delta.get('removed') or []:
+        data.pop(key, None)
+
+    for section, change in (delta.get('components') or {}).items():
+        if section not in DELTA_COMPONENTS or not isinstance(change, dict):
+            raise ValueError("Unknown component section: %s" % section)
+        key_fields = DELTA_COMPONENTS[section].key_fields
+        items = dict()
+        for item in data.get(section) or []:
+            items[tuple(item.get(f) for f in key_fields)] = item
+        for key in change.get('delete') or []:
+            items.pop(tuple(key), None)
+        for item in change.get('upsert') or []:
+            items[tuple(item.get(f) for f in key_fields)] = item
+        data[section] = list(items.values())
+    return data
+
+
+def apply_delta(request, delta):
+    """
+    Apply a delta report: only the sections and components which changed since the state named by delta['base'].
+    The agent also sends delta['token'], the fingerprint of its full report; if the stored state is not the base,
+    or the merge does not reproduce that report, the agent has to send the full report again.
+    :return: (status, message, token), status 'resync' when a full report is needed
+    """
+    asset = models.Asset.objects.only('id', 'report_hash', 'report').filter(sn=delta.get('sn')).first()
+    if asset is None or not asset.report_hash or asset.report_hash != delta.get('base'):
+        return 'resync', "Version token does not match, please send the full report!", None
+    if not isinstance(asset.report, dict):
+        # fingerprinted before the report itself was stored (migration 0004), nothing to merge into
+        return 'resync', "No stored report to apply the delta to, please send the full report!", None
+
+    data = merge_delta(asset.report, delta)
+    if delta.get('token') != report_fingerprint(data):
+        return 'resync', "Delta does not reproduce the report, please send the full report!", None
+    status, message = apply_report(request, data)
+    return status, message, report_token(status, data)
+
+
 class UpdateAsset:
     """
-    Auto Update online asset
+    Auto Update online asset.
+    The whole update runs in one transaction and only writes what changed. Pass an asset fetched with
+    select_related('server', 'cpu', 'manufacturer'), the RAM / disk / NIC sets are prefetched here unless the
+    caller already did it. Statements per report:
+        1  asset, server, CPU and manufacturer (by the caller)
+        3  prefetch of RAM, disk and NIC
+        0  manufacturer, resolved by lookup_cache; 4 for a vendor never seen before
+        1  server, 1  CPU, only when changed
+        9  one insert, update and delete per component type, only for the changed sets
+        1  asset (with the stored report), 1  event log
+    that is 21 plus BEGIN / COMMIT, and a single commit (fsync) on SQLite. The 9 hold while no more than 142
+    components of a type are inserted or updated: on SQLite Django splits bulk_create into 999 // columns rows
+    per INSERT (166 RAM, 142 disks or NICs) and bulk_update into 999 // (fields + 2) rows per UPDATE (166),
+    whatever BATCH_SIZE says, so bigger changed sets take one more statement per slice.
     """
 
-    def __init__(self, request, asset, report_data):
+    def __init__(self, request, asset, report_data, reraise=False):
         self.request = request
         self.asset = asset
         self.report_data = report_data
-        self.asset_update()
+        self.reraise = reraise
+        if not hasattr(asset, '_prefetched_objects_cache'):
+            prefetch_related_objects([asset], *COMPONENT_SETS)
+        self.result = self.asset_update()
 
     def asset_update(self):
         func = getattr(self, "_%s_update" % self.report_data['asset_type'])
@@ -243,14 +675,23 @@ class UpdateAsset:
 
     def _server_update(self):
         try:
-            self._update_manufacturer()  # 更新厂商
-            self._update_server()  # 更新服务器
-            self._update_CPU()  # 更新CPU
-            self._update_RAM()  # 更新内存
-            self._update_disk()  # 更新硬盘
-            self._update_nic()  # 更新网卡
-            self.asset.save()
+            with transaction.atomic():
+                # 依次更新厂商、服务器、CPU、内存、硬盘和网卡
+                for name, func in (('manufacturer', self._update_manufacturer),
+                                   ('server', self._update_server),
+                                   ('cpu', self._update_CPU),
+                                   ('ram', self._update_RAM),
+                                   ('disk', self._update_disk),
+                                   ('nic', self._update_nic)):
+                    with metrics.phase('UpdateAsset', name):
+                        func()
+                self.asset.report_hash = report_fingerprint(self.report_data)
+                self.asset.report = self.report_data
+                self.asset.last_seen = timezone.now()
+                self.asset.save(update_fields=['manufacturer', 'report_hash', 'report', 'last_seen', 'm_time'])
         except Exception as e:
+            if self.reraise and isinstance(e, DatabaseError):
+                raise
             NewAsset.log('update_failed', msg=e, asset=self.asset, request=self.request)
             print(e)
             return False
@@ -262,148 +703,304 @@ class UpdateAsset:
 
     def _update_manufacturer(self):
         """
-        更新厂商
+        更新厂商。厂商没有变化时不查询数据库，变化时从进程内缓存中查找
         """
+        if 'manufacturer' not in self.report_data:
+            return
         m = self.report_data.get('manufacturer')
+        current = self.asset.manufacturer
         if m:
-            manufacturer_obj, _ = models.Manufacturer.objects.get_or_create(name=m)
-            self.asset.manufacturer = manufacturer_obj
+            if current is None or current.name != m:
+                self.asset.manufacturer = lookup_cache.MANUFACTURERS.get(m)
         else:
             self.asset.manufacturer = None
-        self.asset.manufacturer.save()
 
     def _update_server(self):
         """
         更新服务器
         """
-        self.asset.server.model = self.report_data.get('model')
-        self.asset.server.os_type = self.report_data.get('os_type')
-        self.asset.server.os_distribution = self.report_data.get('os_distribution')
-        self.asset.server.os_release = self.report_data.get('os_release')
-        self.asset.server.save()
+        save_changed(self.asset.server, reported(
+            self.report_data, 'model', 'os_type', 'os_distribution', 'os_release'))
 
     def _update_CPU(self):
         """
         更新CPU信息
         :return:
         """
-        self.asset.cpu.cpu_model = self.report_data.get('cpu_model')
-        self.asset.cpu.cpu_count = self.report_data.get('cpu_count')
-        self.asset.cpu.cpu_core_count = self.report_data.get('cpu_core_count')
-        self.asset.cpu.save()
+        save_changed(self.asset.cpu, reported(
+            self.report_data, 'cpu_model', 'cpu_count', 'cpu_core_count'))
 
     def _update_RAM(self):
         """
-        更新内存信息。
-        使用集合数据类型中差的概念，处理不同的情况。
-        如果新数据有，但原数据没有，则新增；
-        如果新数据没有，但原数据有，则删除原来多余的部分；
-        如果新的和原数据都有，则更新。
-        在原则上，下面的代码应该写成一个复用的函数，
-        但是由于内存、硬盘、网卡在某些方面的差别，导致很难提取出重用的代码。
-        :return:
+        更新内存信息。以slot确定每条内存。
         """
-        # 获取已有内存信息，并转成字典格式
-        old_rams = models.RAM.objects.filter(asset=self.asset)
-        old_rams_dict = dict()
-        if old_rams:
-            for ram in old_rams:
-                old_rams_dict[ram.slot] = ram
-        # 获取新数据中的内存信息，并转成字典格式
-        new_rams_list = self.report_data['ram']
-        new_rams_dict = dict()
-        if new_rams_list:
-            for item in new_rams_list:
-                new_rams_dict[item['slot']] = item
-
-        # 利用set类型的差集功能，获得需要删除的内存数据对象
-        need_deleted_keys = set(old_rams_dict.keys()) - set(new_rams_dict.keys())
-        if need_deleted_keys:
-            for key in need_deleted_keys:
-                old_rams_dict[key].delete()
-
-                # 需要新增或更新的
-                if new_rams_dict:
-                    for key in new_rams_dict:
-                        defaults = {
-                            'sn': new_rams_dict[key].get('sn'),
-                            'model': new_rams_dict[key].get('model'),
-                            'manufacturer': new_rams_dict[key].get('manufacturer'),
-                            'capacity': new_rams_dict[key].get('capacity', 0),
-                        }
-                        models.RAM.objects.update_or_create(asset=self.asset, slot=key, defaults=defaults)
+        RAM_DIFF.sync(self.asset, self.report_data, 'ram')
 
     def _update_disk(self):
         """
-        更新硬盘信息。类似更新内存。
-        """
-        old_disks = models.Disk.objects.filter(asset=self.asset)
-        old_disks_dict = dict()
-        if old_disks:
-            for disk in old_disks:
-                old_disks_dict[disk.sn] = disk
-
-        new_disks_list = self.report_data['physical_disk_driver']
-        new_disks_dict = dict()
-        if new_disks_list:
-            for item in new_disks_list:
-                new_disks_dict[item['sn']] = item
-
-        # 需要删除的
-        need_deleted_keys = set(old_disks_dict.keys()) - set(new_disks_dict.keys())
-        if need_deleted_keys:
-            for key in need_deleted_keys:
-                old_disks_dict[key].delete()
-                # 需要新增或更新的
-                if new_disks_dict:
-                    for key in new_disks_dict:
-                        interface_type = new_disks_dict[key].get('interface_type', 'unknown')
-                        if interface_type not in ['SATA', 'SAS', 'SCSI', 'SSD', 'unknown']:
-                            interface_type = 'unknown'
-                        defaults = {
-                            'slot': new_disks_dict[key].get('slot'),
-                            'model': new_disks_dict[key].get('model'),
-                            'manufacturer': new_disks_dict[key].get('manufacturer'),
-                            'capacity': new_disks_dict[key].get('capacity', 0),
-                            'interface_type': interface_type,
-                        }
-                        models.Disk.objects.update_or_create(asset=self.asset, sn=key, defaults=defaults)
+        更新硬盘信息。以sn确定每块硬盘。
+        """
+        DISK_DIFF.sync(self.asset, self.report_data, 'physical_disk_driver')
 
     def _update_nic(self):
         """
-        更新网卡信息。类似更新内存。
-        """
-        old_nics = models.NIC.objects.filter(asset=self.asset)
-        old_nics_dict = dict()
-        if old_nics:
-            for nic in old_nics:
-                old_nics_dict[nic.model + nic.mac] = nic
-
-        new_nics_list = self.report_data['nic']
-        new_nics_dict = dict()
-        if new_nics_list:
-            for item in new_nics_list:
-                new_nics_dict[item['model'] + item['mac']] = item
-
-        # 需要删除的
-        need_deleted_keys = set(old_nics_dict.keys()) - set(new_nics_dict.keys())
-        if need_deleted_keys:
-            for key in need_deleted_keys:
-                old_nics_dict[key].delete()
-
-                # 需要新增或更新的
-                if new_nics_dict:
-                    for key in new_nics_dict:
-                        if new_nics_dict[key].get('net_mask') and len(new_nics_dict[key].get('net_mask')) > 0:
-                            net_mask = new_nics_dict[key].get('net_mask')[0]
-                        else:
-                            net_mask = ""
-                        defaults = {
-                            'name': new_nics_dict[key].get('name'),
-                            'ip_address': new_nics_dict[key].get('ip_address'),
-                            'net_mask': net_mask,
-                        }
-                        models.NIC.objects.update_or_create(asset=self.asset, model=new_nics_dict[key]['model'],
-                                                            mac=new_nics_dict[key]['mac'], defaults=defaults)
-
-        print('更新成功！')
+        更新网卡信息。以型号和mac确定每块网卡。
+        """
+        NIC_DIFF.sync(self.asset, self.report_data, 'nic')
+
+
+class BatchReport:
+    """
+    Ingest many reports with one request, i.e. from a relay node in front of a whole rack.
+    SNs are resolved with one query per chunk, approval zone rows are written with bulk_create / bulk_update
+    and every online asset is updated in its own savepoint, so one bad host does not fail the batch.
+    """
+
+    zone_fields = ['data', 'asset_type', 'manufacturer', 'model', 'ram_size', 'cpu_model', 'cpu_count',
+                   'cpu_core_count', 'os_distribution', 'os_release', 'os_type', 'm_time']
+
+    def __init__(self, request, reports):
+        self.request = request
+        self.reports = reports
+        self.results = []
+
+    def process(self):
+        """
+        :return: one result dict per report, with sn, status ('new', 'updated', 'unchanged', 'failed'
+                 or 'skipped' for an earlier report of an SN sent twice) and message
+        """
+        valid = dict()
+        indexes = dict()
+        for index, data in enumerate(self.reports):
+            error = check_report(data)
+            if error:
+                sn = data.get('sn') if isinstance(data, dict) else None
+                self.results.append({'index': index, 'sn': sn, 'status': 'failed', 'message': error})
+            else:
+                # the latest report wins when one sn shows up more than once
+                if data['sn'] in valid:
+                    self.results.append({'index': indexes[data['sn']], 'sn': data['sn'], 'status': 'skipped',
+                                         'message': 'Replaced by a later report of the same SN in this batch'})
+                valid[data['sn']] = data
+                indexes[data['sn']] = index
+
+        assets = dict()
+        with metrics.phase('BatchReport', 'resolve'):
+            for chunk in chunks(valid):
+                queryset = models.Asset.objects.select_related('server', 'cpu', 'manufacturer').defer('report') \
+                    .filter(sn__in=chunk)
+                assets.update((asset.sn, asset) for asset in queryset)
+
+        new_reports = dict((sn, data) for sn, data in valid.items() if sn not in assets)
+        with metrics.phase('BatchReport', 'zone'):
+            self._add_to_new_assets_zone(new_reports)
+
+        changed = []
+        for sn, asset in assets.items():
+            if touch_if_unchanged(asset, valid[sn]):
+                self.results.append({'sn': sn, 'status': 'unchanged', 'message': 'Asset info is unchanged!'})
+            else:
+                changed.append(asset)
+        changed_ids = set(asset.id for asset in changed)
+        record_profiles(dict((asset.id, valid[asset.sn]) for asset in changed))
+        record_profiles(dict((asset.id, valid[sn]) for sn, asset in assets.items() if asset.id not in changed_ids),
+                        unchanged=True)
+        # the components of all changed assets are loaded with three queries per chunk
+        with metrics.phase('BatchReport', 'prefetch'):
+            for chunk in chunks(changed):
+                prefetch_related_objects(chunk, *COMPONENT_SETS)
+        for asset in changed:
+            self._update_asset(asset, valid[asset.sn])
+        return self.results
+
+    def _add_to_new_assets_zone(self, new_reports):
+        """
+        Write approval zone rows of all unknown assets with bulk statements.
+        Fall back to row by row writes if the bulk statements fail, to find out the bad reports.
+        :param new_reports: {sn: data}
+        :return:
+        """
+        if not new_reports:
+            return
+        try:
+            with transaction.atomic():
+                self._bulk_write_zone(new_reports)
+        except Exception as e:
+            print(e)
+            for sn, data in new_reports.items():
+                try:
+                    with transaction.atomic():
+                        NewAsset(self.request, data).add_to_new_assets_zone()
+                except Exception as e:
+                    self.results.append({'sn': sn, 'status': 'failed', 'message': str(e)})
+                else:
+                    self._zone_result(sn)
+        else:
+            for sn in new_reports:
+                self._zone_result(sn)
+
+    def _bulk_write_zone(self, new_reports):
+        existing = dict()
+        for chunk in chunks(new_reports):
+            existing.update((zone.sn, zone) for zone in models.NewAssetApprovalZone.objects.filter(sn__in=chunk))
+
+        now = timezone.now()
+        to_create = []
+        to_update = []
+        for sn, data in new_reports.items():
+            defaults = NewAsset(self.request, data).zone_defaults()
+            zone = existing.get(sn)
+            if zone is None:
+                to_create.append(models.NewAssetApprovalZone(sn=sn, **defaults))
+            else:
+                for key, value in defaults.items():
+                    setattr(zone, key, value)
+                # bulk_update does not touch auto_now fields
+                zone.m_time = now
+                to_update.append(zone)
+
+        models.NewAssetApprovalZone.objects.bulk_create(to_create, batch_size=BATCH_SIZE)
+        models.NewAssetApprovalZone.objects.bulk_update(to_update, self.zone_fields, batch_size=BATCH_SIZE)
+
+    def _zone_result(self, sn):
+        self.results.append({'sn': sn, 'status': 'new',
+                             'message': 'Asset has been added or updated to new asset approval zone.'})
+
+    def _update_asset(self, asset, data):
+        try:
+            with transaction.atomic():
+                ok = UpdateAsset(self.request, asset, data).result
+        except Exception as e:
+            self.results.append({'sn': asset.sn, 'status': 'failed', 'message': str(e)})
+        else:
+            if ok:
+                self.results.append({'sn': asset.sn, 'status': 'updated', 'message': 'Asset info has been updated!'})
+            else:
+                self.results.append({'sn': asset.sn, 'status': 'failed', 'message': 'Asset info update failed!'})
+
+
+class BulkApprovedAsset:
+    """
+    Approve and upline many new assets at once, i.e. a newly racked batch of servers.
+    The selected approval zone rows are loaded with one query per chunk, Asset, Server, CPU, RAM, Disk and NIC
+    rows are built in memory and every table is written with one bulk_create.
+    Bad reports are reported per asset; if the bulk insert of a chunk fails anyway,
+    the chunk is approved one by one with ApprovedAsset.
+    """
+
+    def __init__(self, request, asset_ids):
+        self.request = request
+        self.asset_ids = asset_ids
+        self.uplined = []
+        self.failed = dict()  # {sn: reason}
+
+    def asset_upline(self):
+        """
+        :return: number of uplined assets
+        """
+        for chunk in chunks(self.asset_ids):
+            with metrics.phase('BulkApprovedAsset', 'build'):
+                new_assets = list(models.NewAssetApprovalZone.objects.filter(id__in=chunk))
+                built = self._build(new_assets)
+            if not built:
+                continue
+            try:
+                with transaction.atomic(), metrics.phase('BulkApprovedAsset', 'insert'):
+                    self._bulk_create(built)
+            except Exception as e:
+                print(e)
+                self._upline_one_by_one([new_asset for new_asset, _, _ in built])
+            else:
+                for new_asset, asset, _ in built:
+                    self.uplined.append(asset)
+                    NewAsset.log("upline", asset=asset, request=self.request)
+        return len(self.uplined)
+
+    def _build(self, new_assets):
+        """
+        Build the rows of every new asset in memory
+        :return: [(new_asset, asset, {model: [component rows]})]
+        """
+        sns = [new_asset.sn for new_asset in new_assets]
+        names = ["%s: %s" % (new_asset.asset_type, new_asset.sn) for new_asset in new_assets]
+        existing = set()
+        # two queries, OR-ing both lists would bind 2 * BATCH_SIZE variables, over the SQLite limit of 999
+        for lookup, values in (('sn__in', sns), ('name__in', names)):
+            for sn, name in models.Asset.objects.filter(**{lookup: values}).values_list('sn', 'name'):
+                existing.update((sn, name))
+
+        built = []
+        for new_asset in new_assets:
+            asset = models.Asset(asset_type=new_asset.asset_type,
+                                 name="%s: %s" % (new_asset.asset_type, new_asset.sn),
+                                 sn=new_asset.sn,
+                                 approved_by=self.request.user)
+            try:
+                if new_asset.asset_type != 'server':
+                    raise ValueError('Asset type %s can not be approved in bulk' % new_asset.asset_type)
+                if asset.sn in existing or asset.name in existing:
+                    raise ValueError('Asset %s already exists' % asset.sn)
+                if new_asset.manufacturer:
+                    asset.manufacturer = lookup_cache.MANUFACTURERS.get(new_asset.manufacturer)
+                components = self._build_components(new_asset, asset)
+            except Exception as e:
+                self._fail(new_asset, e)
+            else:
+                built.append((new_asset, asset, components))
+        return built
+
+    def _build_components(self, new_asset, asset):
+        data = new_asset.data
+        components = dict()
+        components[models.Server] = [models.Server(asset=asset,
+                                                   model=new_asset.model,
+                                                   os_type=new_asset.os_type,
+                                                   os_distribution=new_asset.os_distribution,
+                                                   os_release=new_asset.os_release)]
+        cpu = models.CPU(asset=asset, cpu_model=new_asset.cpu_model)
+        if new_asset.cpu_count is not None:
+            cpu.cpu_count = new_asset.cpu_count
+        if new_asset.cpu_core_count is not None:
+            cpu.cpu_core_count = new_asset.cpu_core_count
+        components[models.CPU] = [cpu]
+
+        for component_diff, section, required in ((RAM_DIFF, 'ram', ('slot',)),
+                                                  (DISK_DIFF, 'physical_disk_driver', ('sn',)),
+                                                  (NIC_DIFF, 'nic', ('mac', 'model'))):
+            rows = dict()
+            for item in data.get(section) or []:
+                for name in required:
+                    if not item.get(name):
+                        raise ValueError('%s without %s' % (section, name))
+                key, values = component_diff.normalize(item)
+                rows[key] = component_diff.build(asset, key, values)
+            components[component_diff.model] = list(rows.values())
+        return components
+
+    def _bulk_create(self, built):
+        models.Asset.objects.bulk_create([asset for _, asset, _ in built], batch_size=BATCH_SIZE)
+        # bulk_create does not return the primary keys on every backend
+        ids = dict(models.Asset.objects.filter(sn__in=[asset.sn for _, asset, _ in built]).values_list('sn', 'id'))
+        rows = dict()
+        for _, asset, components in built:
+            asset.id = ids[asset.sn]
+            for model, objs in components.items():
+                for obj in objs:
+                    # the asset had no primary key when the component was built
+                    obj.asset = asset
+                rows.setdefault(model, []).extend(objs)
+        for model, objs in rows.items():
+            model.objects.bulk_create(objs, batch_size=BATCH_SIZE)
+        models.NewAssetApprovalZone.objects.filter(id__in=[new_asset.id for new_asset, _, _ in built]).delete()
+
+    def _upline_one_by_one(self, new_assets):
+        for new_asset in new_assets:
+            obj = ApprovedAsset(self.request, new_asset.id)
+            if obj.asset_upline():
+                self.uplined.append(models.Asset.objects.get(sn=new_asset.sn))
+            else:
+                self.failed[new_asset.sn] = 'Approved Failed'
+
+    def _fail(self, new_asset, e):
+        self.failed[new_asset.sn] = str(e)
+        NewAsset.log('approved_failed', msg=e, new_asset=new_asset, request=self.request)
@@ -0,0 +1,215 @@
+"""
+Fleet-scale ingestion benchmark of the report endpoint.
+
+Synthetic hosts are generated from the sample payloads of Client/bin/report_assets.py, with a configurable
+number of DIMMs, disks and NICs. Three scenarios are measured separately:
+    new        first report of every host, ends up in the approval zone
+    unchanged  the online host reports the same hardware again
+    changed    the online host reports with a fraction (churn) of its components changed
+Run it with `python manage.py benchmark_report`.
+"""
+import copy
+import json
+import math
+import random
+import time
+import urllib.request
+import urllib.parse
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from assets import event_writer
+
+# Client/bin/report_assets.py linux_data
+LINUX_SAMPLE = {
+    "asset_type": "server",
+    "manufacturer": "innotek GmbH",
+    "sn": "00002",
+    "model": "VirtualBox",
+    "uuid": "E8DE611C-4279-495C-9B58-502B6FCED076",
+    "wake_up_type": "Power Switch",
+    "os_distribution": "Ubuntu",
+    "os_release": "Ubuntu 16.04.3 LTS",
+    "os_type": "Linux",
+    "cpu_count": "2",
+    "cpu_core_count": "4",
+    "cpu_model": "Intel(R) Core(TM) i5-2300 CPU @ 2.80GHz",
+    "ram": [{"slot": "A1", "capacity": 8}],
+    "ram_size": 3.858997344970703,
+    "nic": [],
+    "physical_disk_driver": [{"model": "VBOX HARDDISK", "size": "50", "sn": "VBeee1ba73-09085302"}],
+}
+
+# Client/bin/report_assets.py windows_data
+WINDOWS_SAMPLE = {
+    "os_type": "Windows",
+    "os_release": "7 64bit  6.1.7601 ",
+    "os_distribution": "Microsoft",
+    "asset_type": "server",
+    "cpu_count": 2,
+    "cpu_model": "Intel(R) Core(TM) i5-2300 CPU @ 2.80GHz",
+    "cpu_core_count": 8,
+    "ram": [{"slot": "A1", "capacity": 8, "model": "Physical Memory", "manufacturer": "kingstone ", "sn": "456"}],
+    "manufacturer": "Intel",
+    "model": "P67X-UD3R-B3",
+    "wake_up_type": 6,
+    "sn": "00426-OEM-8992662-22222",
+    "physical_disk_driver": [{"iface_type": "unknown", "slot": 0, "sn": "3830414130423230343234362020202020202020",
+                              "model": "KINGSTON SV100S264G ATA Device", "manufacturer": "(标准磁盘驱动器)",
+                              "capacity": 128}],
+    "nic": [{"mac": "14:CF:22:FF:48:34", "name": 11, "ip_address": "192.168.1.110",
+             "model": "[00000011] Realtek RTL8192CU Wireless LAN 802.11n USB 2.0 Network Adapter",
+             "net_mask": ["255.255.255.0", "64"]}],
+}
+
+SAMPLES = (LINUX_SAMPLE, WINDOWS_SAMPLE)
+
+
+def make_host(index, rams, disks, nics, rnd):
+    """
+    One synthetic host built from a sample payload
+    """
+    data = copy.deepcopy(SAMPLES[index % len(SAMPLES)])
+    data['sn'] = 'BENCH-%06d' % index
+    ram = data['ram'][0]
+    data['ram'] = [dict(ram, slot='DIMM%02d' % i, sn='RAM-%06d-%02d' % (index, i)) for i in range(rams)]
+    disk = data['physical_disk_driver'][0]
+    data['physical_disk_driver'] = [dict(disk, slot=i, sn='DISK-%06d-%02d' % (index, i),
+                                         capacity=rnd.choice([480, 960, 1920, 3840])) for i in range(disks)]
+    nic = {"model": "Intel Corporation Ethernet Controller X710", "net_mask": ["255.255.0.0"]}
+    data['nic'] = [dict(nic, name='eth%s' % i, mac='02:%02x:%02x:%02x:%02x:%02x' % (
+        (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff, i >> 8, i & 0xff),
+                        ip_address='10.%s.%s.%s' % (index // 65536 % 256, index // 256 % 256, index % 256))
+                   for i in range(nics)]
+    return data
+
+
+def churn(data, rate, rnd):
+    """
+    Change a fraction of the components of a host, at least one
+    """
+    components = [('ram', 'capacity'), ('physical_disk_driver', 'capacity'), ('nic', 'ip_address')]
+    items = [(section, field, item) for section, field in components for item in data[section]]
+    for section, field, item in rnd.sample(items, max(1, int(math.ceil(len(items) * rate)))):
+        if field == 'ip_address':
+            item[field] = '172.16.%s.%s' % (rnd.randint(0, 255), rnd.randint(1, 254))
+        else:
+            item[field] = (item.get(field) or 0) + rnd.choice([8, 16, 32])
+    return data
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def summarize(latencies, queries, elapsed):
+    return {
+        'reports': len(latencies),
+        'reports_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0,
+        'queries_per_report': sum(queries) / len(queries) if queries else None,
+    }
+
+
+class Benchmark:
+
+    def __init__(self, hosts=200, rams=8, disks=4, nics=4, churn=0.1, seed=0, url=None):
+        """
+        :param url: report url of a live server, by default the view is driven through the Django test client
+        """
+        self.hosts = hosts
+        self.rams = rams
+        self.disks = disks
+        self.nics = nics
+        self.churn = churn
+        self.url = url
+        self.rnd = random.Random(seed)
+        self.client = Client()
+        self.fleet = [make_host(i, rams, disks, nics, self.rnd) for i in range(hosts)]
+        self.results = dict()
+
+    def post(self, data):
+        if self.url:
+            body = urllib.parse.urlencode({"asset_data": json.dumps(data)}).encode()
+            urllib.request.urlopen(self.url, data=body, timeout=30).read()
+        else:
+            response = self.client.post('/assets/report/', {'asset_data': json.dumps(data)})
+            if response.status_code >= 400:
+                raise RuntimeError('%s: HTTP %s' % (data['sn'], response.status_code))
+
+    def run_scenario(self, reports):
+        latencies = []
+        queries = []
+        start = time.perf_counter()
+        for data in reports:
+            if self.url:
+                t = time.perf_counter()
+                self.post(data)
+                latencies.append(time.perf_counter() - t)
+            else:
+                with CaptureQueriesContext(connection) as captured:
+                    t = time.perf_counter()
+                    self.post(data)
+                    latencies.append(time.perf_counter() - t)
+                queries.append(len(captured.captured_queries))
+        if self.url is None:
+            # buffered events are part of the cost of the scenario
+            event_writer.writer.flush()
+        return summarize(latencies, queries, time.perf_counter() - start)
+
+    def approve_all(self):
+        """
+        Upline the whole fleet, so that the next reports update online assets
+        """
+        from django.contrib.auth.models import User
+        from assets import asset_handler
+        from assets import models
+
+        class Request:
+            user = User.objects.get_or_create(username='benchmark')[0]
+
+        ids = list(models.NewAssetApprovalZone.objects.filter(sn__startswith='BENCH-').values_list('id', flat=True))
+        asset_handler.BulkApprovedAsset(Request(), ids).asset_upline()
+
+    def run(self, scenarios=('new', 'unchanged', 'changed')):
+        """
+        The update scenarios need the fleet online. With the test client it is approved here; a live server
+        has to be benchmarked in two runs: 'new', then approve the BENCH- assets, then the update scenarios.
+        Finished scenarios are kept in self.results when a later one fails.
+        """
+        updates = [name for name in ('unchanged', 'changed') if name in scenarios]
+        if self.url and 'new' in scenarios and updates:
+            raise ValueError('against a live server run the new scenario alone, approve the BENCH- assets, '
+                             'then run %s' % ' and '.join(updates))
+        self.results = results = dict()
+        if 'new' in scenarios:
+            results['new'] = self.run_scenario(self.fleet)
+        elif self.url is None:
+            for data in self.fleet:
+                self.post(data)
+        if updates:
+            if self.url is None:
+                self.approve_all()
+            # the first report of an online asset always writes, it stores the fingerprint
+            for data in self.fleet:
+                self.post(data)
+        if 'unchanged' in scenarios:
+            results['unchanged'] = self.run_scenario(self.fleet)
+        if 'changed' in scenarios:
+            changed = [churn(copy.deepcopy(data), self.churn, self.rnd) for data in self.fleet]
+            results['changed'] = self.run_scenario(changed)
+        return {
+            'config': {
+                'hosts': self.hosts, 'rams': self.rams, 'disks': self.disks, 'nics': self.nics,
+                'churn': self.churn, 'url': self.url or 'django test client',
+            },
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'scenarios': results,
+        }
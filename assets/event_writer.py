@@ -0,0 +1,124 @@
+"""
+Buffered EventLog writer.
+
+Events are collected in memory and written with one bulk_create when the buffer is full or the oldest
+event has waited `interval` seconds. The buffer is flushed at exit; critical events are saved at once.
+Events which can not be written because the database is unavailable stay buffered for the next flush.
+"""
+import atexit
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+
+from assets import models
+
+# events which must not be lost if the process dies
+CRITICAL_EVENTS = ('approved_failed', 'update_failed')
+
+
+class EventWriter:
+
+    def __init__(self, size=200, interval=5.0, max_pending=10000):
+        """
+        :param size: flush when this many events are buffered, 0 writes every event at once
+        :param interval: flush at the latest this many seconds after the first buffered event
+        :param max_pending: events kept while the database can not be written, the oldest are dropped beyond
+        """
+        self.size = size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._events = []
+        self._lock = threading.Lock()
+        self._timer = None
+        atexit.register(self.flush)
+
+    def add(self, event, critical=False):
+        """
+        :param event: unsaved EventLog
+        :param critical: save synchronously
+        """
+        if critical or self.size <= 0:
+            event.save()
+            return
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= self.size
+            if not full:
+                self._schedule()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered events
+        :return: number of written events
+        """
+        with self._lock:
+            events, self._events = self._events, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not events:
+            return 0
+        try:
+            # a savepoint, a failed insert must not break the transaction of the caller
+            with transaction.atomic():
+                models.EventLog.objects.bulk_create(events, batch_size=500)
+            return len(events)
+        except IntegrityError:
+            pass
+        except DatabaseError as e:
+            # i.e. the database is locked or gone, the events are written by the next flush
+            print('event log flush failed, %s events kept: %s' % (len(events), e))
+            self._requeue(events)
+            return 0
+
+        # i.e. the asset of an event has been deleted meanwhile, keep the others
+        failed = []
+        for event in events:
+            try:
+                with transaction.atomic():
+                    event.save()
+            except IntegrityError as e:
+                print(e)
+            except DatabaseError as e:
+                print(e)
+                failed.append(event)
+        if failed:
+            self._requeue(failed)
+        return len(events) - len(failed)
+
+    def _requeue(self, events):
+        with self._lock:
+            self._events[:0] = events
+            # a database which stays down must not eat the memory, the oldest events go first
+            overflow = len(self._events) - self.max_pending
+            if overflow > 0:
+                print('event log buffer full, %s events dropped' % overflow)
+                del self._events[:overflow]
+            self._schedule()
+
+    def _schedule(self):
+        """
+        Start the flush timer, call with the lock held
+        """
+        if self._timer is None and self._events:
+            self._timer = threading.Timer(self.interval, self._flush_in_thread)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            # the timer thread has its own database connection
+            connection.close()
+
+
+_conf = getattr(settings, 'ASSET_EVENT_LOG_BUFFER', {})
+
+writer = EventWriter(**_conf)
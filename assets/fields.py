@@ -0,0 +1,70 @@
+import json
+import zlib
+
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+
+class CompressedJSONDescriptor(DeferredAttribute):
+    """
+    Keeps the compressed bytes read from the database and only decodes them on first access
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, (bytes, memoryview)):
+            value = CompressedJSONField.decode(value)
+            instance.__dict__[self.field_name] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field_name] = value
+
+
+class CompressedJSONField(models.BinaryField):
+    """
+    JSON value stored zlib compressed in a binary column, i.e. the raw reports of the new asset approval zone.
+    Rows loaded from the database keep the compressed bytes until the attribute is read,
+    so list pages and scans which do not look at the value never pay for decompressing it.
+    """
+
+    def __init__(self, *args, level=6, **kwargs):
+        self.level = level
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.level != 6:
+            kwargs['level'] = self.level
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, CompressedJSONDescriptor(self.attname))
+
+    @staticmethod
+    def decode(value):
+        return json.loads(zlib.decompress(bytes(value)).decode())
+
+    def encode(self, value):
+        return zlib.compress(json.dumps(value).encode(), self.level)
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, (bytes, memoryview)):
+            # never decoded, store the compressed bytes as they are
+            return bytes(value)
+        return self.encode(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return self.decode(value)
+        if isinstance(value, str):
+            return json.loads(value)
+        return value
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj))
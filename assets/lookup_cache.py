@@ -0,0 +1,116 @@
+"""
+Process wide name -> id cache of the small reference tables (Manufacturer, IDC, BusinessUnit, Tag).
+
+There are only a few dozen vendors, so after warming up the report path does not query these tables at all.
+Entries expire after a TTL, which bounds how long an edit made in another process stays unnoticed;
+edits in this process clear the cache at once through the signals connected in AssetsConfig.ready().
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+
+from assets import models
+
+
+class LookupCache:
+    """
+    Bounded LRU cache of name -> primary key with TTL based eviction
+    """
+
+    def __init__(self, model, field='name', maxsize=1024, ttl=300):
+        self.model = model
+        self.field = field
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_id(self, name, create=True):
+        """
+        :param name: value of the lookup field
+        :param create: create the row if it does not exist yet
+        :return: primary key, None if the row does not exist and create is False
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(name)
+            if entry is not None:
+                if entry[1] > now:
+                    self._data.move_to_end(name)
+                    return entry[0]
+                del self._data[name]
+
+        pk, created = self._load(name, create)
+        if pk is not None:
+            if created:
+                # a row created inside a transaction which rolls back must not end up in the cache
+                transaction.on_commit(lambda: self._store(name, pk))
+            else:
+                self._store(name, pk)
+        return pk
+
+    def get(self, name, create=True):
+        """
+        :return: an instance carrying only the primary key and the name, good enough to assign a foreign key
+        """
+        pk = self.get_id(name, create)
+        if pk is None:
+            return None
+        return self.model(**{'pk': pk, self.field: name})
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._data.clear()
+            else:
+                self._data.pop(name, None)
+
+    def _load(self, name, create):
+        queryset = self.model.objects.values_list('pk', flat=True)
+        pk = queryset.filter(**{self.field: name}).first()
+        if pk is not None or not create:
+            return pk, False
+        try:
+            with transaction.atomic():
+                return self.model.objects.create(**{self.field: name}).pk, True
+        except IntegrityError:
+            # created by another thread or process in the meantime
+            return queryset.get(**{self.field: name}), False
+
+    def _store(self, name, pk):
+        with self._lock:
+            self._data[name] = (pk, time.monotonic() + self.ttl)
+            self._data.move_to_end(name)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_conf = getattr(settings, 'ASSET_LOOKUP_CACHE', {})
+
+MANUFACTURERS = LookupCache(models.Manufacturer, **_conf)
+IDCS = LookupCache(models.IDC, **_conf)
+BUSINESS_UNITS = LookupCache(models.BusinessUnit, **_conf)
+TAGS = LookupCache(models.Tag, **_conf)
+
+CACHES = {
+    models.Manufacturer: MANUFACTURERS,
+    models.IDC: IDCS,
+    models.BusinessUnit: BUSINESS_UNITS,
+    models.Tag: TAGS,
+}
+
+
+def invalidate(sender, **kwargs):
+    """
+    post_save / post_delete receiver, the old name of a renamed row is unknown so the whole cache is dropped.
+    A new row does not change any cached mapping.
+    """
+    if kwargs.get('created'):
+        return
+    cache = CACHES.get(sender)
+    if cache is not None:
+        cache.invalidate()
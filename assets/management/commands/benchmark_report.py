@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.test.runner import DiscoverRunner
+
+from assets import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the report endpoint with a synthetic fleet, results are written as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hosts', type=int, default=200)
+        parser.add_argument('--rams', type=int, default=8, help='DIMMs per host')
+        parser.add_argument('--disks', type=int, default=4, help='disks per host')
+        parser.add_argument('--nics', type=int, default=4, help='NICs per host')
+        parser.add_argument('--churn', type=float, default=0.1,
+                            help='fraction of the components changed per host in the changed scenario')
+        parser.add_argument('--scenario', action='append', choices=['new', 'unchanged', 'changed'],
+                            help='scenario to run, can be repeated, all by default (only new with --url)')
+        parser.add_argument('--url', help='report url of a live server instead of the Django test client')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        scenarios = options['scenario'] or (['new'] if options['url'] else ['new', 'unchanged', 'changed'])
+        bench = benchmark.Benchmark(hosts=options['hosts'], rams=options['rams'], disks=options['disks'],
+                                    nics=options['nics'], churn=options['churn'], seed=options['seed'],
+                                    url=options['url'])
+        try:
+            if options['url']:
+                results = bench.run(scenarios)
+            else:
+                # a throw away test database, the configured one is never touched
+                setup_test_environment()
+                runner = DiscoverRunner(verbosity=0)
+                old_config = runner.setup_databases()
+                try:
+                    results = bench.run(scenarios)
+                finally:
+                    runner.teardown_databases(old_config)
+                    teardown_test_environment()
+        except Exception as e:
+            # the scenarios which finished are still worth seeing
+            self.print_results(bench.results)
+            raise CommandError(e)
+
+        self.print_results(results['scenarios'])
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write('results written to %s' % options['output'])
+
+    def print_results(self, scenarios):
+        for name, summary in scenarios.items():
+            self.stdout.write('%-10s %6s reports %8.1f/s  p50 %7.2fms  p99 %7.2fms  queries/report %s' % (
+                name, summary['reports'], summary['reports_per_sec'], summary['p50_ms'], summary['p99_ms'],
+                summary['queries_per_report']))
@@ -0,0 +1,90 @@
+import multiprocessing
+import signal
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+from django.db import connections
+
+from assets import asset_handler
+from assets import event_writer
+from assets import report_spool
+
+
+def work(name, idle, stop):
+    """
+    Worker process: claim the next SN, apply its newest report, repeat until stop is set
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    spool = report_spool.get_spool()
+    while not stop.is_set():
+        claimed = spool.claim(name)
+        if claimed is None:
+            stop.wait(idle)
+            continue
+        sn, last_id, data, coalesced = claimed
+        try:
+            status, message = asset_handler.apply_report(None, data, reraise=True)
+        except DatabaseError as e:
+            # keep the reports, another try once the database is back
+            print('%s: %s, %s' % (name, sn, e))
+            spool.release(sn, last_id)
+            connections.close_all()
+            stop.wait(idle)
+            continue
+        except Exception as e:
+            status, message = 'failed', str(e)
+        spool.done(sn, last_id)
+        if coalesced:
+            message = '%s (%s older report(s) skipped)' % (message, coalesced)
+        print('%s: %s %s, %s' % (name, sn, status, message))
+    # atexit handlers do not run in multiprocessing children
+    event_writer.writer.flush()
+
+
+class Command(BaseCommand):
+    help = 'Apply the reports queued in the report spool with a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+        parser.add_argument('--idle', type=float, default=1.0, help='seconds to wait when the spool is empty')
+        parser.add_argument('--stats', action='store_true', help='print queue depth and lag, then exit')
+
+    def handle(self, *args, **options):
+        spool = report_spool.get_spool()
+        if options['stats']:
+            for key, value in spool.stats().items():
+                self.stdout.write('%s %s' % (key, value))
+            return
+
+        # every worker opens its own database connections
+        connections.close_all()
+        stop = multiprocessing.Event()
+        workers = []
+        for i in range(options['workers']):
+            name = '%s-%s' % (socket.gethostname(), i)
+            process = multiprocessing.Process(target=work, args=(name, options['idle'], stop), name=name)
+            process.start()
+            workers.append(process)
+
+        stopping = []
+
+        def shutdown(signum, frame):
+            # Event.set() would dead lock when the handler interrupts Event.wait(), only record the signal here
+            stopping.append(signum)
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        self.stdout.write('%s workers draining %s' % (len(workers), spool.path))
+        last = 0
+        while not stopping:
+            if time.time() - last >= 10:
+                stats = spool.stats()
+                self.stdout.write('depth %(depth)s assets %(assets)s lag %(lag).1fs' % stats)
+                last = time.time()
+            time.sleep(0.5)
+        stop.set()
+        for process in workers:
+            process.join()
+        self.stdout.write('workers stopped')
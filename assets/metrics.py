@@ -0,0 +1,157 @@
+"""
+In-process instrumentation of the report path.
+
+Every phase of NewAsset / ApprovedAsset / UpdateAsset is timed with metrics.phase(): wall time, number of
+queries and SQL time go into histograms of this process, which assets/metrics/ exposes as plain text.
+With ASSET_REPORT_METRICS['timing_header'] the report views also add a Server-Timing header with the
+breakdown of the request.
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket{%s,le="%s"} %s' % (name, labels, bound, cumulative)
+        yield '%s_bucket{%s,le="+Inf"} %s' % (name, labels, self.count)
+        yield '%s_sum{%s} %s' % (name, labels, self.sum)
+        yield '%s_count{%s} %s' % (name, labels, self.count)
+
+
+# metric name -> {(handler, phase): Histogram}
+_histograms = OrderedDict((
+    ('report_phase_seconds', OrderedDict()),
+    ('report_phase_sql_seconds', OrderedDict()),
+    ('report_phase_queries', OrderedDict()),
+))
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _conf():
+    return getattr(settings, 'ASSET_REPORT_METRICS', {})
+
+
+def enabled():
+    return _conf().get('enabled', True)
+
+
+def observe(handler, name, wall, queries, sql):
+    key = (handler, name)
+    with _lock:
+        for metric, value, buckets in (('report_phase_seconds', wall, SECONDS_BUCKETS),
+                                       ('report_phase_sql_seconds', sql, SECONDS_BUCKETS),
+                                       ('report_phase_queries', queries, QUERIES_BUCKETS)):
+            histogram = _histograms[metric].get(key)
+            if histogram is None:
+                histogram = _histograms[metric][key] = Histogram(buckets)
+            histogram.observe(value)
+    breakdown = getattr(_local, 'breakdown', None)
+    if breakdown is not None:
+        total = breakdown.setdefault('%s.%s' % key, [0.0, 0, 0.0])
+        total[0] += wall
+        total[1] += queries
+        total[2] += sql
+
+
+@contextmanager
+def phase(handler, name):
+    """
+    Time one phase of a report handler
+    :param handler: i.e. 'UpdateAsset'
+    :param name: i.e. 'ram'
+    """
+    if not enabled():
+        yield
+        return
+
+    stats = [0, 0.0]
+
+    def count_queries(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats[0] += 1
+            stats[1] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(count_queries):
+            yield
+    finally:
+        observe(handler, name, time.perf_counter() - start, stats[0], stats[1])
+
+
+def instrument_view(name):
+    """
+    Decorator of the report views: times the whole request as phase 'view.<name>'
+    and adds the Server-Timing header if it is enabled
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            if not enabled():
+                return func(request, *args, **kwargs)
+            _local.breakdown = OrderedDict()
+            try:
+                with phase('view', name):
+                    response = func(request, *args, **kwargs)
+                breakdown = _local.breakdown
+            finally:
+                _local.breakdown = None
+            if _conf().get('timing_header', False):
+                response['Server-Timing'] = server_timing(breakdown)
+            return response
+
+        return inner
+
+    return decorator
+
+
+def server_timing(breakdown):
+    items = []
+    for key, (wall, queries, sql) in breakdown.items():
+        items.append('%s;dur=%.3f;desc="%s queries, %.3fms sql"' % (key, wall * 1000, queries, sql * 1000))
+    return ', '.join(items)
+
+
+def render():
+    """
+    :return: all histograms of this process in the Prometheus text format
+    """
+    lines = []
+    with _lock:
+        for metric, histograms in _histograms.items():
+            lines.append('# TYPE %s histogram' % metric)
+            for (handler, name), histogram in histograms.items():
+                lines.extend(histogram.lines(metric, 'handler="%s",phase="%s"' % (handler, name)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.6 on 2026-10-18 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='last_seen',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Last Reported'),
+        ),
+        migrations.AddField(
+            model_name='asset',
+            name='report_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Report Fingerprint'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+import json
+
+import assets.fields
+from django.db import migrations, models
+
+
+def compress_data(apps, schema_editor):
+    NewAssetApprovalZone = apps.get_model('assets', 'NewAssetApprovalZone')
+    for pk, data in NewAssetApprovalZone.objects.values_list('id', 'data').iterator():
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            payload = data
+        NewAssetApprovalZone.objects.filter(id=pk).update(payload=payload)
+
+
+def decompress_data(apps, schema_editor):
+    NewAssetApprovalZone = apps.get_model('assets', 'NewAssetApprovalZone')
+    for zone in NewAssetApprovalZone.objects.only('id', 'payload').iterator():
+        NewAssetApprovalZone.objects.filter(id=zone.id).update(data=json.dumps(zone.payload))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0002_asset_report_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newassetapprovalzone',
+            name='payload',
+            field=assets.fields.CompressedJSONField(null=True, verbose_name='Asset Data'),
+        ),
+        # nullable while both columns exist, so that the migration can be reversed
+        migrations.AlterField(
+            model_name='newassetapprovalzone',
+            name='data',
+            field=models.TextField(null=True, verbose_name='Asset Data'),
+        ),
+        migrations.RunPython(compress_data, decompress_data),
+        migrations.RemoveField(
+            model_name='newassetapprovalzone',
+            name='data',
+        ),
+        migrations.RenameField(
+            model_name='newassetapprovalzone',
+            old_name='payload',
+            new_name='data',
+        ),
+        migrations.AlterField(
+            model_name='newassetapprovalzone',
+            name='data',
+            field=assets.fields.CompressedJSONField(verbose_name='Asset Data'),
+        ),
+    ]
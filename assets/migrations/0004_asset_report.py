@@ -0,0 +1,26 @@
+# Generated by Django 2.2.6 on 2026-10-18 15:40
+
+import assets.fields
+from django.db import migrations
+
+
+def forget_report_hash(apps, schema_editor):
+    # assets applied before have a fingerprint but no stored report, their next full report is applied again
+    Asset = apps.get_model('assets', 'Asset')
+    Asset.objects.filter(report_hash__isnull=False).update(report_hash=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0003_newassetapprovalzone_compressed_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='report',
+            field=assets.fields.CompressedJSONField(editable=False, null=True, verbose_name='Last Report'),
+        ),
+        migrations.RunPython(forget_report_hash, migrations.RunPython.noop),
+    ]
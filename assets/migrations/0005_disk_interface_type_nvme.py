@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-18 15:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0004_asset_report'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='disk',
+            name='interface_type',
+            field=models.CharField(choices=[('SATA', 'SATA'), ('SAS', 'SAS'), ('SCSI', 'SCSI'), ('SSD', 'SSD'), ('NVMe', 'NVMe'), ('unknown', 'unknown')], default='unknown', max_length=16, verbose_name='Interface Type'),
+        ),
+    ]
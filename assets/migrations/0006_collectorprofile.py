@@ -0,0 +1,33 @@
+# Generated by Django 2.2.6 on 2026-10-18 15:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0005_disk_interface_type_nvme'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectorProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collector', models.CharField(max_length=64, verbose_name='Collector')),
+                ('wall_ms', models.FloatField(default=0, verbose_name='Wall Time (ms)')),
+                ('cpu_ms', models.FloatField(blank=True, null=True, verbose_name='CPU Time (ms)')),
+                ('commands', models.PositiveIntegerField(default=0, verbose_name='Commands')),
+                ('command_ms', models.FloatField(default=0, verbose_name='Command Wall Time (ms)')),
+                ('cached', models.BooleanField(default=False, verbose_name='Cached')),
+                ('m_time', models.DateTimeField(auto_now=True, verbose_name='Reported')),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='assets.Asset')),
+            ],
+            options={
+                'verbose_name': 'Collector Profile',
+                'verbose_name_plural': 'Collector Profile',
+                'unique_together': {('asset', 'collector')},
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from assets.fields import CompressedJSONField
 
 
 # Create your models here.
@@ -40,6 +41,12 @@ class Asset(models.Model):
     memo = models.TextField(null=True, blank=True, verbose_name='Memo')
     c_time = models.DateTimeField(auto_now_add=True, verbose_name='Approved Date')
     m_time = models.DateTimeField(auto_now=True, verbose_name='Updated Date')
+    # Fingerprint of the last applied report, an identical report only touches last_seen
+    report_hash = models.CharField(max_length=64, null=True, blank=True, editable=False,
+                                   verbose_name='Report Fingerprint')
+    last_seen = models.DateTimeField(null=True, blank=True, verbose_name='Last Reported')
+    # The last applied report itself, the base a delta report is applied to; set together with report_hash
+    report = CompressedJSONField('Last Report', null=True, editable=False)
 
     # Foreign Key Params: (1) => Another Model Name; First Argument without quote: it's a reference to a model either
     # defined within the file or imported via import; First Argument with quote:  Finding the model among all the
@@ -355,8 +362,10 @@ class Disk(models.Model):
 
     disk_interface_type_choice = (
         ('SATA', 'SATA'),
+        ('SAS', 'SAS'),
         ('SCSI', 'SCSI'),
         ('SSD', 'SSD'),
+        ('NVMe', 'NVMe'),
         ('unknown', 'unknown'),
     )
 
@@ -443,6 +452,33 @@ class EventLog(models.Model):
         verbose_name_plural = "Event Log"
 
 
+class CollectorProfile(models.Model):
+    """
+    Cost of one client collector on one asset, from the last report sent with --profile.
+    The row named TOTAL holds the whole collection of the asset.
+    """
+
+    TOTAL = '(total)'
+
+    asset = models.ForeignKey('Asset', on_delete=models.CASCADE)
+
+    collector = models.CharField('Collector', max_length=64)
+    wall_ms = models.FloatField('Wall Time (ms)', default=0)
+    cpu_ms = models.FloatField('CPU Time (ms)', blank=True, null=True)
+    commands = models.PositiveIntegerField('Commands', default=0)
+    command_ms = models.FloatField('Command Wall Time (ms)', default=0)
+    cached = models.BooleanField('Cached', default=False)
+    m_time = models.DateTimeField('Reported', auto_now=True)
+
+    def __str__(self):
+        return '%s:  %s:  %sms' % (self.asset_id, self.collector, self.wall_ms)
+
+    class Meta:
+        verbose_name = 'Collector Profile'
+        verbose_name_plural = "Collector Profile"
+        unique_together = ('asset', 'collector')
+
+
 class NewAssetApprovalZone(models.Model):
     """New Asset Approval Zone"""
 
@@ -467,7 +503,7 @@ class NewAssetApprovalZone(models.Model):
     os_distribution = models.CharField('Distribution', max_length=64, blank=True, null=True)
     os_type = models.CharField('OS Type', max_length=64, blank=True, null=True)
     os_release = models.CharField('OS Release', max_length=64, blank=True, null=True)
-    data = models.TextField('Asset Data')
+    data = CompressedJSONField('Asset Data')
     c_time = models.DateTimeField('Report Date', auto_now_add=True)
     m_time = models.DateTimeField('Data Update Date', auto_now=True)
     approved = models.BooleanField('Approval', default=False)
@@ -0,0 +1,152 @@
+"""
+Durable spool of accepted reports.
+
+With ASSET_REPORT_SPOOL['enabled'] the report views only validate the payload, append it to this
+SQLite file and answer 202; the drain_report_spool command runs the worker processes which apply them.
+Workers claim all pending reports of one SN at once and only apply the newest one, so the reports of
+an SN are applied in order and never by two workers at the same time.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS report (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sn TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received REAL NOT NULL,
+    worker TEXT,
+    claimed REAL
+);
+CREATE INDEX IF NOT EXISTS report_sn ON report (sn, id);
+"""
+
+
+class ReportSpool:
+    """
+    SQLite backed FIFO of raw reports
+    """
+
+    def __init__(self, path, lease=300):
+        """
+        :param path: spool file
+        :param lease: seconds after which a claim of a dead worker is given to another one
+        """
+        self.path = path
+        self.lease = lease
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # an accepted report must survive a crash of the host
+            conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def put(self, data):
+        self.put_many([data])
+
+    def put_many(self, reports):
+        """
+        Append reports to the spool in one transaction
+        :param reports: validated report dicts
+        :return:
+        """
+        now = time.time()
+        rows = [(data['sn'], json.dumps(data), now) for data in reports]
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT INTO report (sn, payload, received) VALUES (?, ?, ?)', rows)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def claim(self, worker):
+        """
+        Claim the pending reports of the SN which has waited longest
+        :param worker: name of the claiming worker
+        :return: (sn, last_id, data, coalesced) or None if nothing is pending.
+                 data is the newest report, coalesced the number of older reports it replaces.
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT sn FROM report WHERE sn NOT IN '
+                '(SELECT sn FROM report WHERE worker IS NOT NULL AND claimed > ?) '
+                'ORDER BY id LIMIT 1', (now - self.lease,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            sn = row[0]
+            last_id, payload = conn.execute('SELECT id, payload FROM report WHERE sn = ? ORDER BY id DESC LIMIT 1',
+                                            (sn,)).fetchone()
+            claimed = conn.execute('UPDATE report SET worker = ?, claimed = ? WHERE sn = ? AND id <= ?',
+                                   (worker, now, sn, last_id)).rowcount
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return sn, last_id, json.loads(payload), claimed - 1
+
+    def done(self, sn, last_id):
+        """
+        Remove the claimed reports of an SN once the newest one is applied
+        """
+        self._connection().execute('DELETE FROM report WHERE sn = ? AND id <= ?', (sn, last_id))
+
+    def release(self, sn, last_id):
+        """
+        Give the claimed reports back, i.e. when the database is not reachable
+        """
+        self._connection().execute('UPDATE report SET worker = NULL, claimed = NULL WHERE sn = ? AND id <= ?',
+                                   (sn, last_id))
+
+    def stats(self):
+        """
+        :return: {'depth': pending reports, 'assets': pending SNs, 'claimed': reports in progress,
+                  'lag': seconds the oldest report has waited}
+        """
+        depth, assets, claimed, oldest = self._connection().execute(
+            'SELECT COUNT(*), COUNT(DISTINCT sn), COUNT(worker), MIN(received) FROM report').fetchone()
+        return {
+            'depth': depth,
+            'assets': assets,
+            'claimed': claimed,
+            'lag': time.time() - oldest if oldest else 0.0,
+        }
+
+
+_spool = None
+
+
+def spool_enabled():
+    return getattr(settings, 'ASSET_REPORT_SPOOL', {}).get('enabled', False)
+
+
+def get_spool():
+    """
+    The spool configured in settings.ASSET_REPORT_SPOOL, one instance per process
+    """
+    global _spool
+    if _spool is None:
+        conf = settings.ASSET_REPORT_SPOOL
+        _spool = ReportSpool(conf['path'], lease=conf.get('lease', 300))
+    return _spool
@@ -1,3 +1,1296 @@
+import copy
+import gzip
+import http.server
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db import IntegrityError
+from django.db import OperationalError
+from django.db.migrations.executor import MigrationExecutor
+from django.test import override_settings
 from django.test import TestCase
+from django.test import TransactionTestCase
+
+from assets import asset_handler
+from assets import benchmark
+from assets import event_writer
+from assets import lookup_cache
+from assets import metrics
+from assets import models
+from assets import report_spool
+from assets.management.commands import drain_report_spool
+
+# the agent is a separate program, its modules import each other from the Client directory
+CLIENT_DIR = os.path.join(settings.BASE_DIR, 'Client')
+if CLIENT_DIR not in sys.path:
+    sys.path.append(CLIENT_DIR)
+
+import plugins  # noqa: E402
+from conf import settings as client_settings  # noqa: E402
+from core import delta as client_delta  # noqa: E402
+from core import fact_cache  # noqa: E402
+from core import handler  # noqa: E402
+from core import info_collection  # noqa: E402
+from core import low_impact  # noqa: E402
+from core import profiler  # noqa: E402
+from core import relay as client_relay  # noqa: E402
+from core import spool as client_spool  # noqa: E402
+from core import transport as client_transport  # noqa: E402
+from plugins import collect_linux_info as linux  # noqa: E402
+
 
 # Create your tests here.
+
+def make_report(index=0, rams=2, disks=2, nics=2):
+    return benchmark.make_host(index, rams, disks, nics, random.Random(index))
+
+
+class ReportTestCase(TestCase):
+    """
+    Posts reports through the views and brings assets online like an administrator would
+    """
+
+    def setUp(self):
+        # cached ids of a rolled back test would point to rows which do not exist
+        for cache in lookup_cache.CACHES.values():
+            cache.invalidate()
+
+    def tearDown(self):
+        event_writer.writer.flush()
+
+    def post_report(self, data):
+        response = self.client.post('/assets/report/', json.dumps(data), content_type='application/json',
+                                    HTTP_ACCEPT='application/json')
+        return response.status_code, response.json()
+
+    def post_delta(self, delta):
+        response = self.client.post('/assets/report/delta/', json.dumps(delta), content_type='application/json',
+                                    HTTP_ACCEPT='application/json')
+        return response.status_code, response.json()
+
+    def approve(self):
+        class Request:
+            user = User.objects.get_or_create(username='tester')[0]
+
+        ids = list(models.NewAssetApprovalZone.objects.values_list('id', flat=True))
+        return asset_handler.BulkApprovedAsset(Request(), ids).asset_upline()
+
+    def make_online(self, data):
+        """
+        :return: version token of the stored report
+        """
+        self.post_report(data)
+        self.approve()
+        status, reply = self.post_report(data)
+        self.assertEqual(reply['status'], 'updated')
+        return reply['token']
+
+
+class DeltaTest(ReportTestCase):
+
+    def test_client_fingerprint_matches_server(self):
+        data = make_report()
+        data['collect_meta'] = {'profile': {'wall_ms': 12}}
+        shuffled = copy.deepcopy(data)
+        shuffled['nic'].reverse()
+        shuffled['collect_meta'] = {'profile': {'wall_ms': 99}}
+        self.assertEqual(client_delta.VOLATILE_KEYS, asset_handler.VOLATILE_KEYS)
+        self.assertEqual(client_delta.fingerprint(data), asset_handler.report_fingerprint(data))
+        self.assertEqual(client_delta.fingerprint(shuffled), asset_handler.report_fingerprint(data))
+
+    def test_delta_is_merged(self):
+        old = make_report()
+        token = self.make_online(old)
+        new = copy.deepcopy(old)
+        new['ram'][0]['capacity'] += 8
+        del new['nic'][1]
+        new['os_release'] = 'Ubuntu 18.04 LTS'
+
+        delta = client_delta.make_delta(old, new)
+        delta.update(sn=new['sn'], base=token, token=client_delta.fingerprint(new))
+        status, reply = self.post_delta(delta)
+        self.assertEqual(status, 200)
+        self.assertEqual(reply['token'], client_delta.fingerprint(new))
+        asset = models.Asset.objects.get(sn=new['sn'])
+        self.assertEqual(asset.report, new)
+        self.assertEqual(asset.ram_set.get(slot=new['ram'][0]['slot']).capacity, new['ram'][0]['capacity'])
+        self.assertEqual(asset.nic_set.count(), 1)
+        self.assertEqual(asset.server.os_release, 'Ubuntu 18.04 LTS')
+
+    def test_stale_base_asks_for_full_report(self):
+        data = make_report()
+        self.make_online(data)
+        delta = {'sn': data['sn'], 'base': 'stale', 'token': client_delta.fingerprint(data),
+                 'changed': {}, 'removed': [], 'components': {}}
+        status, reply = self.post_delta(delta)
+        self.assertEqual(status, 409)
+        self.assertEqual(reply['status'], 'resync')
+
+    def test_wrong_token_asks_for_full_report(self):
+        data = make_report()
+        token = self.make_online(data)
+        delta = {'sn': data['sn'], 'base': token, 'token': 'not the merged report',
+                 'changed': {'model': 'other'}, 'removed': [], 'components': {}}
+        status, reply = self.post_delta(delta)
+        self.assertEqual(status, 409)
+        self.assertEqual(models.Asset.objects.get(sn=data['sn']).report, data)
+
+    def test_missing_stored_report_asks_for_full_report(self):
+        data = make_report()
+        token = self.make_online(data)
+        # fingerprinted before migration 0004 stored the report
+        models.Asset.objects.filter(sn=data['sn']).update(report=None)
+        delta = {'sn': data['sn'], 'base': token, 'token': token, 'changed': {}, 'removed': [], 'components': {}}
+        status, reply = self.post_delta(delta)
+        self.assertEqual(status, 409)
+        self.assertEqual(reply['status'], 'resync')
+
+
+class BatchReportTest(ReportTestCase):
+
+    def test_batch_of_new_assets(self):
+        reports = [make_report(i) for i in range(3)] + [{'no': 'sn'}]
+        body = gzip.compress(json.dumps({'reports': reports}).encode())
+        response = self.client.post('/assets/report/batch/', body, content_type='application/json',
+                                    HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(sorted(statuses), ['failed', 'new', 'new', 'new'])
+        self.assertEqual(models.NewAssetApprovalZone.objects.count(), 3)
+        self.assertEqual(self.approve(), 3)
+        self.assertEqual(models.Asset.objects.count(), 3)
+
+    def post_batch(self, reports):
+        response = self.client.post('/assets/report/batch/', json.dumps(reports), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_malformed_items_fail_alone(self):
+        reports = [make_report(0), 'not a report', {'sn': ['a', 'list']}, dict(make_report(1), asset_type=None),
+                   dict(make_report(2), asset_type='networkdevice')]
+        results = self.post_batch(reports)
+        failed = sorted((result['index'], result['status']) for result in results if 'index' in result)
+        self.assertEqual(failed, [(1, 'failed'), (2, 'failed'), (3, 'failed'), (4, 'failed')])
+        self.assertEqual([result['sn'] for result in results if result['status'] == 'new'], [reports[0]['sn']])
+
+    def test_duplicate_sn_keeps_the_latest(self):
+        first = make_report(0)
+        second = dict(copy.deepcopy(first), model='R750')
+        results = self.post_batch([first, second])
+        self.assertEqual(sorted(result['status'] for result in results), ['new', 'skipped'])
+        self.assertEqual([result['index'] for result in results if result['status'] == 'skipped'], [0])
+        self.assertEqual(models.NewAssetApprovalZone.objects.get().model, 'R750')
+
+    def test_failed_update_does_not_fail_the_batch(self):
+        online = [make_report(i) for i in range(2)]
+        for data in online:
+            self.make_online(data)
+        changed = [dict(copy.deepcopy(data), os_release='changed') for data in online]
+        changed[0]['ram'][0]['capacity'] += 8
+
+        def update_ram(update):
+            if update.asset.sn == changed[0]['sn']:
+                raise ValueError('bad RAM')
+
+        with mock.patch.object(asset_handler.UpdateAsset, '_update_RAM', autospec=True, side_effect=update_ram):
+            results = self.post_batch(changed + [make_report(5)])
+        statuses = dict((result['sn'], result['status']) for result in results)
+        self.assertEqual(statuses, {changed[0]['sn']: 'failed', changed[1]['sn']: 'updated',
+                                    make_report(5)['sn']: 'new'})
+        self.assertEqual(models.Server.objects.get(asset__sn=changed[1]['sn']).os_release, 'changed')
+        self.assertNotEqual(models.Server.objects.get(asset__sn=changed[0]['sn']).os_release, 'changed')
+
+
+class ApproveActionTest(ReportTestCase):
+
+    def test_select_across_approves_every_page(self):
+        for index in range(3):
+            self.post_report(make_report(index))
+        ids = list(models.NewAssetApprovalZone.objects.values_list('id', flat=True))
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        # "select all" posts only the checkboxes of the current page
+        response = self.client.post('/admin/assets/newassetapprovalzone/', {
+            'action': 'approve_selected_new_assets', 'select_across': '1', 'index': '0',
+            '_selected_action': ids[:1],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(models.Asset.objects.count(), 3)
+
+
+class CheckReportTest(ReportTestCase):
+
+    def test_asset_type_is_required(self):
+        for asset_type in (None, '', 'networkdevice', ['server']):
+            data = dict(make_report(), asset_type=asset_type)
+            if asset_type is None:
+                del data['asset_type']
+            status, reply = self.post_report(data)
+            self.assertEqual((status, reply['status']), (200, 'failed'), asset_type)
+        self.assertFalse(models.NewAssetApprovalZone.objects.exists())
+
+
+class ComponentDiffTest(ReportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = make_report(rams=3)
+        self.make_online(self.data)
+        self.asset = models.Asset.objects.get(sn=self.data['sn'])
+
+    def sync(self, data, queries):
+        asset = models.Asset.objects.get(id=self.asset.id)
+        with self.assertNumQueries(queries):
+            return asset_handler.RAM_DIFF.sync(asset, data, 'ram')
+
+    def slots(self):
+        return dict(self.asset.ram_set.values_list('slot', 'capacity'))
+
+    def test_unchanged_section_writes_nothing(self):
+        # the stored set only
+        self.assertEqual(self.sync(self.data, 1), (0, 0, 0))
+
+    def test_insert_update_delete(self):
+        data = copy.deepcopy(self.data)
+        data['ram'][0]['capacity'] = 64
+        del data['ram'][1]
+        data['ram'].append(dict(data['ram'][0], slot='DIMM99', capacity=32))
+        # stored set, delete, insert, update
+        self.assertEqual(self.sync(data, 4), (1, 1, 1))
+        self.assertEqual(self.slots(), {'DIMM00': 64, 'DIMM02': self.data['ram'][2]['capacity'], 'DIMM99': 32})
+
+    def test_missing_section_keeps_components(self):
+        data = copy.deepcopy(self.data)
+        del data['ram']
+        self.assertEqual(self.sync(data, 0), (0, 0, 0))
+        self.assertEqual(len(self.slots()), 3)
+
+    def test_empty_section_deletes_components(self):
+        data = dict(self.data, ram=[])
+        self.assertEqual(self.sync(data, 2), (0, 3, 0))
+        self.assertEqual(self.slots(), {})
+
+    def test_report_without_section_keeps_components(self):
+        # a collector which timed out leaves its section out and names it in collect_errors
+        data = copy.deepcopy(self.data)
+        del data['ram']
+        data['collect_errors'] = {'ram': 'timeout after 60s'}
+        status, reply = self.post_report(data)
+        self.assertEqual(reply['status'], 'updated')
+        self.assertEqual(len(self.slots()), 3)
+
+
+class FingerprintTest(ReportTestCase):
+
+    def test_unchanged_report_only_touches_last_seen(self):
+        data = make_report()
+        self.make_online(data)
+        asset = models.Asset.objects.get(sn=data['sn'])
+        # asset lookup and the last_seen update
+        with self.assertNumQueries(2):
+            status, reply = self.post_report(data)
+        self.assertEqual(reply['status'], 'unchanged')
+        self.assertEqual(reply['token'], asset.report_hash)
+        self.assertGreater(models.Asset.objects.get(id=asset.id).last_seen, asset.last_seen)
+
+    def test_component_order_and_volatile_keys_do_not_matter(self):
+        data = make_report()
+        self.make_online(data)
+        shuffled = copy.deepcopy(data)
+        shuffled['ram'].reverse()
+        shuffled['collect_meta'] = {'profile': {'wall_ms': 5}}
+        self.assertEqual(self.post_report(shuffled)[1]['status'], 'unchanged')
+
+    def test_changed_report_is_applied(self):
+        data = make_report()
+        self.make_online(data)
+        changed = copy.deepcopy(data)
+        changed['physical_disk_driver'][0]['capacity'] += 1
+        status, reply = self.post_report(changed)
+        self.assertEqual(reply['status'], 'updated')
+        disk = models.Disk.objects.get(sn=changed['physical_disk_driver'][0]['sn'])
+        self.assertEqual(disk.capacity, changed['physical_disk_driver'][0]['capacity'])
+
+
+class ReportSpoolTest(ReportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.spool = report_spool.ReportSpool(os.path.join(self.tmp, 'reports.sqlite3'))
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp)
+
+    def test_claim_coalesces_reports_of_one_sn(self):
+        self.spool.put_many([{'sn': 'A', 'n': 1}, {'sn': 'B', 'n': 1}, {'sn': 'A', 'n': 2}, {'sn': 'A', 'n': 3}])
+        sn, last_id, data, coalesced = self.spool.claim('w1')
+        self.assertEqual((sn, data['n'], coalesced), ('A', 3, 2))
+        # the reports of A are claimed, the next worker gets B
+        self.assertEqual(self.spool.claim('w2')[0], 'B')
+        self.assertIsNone(self.spool.claim('w3'))
+        self.spool.done(sn, last_id)
+        self.assertEqual(self.spool.stats()['depth'], 1)
+
+    def test_report_arriving_after_claim_stays(self):
+        self.spool.put({'sn': 'A', 'n': 1})
+        sn, last_id, data, coalesced = self.spool.claim('w1')
+        self.spool.put({'sn': 'A', 'n': 2})
+        self.spool.done(sn, last_id)
+        self.assertEqual(self.spool.claim('w1')[2]['n'], 2)
+
+    def test_release_gives_reports_back(self):
+        self.spool.put({'sn': 'A', 'n': 1})
+        sn, last_id, data, coalesced = self.spool.claim('w1')
+        self.spool.release(sn, last_id)
+        self.assertEqual(self.spool.stats()['claimed'], 0)
+        self.assertEqual(self.spool.claim('w2')[0], 'A')
+
+    def test_expired_claim_is_taken_over(self):
+        spool = report_spool.ReportSpool(self.spool.path, lease=-1)
+        spool.put({'sn': 'A'})
+        spool.claim('dead')
+        self.assertEqual(spool.claim('w2')[0], 'A')
+
+    def test_update_failing_on_the_database_is_raised(self):
+        data = make_report()
+        self.make_online(data)
+        changed = copy.deepcopy(data)
+        changed['ram'][0]['capacity'] += 8
+        with mock.patch.object(asset_handler.UpdateAsset, '_update_RAM', side_effect=OperationalError('locked')):
+            self.assertEqual(asset_handler.apply_report(None, changed)[0], 'failed')
+            with self.assertRaises(OperationalError):
+                asset_handler.apply_report(None, changed, reraise=True)
+
+    def test_worker_releases_report_when_database_fails(self):
+        self.spool.put(make_report())
+        stop = mock.Mock()
+        stop.is_set.side_effect = [False, True]
+        sigint = signal.getsignal(signal.SIGINT)
+        try:
+            with mock.patch.object(report_spool, 'get_spool', return_value=self.spool), \
+                    mock.patch.object(drain_report_spool, 'connections'), \
+                    mock.patch.object(asset_handler, 'apply_report', side_effect=OperationalError('gone')):
+                drain_report_spool.work('w1', 0, stop)
+        finally:
+            signal.signal(signal.SIGINT, sigint)
+        stats = self.spool.stats()
+        self.assertEqual((stats['depth'], stats['claimed']), (1, 0))
+
+
+class LookupCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = lookup_cache.LookupCache(models.Manufacturer, ttl=60)
+        self.pk = models.Manufacturer.objects.create(name='Dell').pk
+
+    def test_hit_does_not_query(self):
+        self.assertEqual(self.cache.get_id('Dell'), self.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get_id('Dell'), self.pk)
+
+    def test_entry_expires_after_ttl(self):
+        with mock.patch.object(lookup_cache.time, 'monotonic', return_value=1000.0):
+            self.cache.get_id('Dell')
+        with mock.patch.object(lookup_cache.time, 'monotonic', return_value=1059.0), self.assertNumQueries(0):
+            self.cache.get_id('Dell')
+        with mock.patch.object(lookup_cache.time, 'monotonic', return_value=1061.0), self.assertNumQueries(1):
+            self.assertEqual(self.cache.get_id('Dell'), self.pk)
+
+    def test_rename_invalidates(self):
+        lookup_cache.MANUFACTURERS.get_id('Dell')
+        manufacturer = models.Manufacturer.objects.get(pk=self.pk)
+        manufacturer.name = 'Dell EMC'
+        manufacturer.save()
+        self.assertIsNone(lookup_cache.MANUFACTURERS.get_id('Dell', create=False))
+        self.assertEqual(lookup_cache.MANUFACTURERS.get_id('Dell EMC', create=False), self.pk)
+
+    def test_lru_bound(self):
+        cache = lookup_cache.LookupCache(models.Manufacturer, maxsize=1)
+        other = models.Manufacturer.objects.create(name='HP').pk
+        cache.get_id('Dell')
+        cache.get_id('HP')
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_id('HP'), other)
+        with self.assertNumQueries(1):
+            cache.get_id('Dell')
+
+
+class EventWriterTest(TestCase):
+
+    def setUp(self):
+        self.writer = event_writer.EventWriter(size=10, interval=3600, max_pending=3)
+
+    def tearDown(self):
+        self.writer.flush()
+
+    def add(self, *names):
+        for name in names:
+            self.writer.add(models.EventLog(name=name))
+
+    def test_events_are_written_in_bulk(self):
+        self.add('a', 'b')
+        self.assertEqual(models.EventLog.objects.count(), 0)
+        with self.assertNumQueries(3):
+            self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(models.EventLog.objects.count(), 2)
+
+    def test_events_are_kept_when_the_database_fails(self):
+        with mock.patch.object(models.EventLog.objects, 'bulk_create', side_effect=OperationalError('locked')):
+            self.add('a', 'b')
+            self.assertEqual(self.writer.flush(), 0)
+            self.add('c', 'd')
+            self.assertEqual(self.writer.flush(), 0)
+        # the oldest event went beyond max_pending
+        self.assertEqual(self.writer.flush(), 3)
+        self.assertEqual(sorted(models.EventLog.objects.values_list('name', flat=True)), ['b', 'c', 'd'])
+
+    def test_integrity_error_falls_back_to_row_saves(self):
+        self.add('a', 'b')
+        with mock.patch.object(models.EventLog.objects, 'bulk_create', side_effect=IntegrityError('fk')):
+            self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(models.EventLog.objects.count(), 2)
+
+
+class CompressedJSONFieldTest(TestCase):
+
+    def test_roundtrip(self):
+        data = make_report(rams=16)
+        zone = models.NewAssetApprovalZone.objects.create(sn=data['sn'], data=data)
+        stored = models.NewAssetApprovalZone.objects.values_list('data', flat=True).get(id=zone.id)
+        self.assertLess(len(stored), len(json.dumps(data)))
+        self.assertEqual(zlib.decompress(bytes(stored)), json.dumps(data).encode())
+        self.assertEqual(models.NewAssetApprovalZone.objects.get(id=zone.id).data, data)
+
+    def test_decoded_lazily(self):
+        data = make_report()
+        zone = models.NewAssetApprovalZone.objects.create(sn=data['sn'], data=data)
+        zone = models.NewAssetApprovalZone.objects.get(id=zone.id)
+        self.assertIsInstance(zone.__dict__['data'], (bytes, memoryview))
+        # saved without being read, the compressed bytes are written back as they are
+        zone.save()
+        self.assertEqual(models.NewAssetApprovalZone.objects.get(id=zone.id).data, data)
+        self.assertEqual(zone.data, data)
+        self.assertIsInstance(zone.__dict__['data'], dict)
+
+    def test_none(self):
+        asset = models.Asset.objects.create(sn='NONE', name='server: NONE')
+        self.assertIsNone(models.Asset.objects.get(id=asset.id).report)
+
+
+class CompressDataMigrationTest(TransactionTestCase):
+
+    before = [('assets', '0002_asset_report_hash')]
+    after = [('assets', '0003_newassetapprovalzone_compressed_data')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_text_reports_are_compressed_and_back(self):
+        data = make_report()
+        apps = self.migrate(self.before)
+        apps.get_model('assets', 'NewAssetApprovalZone').objects.create(sn=data['sn'], data=json.dumps(data))
+
+        apps = self.migrate(self.after)
+        zone = apps.get_model('assets', 'NewAssetApprovalZone').objects.get(sn=data['sn'])
+        self.assertEqual(zone.data, data)
+
+        apps = self.migrate(self.before)
+        zone = apps.get_model('assets', 'NewAssetApprovalZone').objects.get(sn=data['sn'])
+        self.assertEqual(json.loads(zone.data), data)
+
+
+class MetricsTest(ReportTestCase):
+
+    def count(self, text, metric, handler, phase):
+        prefix = '%s_count{handler="%s",phase="%s"} ' % (metric, handler, phase)
+        lines = [line for line in text.splitlines() if line.startswith(prefix)]
+        return int(lines[0][len(prefix):]) if lines else 0
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram((1, 5))
+        for value in (0, 3, 4, 9):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.lines('q', 'a="b"')), [
+            'q_bucket{a="b",le="1"} 1', 'q_bucket{a="b",le="5"} 3', 'q_bucket{a="b",le="+Inf"} 4',
+            'q_sum{a="b"} 16.0', 'q_count{a="b"} 4'])
+
+    def test_report_phases_are_exposed(self):
+        before = self.client.get('/assets/metrics/').content.decode()
+        self.post_report(make_report())
+        response = self.client.get('/assets/metrics/')
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertIn('# TYPE report_phase_queries histogram', text)
+        for metric in ('report_phase_seconds', 'report_phase_sql_seconds', 'report_phase_queries'):
+            self.assertEqual(self.count(text, metric, 'view', 'report'),
+                             self.count(before, metric, 'view', 'report') + 1)
+
+    @override_settings(ASSET_REPORT_METRICS={'enabled': True, 'timing_header': True})
+    def test_server_timing_header(self):
+        response = self.client.post('/assets/report/', json.dumps(make_report()),
+                                    content_type='application/json', HTTP_ACCEPT='application/json')
+        self.assertRegex(response['Server-Timing'], r'(^|, )view\.report;dur=[0-9.]+;desc="\d+ queries')
+
+    @override_settings(ASSET_REPORT_METRICS={'enabled': False})
+    def test_disabled(self):
+        before = self.client.get('/assets/metrics/').content.decode()
+        self.post_report(make_report())
+        after = self.client.get('/assets/metrics/').content.decode()
+        self.assertEqual(self.count(after, 'report_phase_seconds', 'view', 'report'),
+                         self.count(before, 'report_phase_seconds', 'view', 'report'))
+
+
+class FakeSysfs:
+    """
+    A /sys tree in a temporary directory: class entries are symlinks into devices/ like on a real host
+    """
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+
+    def write(self, path, content=''):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+
+    def link(self, path, target):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.join(self.root, target), exist_ok=True)
+        os.symlink(os.path.join(self.root, target), path)
+
+    def path(self, path):
+        return os.path.join(self.root, path)
+
+    def remove(self):
+        shutil.rmtree(self.root)
+
+
+IP_ADDR = """1: lo    inet 127.0.0.1/8 scope host lo
+2: eth0    inet 10.0.0.5/24 brd 10.0.0.255 scope global eth0
+2: eth0    inet6 fe80::1/64 scope link
+4: bond0    inet 10.1.0.5/16 brd 10.1.255.255 scope global bond0
+6: vlan100@eth0    inet 10.100.0.5/24 scope global vlan100
+"""
+
+DMIDECODE = """# dmidecode 3.2
+Handle 0x0001, DMI type 1, 27 bytes
+System Information
+\tManufacturer: Dell Inc.
+\tProduct Name: PowerEdge R740
+\tSerial Number: ABC1234
+\tWake-up Type: Power Switch
+
+Handle 0x1100, DMI type 17, 84 bytes
+Memory Device
+\tSize: 32 GB
+\tLocator: A1
+\tType: DDR4
+\tManufacturer: Samsung
+\tSerial Number: 0001
+\tAsset Tag: 01
+
+Handle 0x1101, DMI type 17, 84 bytes
+Memory Device
+\tSize: No Module Installed
+\tLocator: A2
+"""
+
+
+class LinuxCollectorTest(TestCase):
+
+    def setUp(self):
+        self.sys = FakeSysfs()
+        self.addCleanup(self.sys.remove)
+        for name in ('DMI_PATH', 'NET_PATH', 'BLOCK_PATH', 'NVME_PATH'):
+            patcher = mock.patch.object(linux, name, self.sys.path(getattr(linux, name)[len('/sys/'):]))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.commands = {'ip': IP_ADDR, 'dmidecode': DMIDECODE}
+        self.run = linux.run
+        patcher = mock.patch.object(linux, 'run', side_effect=self.run_command)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        linux.reset()
+
+    def run_command(self, cmd, timeout=30, required=False):
+        output = self.commands.get(cmd[0] if cmd[0] != 'sudo' else cmd[2], '')
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+    def add_nic(self, name, mac, driver=None, virtual=False):
+        device = 'devices/virtual/net/%s' % name if virtual else 'devices/pci0000:00/0000:00:%s/net/%s' % (
+            len(os.listdir(self.sys.path('class/net'))) if os.path.isdir(self.sys.path('class/net')) else 0, name)
+        self.sys.link('class/net/%s' % name, device)
+        self.sys.write('%s/address' % device, mac)
+        if driver:
+            self.sys.link('%s/device/driver' % device, 'bus/pci/drivers/%s' % driver)
+
+    def test_nic(self):
+        self.add_nic('lo', '00:00:00:00:00:00', virtual=True)
+        self.add_nic('eth0', 'aa:00:00:00:00:01', 'ixgbe')
+        self.add_nic('eth1', 'aa:00:00:00:00:02', 'ixgbe')
+        self.add_nic('eth2', 'aa:00:00:00:00:02', 'ixgbe')
+        self.add_nic('bond0', 'aa:00:00:00:00:02', virtual=True)
+        self.add_nic('br0', 'aa:00:00:00:00:09', virtual=True)
+        self.add_nic('vlan100', 'aa:00:00:00:00:01', virtual=True)
+        self.add_nic('vlan200', 'aa:00:00:00:00:01', virtual=True)
+        for i in range(3):
+            self.add_nic('veth%s' % i, 'fe:00:00:00:00:%02x' % i, virtual=True)
+        self.sys.write('class/net/bonding_masters', 'bond0')
+        self.sys.write('class/net/bond0/bonding/slaves', 'eth1 eth2')
+        self.sys.write('class/net/bond0/bonding/mode', 'active-backup 1')
+        self.sys.write('class/net/eth1/bonding_slave/perm_hwaddr', 'aa:00:00:00:00:02')
+        self.sys.write('class/net/eth2/bonding_slave/perm_hwaddr', 'aa:00:00:00:00:03')
+
+        data = linux.get_nic_info()
+        nics = dict((nic['name'], nic) for nic in data['nic'])
+        self.assertEqual(sorted(nics), ['bond0', 'br0', 'eth0', 'eth1', 'eth2', 'vlan100,vlan200'])
+        self.assertEqual(data['nic_summary'], {'veth': 3})
+        self.assertEqual((nics['eth0']['model'], nics['eth0']['ip_address']), ('ixgbe', '10.0.0.5'))
+        self.assertEqual(nics['eth0']['net_mask'], ['255.255.255.0'])
+        self.assertEqual(nics['eth0']['addresses'], ['10.0.0.5/24', 'fe80::1/64'])
+        self.assertEqual((nics['bond0']['model'], nics['bond0']['slaves']), ('bond', ['eth1', 'eth2']))
+        self.assertEqual((nics['eth2']['mac'], nics['eth2']['bonding']), ('aa:00:00:00:00:03', 'bond0'))
+        # VLANs share their parent's MAC and have no driver, one entry keeps both
+        self.assertEqual(nics['vlan100,vlan200']['ip_address'], '10.100.0.5')
+        keys = [(nic['model'], nic['mac']) for nic in data['nic']]
+        self.assertEqual(len(keys), len(set(keys)))
+
+    def add_disk(self, name, device, serial=None, size=1953525168, rotational='1', model=''):
+        self.sys.link('block/%s' % name, '%s/block/%s' % (device, name))
+        path = '%s/block/%s' % (device, name)
+        self.sys.write('%s/size' % path, str(size))
+        self.sys.write('%s/queue/rotational' % path, rotational)
+        if not name.startswith('nvme'):
+            os.symlink(self.sys.path(device), self.sys.path('%s/device' % path))
+            self.sys.write('%s/model' % device, model)
+            self.sys.write('%s/vendor' % device, 'ATA')
+            if serial:
+                self.sys.write('%s/vpd_pg80' % device, b'\x00\x80\x00\x0c' + serial.encode())
+
+    def test_disk(self):
+        self.add_disk('sda', 'devices/pci0000:00/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0', 'S1', model='ST2000')
+        # two paths of one multipath SAS disk
+        sas = 'devices/pci0000:00/0000:3b:00.0/host1/port-1:0/end_device-1:0/target1:0:%s/1:0:%s:0'
+        self.add_disk('sdb', sas % (0, 0), 'S2', model='AL15SE')
+        self.add_disk('sdc', sas % (1, 1), 'S2', model='AL15SE')
+        self.add_disk('loop0', 'devices/virtual/block/loop0', size=1000)
+        # one NVMe drive with two namespaces
+        controller = 'devices/pci0000:00/0000:5e:00.0/nvme/nvme0'
+        self.sys.link('class/nvme/nvme0', controller)
+        self.sys.write('%s/model' % controller, 'Samsung PM983')
+        self.sys.write('%s/serial' % controller, 'N1')
+        self.sys.write('%s/transport' % controller, 'pcie')
+        for namespace in ('nvme0n1', 'nvme0n2'):
+            self.add_disk(namespace, controller, size=1000000000, rotational='0')
+            os.symlink(self.sys.path(controller), self.sys.path('%s/block/%s/device' % (controller, namespace)))
+
+        disks = dict((disk['sn'], disk) for disk in linux.get_disk_info()['physical_disk_driver'])
+        self.assertEqual(sorted(disks), ['N1', 'S1', 'S2'])
+        self.assertEqual((disks['S1']['interface_type'], disks['S1']['slot'], disks['S1']['model']),
+                         ('SATA', '0:0:0:0', 'ST2000'))
+        self.assertEqual(disks['S1']['capacity'], 1000.2)
+        self.assertEqual((disks['S2']['interface_type'], disks['S2']['paths']), ('SAS', ['sdb', 'sdc']))
+        self.assertEqual((disks['N1']['interface_type'], disks['N1']['model']), ('NVMe', 'Samsung PM983'))
+        self.assertEqual((disks['N1']['capacity'], disks['N1']['rotational']), (1024.0, False))
+        self.assertEqual(disks['N1']['paths'], ['nvme0n1', 'nvme0n2'])
+        for disk in disks.values():
+            self.assertIn(asset_handler._clean_disk(disk)['interface_type'], asset_handler.DISK_INTERFACE_TYPES)
+
+    def test_system_and_ram(self):
+        self.sys.write('class/dmi/id/sys_vendor', 'Dell Inc.')
+        self.sys.write('class/dmi/id/product_name', 'PowerEdge R740')
+        data = linux.get_system_info()
+        # product_serial is readable by root only, dmidecode fills the gap
+        self.assertEqual((data['sn'], data['model'], data['wake_up_type']),
+                         ('ABC1234', 'PowerEdge R740', 'Power Switch'))
+        ram = linux.get_ram_info()['ram']
+        self.assertEqual(ram, [{'slot': 'A1', 'capacity': 32, 'model': 'DDR4', 'manufacturer': 'Samsung',
+                                'sn': '0001', 'asset_tag': '01'}])
+
+    def test_small_modules_are_rounded_up(self):
+        self.commands['dmidecode'] = DMIDECODE.replace('Size: 32 GB', 'Size: 512 MB')
+        self.assertEqual(linux.get_ram_info()['ram'][0]['capacity'], 1)
+
+    def test_dmidecode_failure_fails_the_ram_section(self):
+        # sudo -n without a password, or no dmidecode at all
+        self.commands['dmidecode'] = linux.CommandError('dmidecode failed with exit status 1')
+        with self.assertRaises(linux.CommandError):
+            linux.get_ram_info()
+        linux.reset()
+        self.commands['dmidecode'] = '# dmidecode 3.2\n# No SMBIOS nor DMI entry point found, sorry.\n'
+        with self.assertRaises(linux.CommandError):
+            linux.get_ram_info()
+
+    def test_required_command(self):
+        self.assertEqual(self.run(['false']), '')
+        for cmd in (['false'], ['true'], ['no-such-command-%s' % os.getpid()]):
+            with self.assertRaises(linux.CommandError):
+                self.run(cmd, required=True)
+        self.assertEqual(self.run(['echo', 'ok'], required=True), 'ok\n')
+
+    def test_command_timeout_fails_the_section(self):
+        self.commands['dmidecode'] = linux.CommandError('dmidecode timed out after 30s')
+        with self.assertRaises(linux.CommandError):
+            linux.get_ram_info()
+        # sysfs knows everything but the wake up type
+        for name, value in (('sys_vendor', 'Dell Inc.'), ('product_name', 'R740'), ('product_serial', 'S'),
+                            ('product_uuid', 'U')):
+            self.sys.write('class/dmi/id/%s' % name, value)
+        self.assertEqual(linux.get_system_info()['sn'], 'S')
+        with self.assertRaises(linux.CommandError):
+            self.run(['sleep', '5'], timeout=0.1)
+
+
+class FactCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cache = fact_cache.FactCache(os.path.join(self.tmp, 'cache', 'facts.json'), ttl=100,
+                                          sections=['system', 'ram'])
+        self.signature = {'boot_id': 'b1', 'kernel': '5.4', 'cpus': '0-3', 'block': 'x', 'pci': 'y'}
+        patcher = mock.patch.object(fact_cache.FactCache, 'signature', side_effect=lambda: dict(self.signature))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_static_sections_are_kept(self):
+        self.cache.save({'system': {'sn': 'S'}, 'ram': {'ram': []}, 'nic': {'nic': []}})
+        self.assertEqual(self.cache.load(), {'system': {'sn': 'S'}, 'ram': {'ram': []}})
+        # serial numbers are in the file
+        self.assertEqual(os.stat(self.cache.path).st_mode & 0o777, 0o600)
+
+    def test_sections_expire_one_by_one(self):
+        with mock.patch.object(fact_cache.time, 'time', return_value=1000.0):
+            self.cache.save({'system': {'sn': 'S'}, 'ram': {'ram': []}})
+        with mock.patch.object(fact_cache.time, 'time', return_value=1050.0):
+            self.cache.save({'ram': {'ram': [{'slot': 'A1'}]}})
+        with mock.patch.object(fact_cache.time, 'time', return_value=1120.0):
+            self.assertEqual(self.cache.load(), {'ram': {'ram': [{'slot': 'A1'}]}})
+        # a clock set backwards
+        with mock.patch.object(fact_cache.time, 'time', return_value=900.0):
+            self.assertEqual(self.cache.load(), {})
+
+    def test_changed_signature_drops_the_cache(self):
+        self.cache.save({'system': {'sn': 'S'}})
+        self.signature['block'] = 'z'
+        self.assertEqual(self.cache.load(), {})
+        self.cache.save({'ram': {'ram': []}})
+        self.signature['block'] = 'x'
+        self.assertEqual(self.cache.load(), {})
+
+    def test_corrupt_file_is_a_miss(self):
+        os.makedirs(os.path.dirname(self.cache.path))
+        with open(self.cache.path, 'w') as f:
+            f.write('{"signature": ')
+        self.assertEqual(self.cache.load(), {})
+        self.cache.save({'system': {'sn': 'S'}})
+        self.assertEqual(self.cache.load(), {'system': {'sn': 'S'}})
+
+
+class DaemonTest(TestCase):
+    """
+    The daemon loop on a fake clock, each reading of which takes a little time
+    """
+
+    def setUp(self):
+        self.clock = 1000.0
+        self.sent = []
+        self.run_times = [5, 100, 5]
+        for name in ('SIGTERM', 'SIGINT', 'SIGHUP'):
+            self.addCleanup(signal.signal, getattr(signal, name), signal.getsignal(getattr(signal, name)))
+
+    def monotonic(self):
+        self.clock += 0.3
+        return self.clock
+
+    def sleep(self, seconds):
+        self.assertTrue(0 <= seconds <= 1.0, seconds)
+        self.clock += seconds
+
+    def send(self, transport, asset_data, spool):
+        self.sent.append(self.clock)
+        self.clock += self.run_times[len(self.sent) - 1]
+        if len(self.sent) == len(self.run_times):
+            signal.raise_signal(signal.SIGTERM)
+
+    def test_runs_are_splayed_and_do_not_pile_up(self):
+        clock = mock.Mock(monotonic=self.monotonic, sleep=self.sleep)
+        with mock.patch.object(handler, 'time', clock), \
+                mock.patch.object(handler, 'random', mock.Mock(uniform=lambda a, b: b)), \
+                mock.patch.dict(client_settings.DAEMON, interval=60, splay=10), \
+                mock.patch.object(handler.info_collection, 'InfoCollection'), \
+                mock.patch.object(handler, 'Transport') as transport_class, \
+                mock.patch.object(handler, 'OfflineSpool', return_value=mock.Mock(due=lambda: False)), \
+                mock.patch.object(handler.ArgvHandler, 'send', side_effect=self.send):
+            handler.ArgvHandler.daemon()
+        # due at 1010 and 1070; the second run overran its interval, the third waits only for the splay
+        for sent, due in zip(self.sent, (1010, 1070, 1180)):
+            self.assertTrue(due <= sent < due + 1.5, self.sent)
+        self.assertEqual(len(self.sent), 3)
+        transport_class.return_value.close.assert_called_once_with()
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.peers.append(self.client_address)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(400 if body == b'bad' else 200)
+        self.send_header('Content-Length', '2')
+        if body == b'close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTest(TestCase):
+
+    def setUp(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        server.peers = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+        self.transport = client_transport.Transport('127.0.0.1', server.server_address[1], timeout=5)
+        self.addCleanup(self.transport.close)
+
+    def test_connection_is_reused(self):
+        for i in range(3):
+            self.assertEqual(self.transport.post('/assets/report/', b'{}'), (200, 'ok'))
+        self.assertEqual(len(set(self.server.peers)), 1)
+
+    def test_reconnects_after_close(self):
+        self.transport.post('/assets/report/', b'close')
+        self.assertIsNone(self.transport.connection)
+        self.transport.post('/assets/report/', b'{}')
+        # the server dropped the idle connection
+        self.transport.connection.sock.shutdown(socket.SHUT_RDWR)
+        self.transport.post('/assets/report/', b'{}')
+        self.assertEqual(len(set(self.server.peers)), 3)
+
+    def test_error_status(self):
+        with self.assertRaises(client_transport.TransportError) as raised:
+            self.transport.post('/assets/report/', b'bad')
+        self.assertEqual(raised.exception.status, 400)
+
+
+class OfflineSpoolTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.spool = client_spool.OfflineSpool(self.tmp, max_entries=3)
+        self.transport = mock.Mock()
+
+    def sent(self):
+        body = self.transport.post.call_args[0][1]
+        return [report['n'] for report in json.loads(gzip.decompress(body))['reports']]
+
+    def test_newest_report_per_sn_and_oldest_dropped(self):
+        for sn, n in (('A', 1), ('B', 2), ('A', 3), ('C', 4), ('D', 5)):
+            self.spool.put({'sn': sn, 'n': n})
+            # mtimes of files written in one tick may be equal
+            os.utime(self.spool._file(sn), ns=(n * 10 ** 9, n * 10 ** 9))
+        self.assertEqual([report['n'] for path, mtime, report in self.spool.entries()], [3, 4, 5])
+
+    def test_replay_sends_one_batch(self):
+        self.spool.extend([{'sn': 'A', 'n': 1}, {'sn': 'B', 'n': 2}])
+        self.assertEqual(self.spool.replay(self.transport), 2)
+        self.assertEqual(sorted(self.sent()), [1, 2])
+        self.assertEqual(self.spool.entries(), [])
+        self.assertFalse(self.spool.due())
+
+    def test_server_error_backs_off(self):
+        self.spool.put({'sn': 'A', 'n': 1})
+        for error in (client_transport.TransportError(503, 'busy'), ConnectionRefusedError()):
+            self.transport.post.side_effect = error
+            self.assertEqual(self.spool.replay(self.transport), 0)
+            self.assertEqual(len(self.spool.entries()), 1)
+            self.assertFalse(self.spool.due())
+        self.assertEqual(self.spool._state()['failures'], 2)
+
+    def test_rejected_batch_is_dropped(self):
+        self.spool.put({'sn': 'A', 'n': 1})
+        self.spool.failed()
+        self.transport.post.side_effect = client_transport.TransportError(400, 'bad report')
+        self.assertEqual(self.spool.replay(self.transport), 0)
+        self.assertEqual(self.spool.entries(), [])
+        self.assertEqual(self.spool._state()['failures'], 0)
+
+
+@override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=4096)
+class CompressedBodyTest(ReportTestCase):
+
+    def post_body(self, body, encoding):
+        return self.client.post('/assets/report/', body, content_type='application/json',
+                                HTTP_CONTENT_ENCODING=encoding, HTTP_ACCEPT='application/json')
+
+    def test_gzip_and_deflate(self):
+        data = make_report(0, rams=1, disks=1, nics=1)
+        raw = json.dumps(data).encode()
+        raw_deflate = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for index, (encoding, body) in enumerate((
+                ('gzip', gzip.compress(raw)),
+                ('deflate', zlib.compress(raw)),
+                ('deflate', raw_deflate.compress(raw) + raw_deflate.flush()))):
+            models.NewAssetApprovalZone.objects.all().delete()
+            response = self.post_body(body, encoding)
+            self.assertEqual(response.status_code, 200, (index, response.content))
+            self.assertEqual(models.NewAssetApprovalZone.objects.get().sn, data['sn'])
+
+    def test_decompressed_size_is_capped(self):
+        # 100 KB of JSON in a few hundred compressed bytes
+        raw = json.dumps(dict(make_report(), padding='x' * 100000)).encode()
+        for encoding, body in (('gzip', gzip.compress(raw)), ('deflate', zlib.compress(raw))):
+            self.assertLess(len(body), 4096)
+            response = self.post_body(body, encoding)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(b'larger than 4096', response.content)
+        self.assertFalse(models.NewAssetApprovalZone.objects.exists())
+
+    def test_corrupt_and_truncated_bodies(self):
+        body = gzip.compress(json.dumps(make_report()).encode())
+        self.assertEqual(self.post_body(body[:len(body) // 2], 'gzip').status_code, 400)
+        self.assertEqual(self.post_body(b'not gzip at all', 'gzip').status_code, 400)
+        self.assertEqual(self.post_body(body, 'br').status_code, 400)
+
+    def test_agent_encodings(self):
+        data = make_report(0, rams=1, disks=1, nics=1)
+        for report_format in ('gzip', 'deflate', 'json', 'form'):
+            models.NewAssetApprovalZone.objects.all().delete()
+            body, headers = client_transport.encode_report(data, report_format)
+            extra = {'HTTP_CONTENT_ENCODING': headers['Content-Encoding']} if 'Content-Encoding' in headers else {}
+            response = self.client.post('/assets/report/', body, content_type=headers['Content-Type'], **extra)
+            self.assertEqual(response.status_code, 200, (report_format, response.content))
+            self.assertEqual(models.NewAssetApprovalZone.objects.get().sn, data['sn'])
+
+
+class PluginRegistryTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(plugins, 'REGISTRY', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_register_replaces_by_name_and_platform(self):
+        plugins.register(plugins.Collector('ram', 'plugins.collect_linux_info', 'get_ram_info', ['linux']))
+        plugins.register(plugins.Collector('ram', 'plugins.collect_darwin_info', 'collect', ['darwin']))
+        site = plugins.register(plugins.Collector('ram', 'site_plugins.ram', 'collect', ['linux']))
+        self.assertEqual([c.module for c in plugins.REGISTRY], ['plugins.collect_darwin_info', 'site_plugins.ram'])
+        self.assertEqual(plugins.collectors('linux'), [site])
+
+    def test_collectors_are_filtered_and_most_expensive_first(self):
+        for name, cost, kwargs in (('os', 'low', {}), ('ram', 'high', {}), ('nic', 'medium', {}),
+                                   ('off', 'high', {}),
+                                   ('gone', 'high', {'requires': ['/no/such/path']}),
+                                   ('tool', 'high', {'commands': ['no-such-command-%s' % os.getpid()]})):
+            plugins.register(plugins.Collector(name, 'site_plugins.%s' % name, 'collect', ['linux'], cost=cost,
+                                               **kwargs))
+        with mock.patch.dict(client_settings.COLLECTORS, off=False):
+            self.assertEqual([c.name for c in plugins.collectors('linux')], ['ram', 'nic', 'os'])
+        self.assertEqual(plugins.collectors('windows'), [])
+
+    def test_module_is_imported_on_load(self):
+        # registering does not import anything
+        collector = plugins.register(plugins.Collector('x', 'site_plugins_not_installed', 'collect', ['linux']))
+        with self.assertRaises(ImportError):
+            collector.load()
+        linux._dmidecode_cache['sections'] = {}
+        func = plugins.Collector('ram', 'plugins.collect_linux_info', 'get_ram_info', ['linux']).load()
+        self.assertIs(func, linux.get_ram_info)
+        # the state of the last collection is reset
+        self.assertEqual(linux._dmidecode_cache, {})
+
+
+class RunCollectorsTest(TestCase):
+
+    def collector(self, name, func, threaded=True):
+        collector = plugins.Collector(name, 'site_plugins.%s' % name, 'collect', ['linux'], threaded=threaded)
+        collector.load = lambda: func
+        return collector
+
+    def test_hung_and_failing_collectors_leave_their_section_out(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def hang():
+            release.wait(10)
+            return {'late': True}
+
+        def fail():
+            raise OSError('no such device')
+
+        broken = self.collector('broken', None)
+        broken.load = mock.Mock(side_effect=ImportError('no module'))
+        collectors = [self.collector('slow', hang), self.collector('bad', fail), broken,
+                      self.collector('os', lambda: {'os_type': 'Linux'}, threaded=False)]
+        with mock.patch.dict(client_settings.COLLECT_TIMEOUT, slow=0.2):
+            sections, errors = info_collection.InfoCollection.run_collectors(collectors)
+        self.assertEqual(sections, {'os': {'os_type': 'Linux'}})
+        self.assertTrue(errors['slow'].startswith('timeout after'))
+        self.assertEqual(errors['bad'], 'error: no such device')
+        self.assertEqual(errors['broken'], 'error: no module')
+        self.assertEqual(info_collection.InfoCollection.merge(sections, errors)['collect_errors'], errors)
+
+
+class ProfilerTest(TestCase):
+
+    def test_collectors_and_their_commands(self):
+        profile = profiler.Profiler()
+        profile.enabled = True
+        with profile.collector('ram'):
+            with profile.command(['dmidecode', '-t', 'memory']):
+                pass
+            with self.assertRaises(OSError), profile.command(['lsblk']):
+                raise OSError('missing')
+        with profile.command(['uname']):
+            pass
+        profile.cached(['system'])
+        report = json.loads(json.dumps(profile.report()))
+        self.assertEqual(report['collectors']['ram']['commands'], 2)
+        self.assertEqual(report['collectors']['system'], {'wall_ms': 0, 'cpu_ms': 0, 'cached': True})
+        self.assertEqual([(c['collector'], c['command'], c['failed']) for c in report['commands']], [
+            ('ram', 'dmidecode -t memory', False), ('ram', 'lsblk', True), (None, 'uname', False)])
+        for key in ('wall_ms', 'cpu_ms', 'commands_cpu_ms'):
+            self.assertGreaterEqual(report[key], 0)
+
+    def test_disabled_records_nothing(self):
+        profile = profiler.Profiler()
+        profile.enabled = False
+        with profile.collector('ram'), profile.command(['dmidecode']):
+            pass
+        self.assertEqual((profile.collectors, profile.commands), ({}, []))
+
+    def test_options_go_anywhere(self):
+        for args in (['main.py', '--profile', 'collect_data'], ['main.py', 'collect_data', '--profile']):
+            with mock.patch.object(handler.PROFILER, 'enabled', False), \
+                    mock.patch.object(handler.ArgvHandler, 'collect_data') as collect_data:
+                handler.ArgvHandler(args)
+                self.assertTrue(handler.PROFILER.enabled)
+            collect_data.assert_called_once_with()
+
+
+class CollectorProfileTest(ReportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(asset_handler._profiled, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def profiled(self, data, wall_ms):
+        data = dict(data, collect_meta={'profile': {
+            'collectors': {'ram': {'wall_ms': wall_ms, 'cpu_ms': 1, 'commands': 1, 'command_ms': wall_ms}},
+            'commands': [{'collector': 'ram', 'command': 'dmidecode', 'wall_ms': wall_ms}],
+            'wall_ms': wall_ms + 1, 'cpu_ms': 2, 'commands_cpu_ms': 1}})
+        return data
+
+    def stored(self):
+        return dict(models.CollectorProfile.objects.values_list('collector', 'wall_ms'))
+
+    def test_unchanged_reports_are_sampled(self):
+        data = make_report()
+        self.make_online(data)
+        self.assertEqual(self.post_report(self.profiled(data, 5))[1]['status'], 'unchanged')
+        self.assertEqual(self.stored(), {'ram': 5, models.CollectorProfile.TOTAL: 6})
+        # within the interval an unchanged report writes nothing but last_seen
+        with self.assertNumQueries(2):
+            self.assertEqual(asset_handler.apply_report(None, self.profiled(data, 7))[0], 'unchanged')
+        self.assertEqual(self.stored()['ram'], 5)
+        changed = self.profiled(copy.deepcopy(data), 9)
+        changed['ram'][0]['capacity'] += 8
+        self.assertEqual(self.post_report(changed)[1]['status'], 'updated')
+        self.assertEqual(self.stored()['ram'], 9)
+
+    def test_batch(self):
+        data = make_report()
+        self.make_online(data)
+        response = self.client.post('/assets/report/batch/', json.dumps({'reports': [self.profiled(data, 5)]}),
+                                    content_type='application/json')
+        self.assertEqual(response.json()['results'][0]['status'], 'unchanged')
+        self.assertEqual(self.stored()['ram'], 5)
+        self.client.post('/assets/report/batch/', json.dumps({'reports': [self.profiled(data, 7)]}),
+                         content_type='application/json')
+        self.assertEqual(self.stored()['ram'], 5)
+
+
+class LowImpactTest(TestCase):
+
+    def setUp(self):
+        self.clock = 1000.0
+        self.limits = low_impact.LowImpact()
+        self.limits.enabled = True
+        self.limits.conf = dict(self.limits.conf, wall_budget=30, load_wait=60, max_load=1.0,
+                                essential=('system', 'os'))
+        clock = mock.Mock(monotonic=lambda: self.clock, sleep=self.sleep, process_time=lambda: 0.0)
+        for patcher in (mock.patch.object(low_impact, 'time', clock),
+                        mock.patch.object(low_impact, 'resource', None),
+                        mock.patch.object(info_collection, 'LIMITS', self.limits),
+                        mock.patch.dict(client_settings.FACT_CACHE, enabled=False)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.clock += seconds
+
+    def collector(self, name, cost, data):
+        def collect():
+            # real commands take a moment
+            threading.Event().wait(0.05)
+            return data
+
+        collector = plugins.Collector(name, 'site_plugins.%s' % name, 'collect', ['linux'], cost=cost)
+        collector.load = lambda: collect
+        return collector
+
+    def collect(self, load):
+        collectors = [self.collector('ram', 'high', {'ram': [{'slot': 'A1', 'capacity': 16}]}),
+                      self.collector('system', 'medium', {'sn': 'S1', 'asset_type': 'server'}),
+                      self.collector('os', 'low', {'os_type': 'Linux'})]
+        with mock.patch.object(plugins, 'collectors', return_value=collectors), \
+                mock.patch.object(self.limits, 'load_per_cpu', return_value=load):
+            return info_collection.InfoCollection().collect()
+
+    def test_busy_host_skips_heavy_collectors_but_keeps_the_sn(self):
+        data = self.collect(load=4.0)
+        self.assertEqual((data['sn'], data['os_type']), ('S1', 'Linux'))
+        self.assertNotIn('ram', data)
+        self.assertEqual(data['collect_errors'], {'ram': 'skipped: load 4.00 per cpu'})
+        # a minute of waiting for the load to drop, the wall budget is still untouched
+        self.assertEqual(self.clock, 1060.0)
+        self.assertEqual(self.limits.remaining_wall(), 30)
+
+    def test_quiet_host_runs_everything(self):
+        data = self.collect(load=0.5)
+        self.assertEqual(data['ram'][0]['slot'], 'A1')
+        self.assertNotIn('collect_errors', data)
+        self.assertEqual(self.clock, 1000.0)
+
+    def test_essential_collectors_are_never_held_back(self):
+        collectors = [self.collector('system', 'high', {}), self.collector('disk', 'high', {})]
+        with mock.patch.object(self.limits, 'load_per_cpu', return_value=4.0):
+            self.limits.start()
+            admitted, skipped = self.limits.admit(collectors)
+        self.assertEqual([c.name for c in admitted], ['system'])
+        self.assertEqual(list(skipped), ['disk'])
+
+    def test_used_up_budget_does_not_cut_essential_collectors(self):
+        self.limits.start()
+        self.clock += 30
+        sections, errors = info_collection.InfoCollection.run_collectors(
+            [self.collector('disk', 'medium', {'physical_disk_driver': []}),
+             self.collector('system', 'medium', {'sn': 'S1'})])
+        self.assertEqual(sections, {'system': {'sn': 'S1'}})
+        self.assertIn('disk', errors)
+
+
+class RelayTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch.dict(client_settings.RELAY, spool_path=os.path.join(self.tmp, 'spool'), batch_size=2,
+                                  max_pending=3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.relay = self.new_relay()
+
+    def new_relay(self):
+        relay = client_relay.Relay()
+        relay.transport = mock.Mock()
+        return relay
+
+    def sent(self, relay=None):
+        calls = (relay or self.relay).transport.post.call_args_list
+        return [[report['sn'] for report in json.loads(gzip.decompress(call[0][1]))['reports']] for call in calls]
+
+    def test_newest_report_per_sn(self):
+        self.assertEqual(self.relay.add([{'sn': 'A', 'n': 1}, {'sn': 'B'}, {'n': 'no sn'}, {'sn': 'A', 'n': 2}]), 3)
+        self.relay.add([{'sn': 'C'}, {'sn': 'D'}])
+        # over max_pending, the oldest goes
+        self.assertEqual(list(self.relay.pending), ['A', 'C', 'D'])
+        self.assertEqual(self.relay.pending['A']['n'], 2)
+        self.assertEqual((self.relay.stats['replaced'], self.relay.stats['dropped']), (1, 1))
+
+    def test_forward_in_batches(self):
+        self.relay.add([{'sn': 'A'}, {'sn': 'B'}, {'sn': 'C'}])
+        self.assertEqual(self.relay.forward(), 3)
+        self.assertEqual(self.sent(), [['A', 'B'], ['C']])
+        self.assertEqual(self.relay.pending, {})
+
+    def test_rejected_batch_is_dropped_failed_one_requeued(self):
+        self.relay.add([{'sn': 'A'}, {'sn': 'B'}, {'sn': 'C'}])
+        self.relay.transport.post.side_effect = [client_transport.TransportError(400, 'bad'),
+                                                 client_transport.TransportError(503, 'busy')]
+        self.assertEqual(self.relay.forward(), 0)
+        self.assertEqual(list(self.relay.pending), ['C'])
+        self.assertEqual(self.relay.stats['rejected'], 2)
+        self.assertFalse(self.relay.due())
+
+    def test_spooled_reports_stay_until_forwarded(self):
+        self.relay.add([{'sn': 'A'}, {'sn': 'B'}])
+        self.assertEqual(self.relay.save(), 2)
+
+        relay = self.new_relay()
+        self.assertEqual(relay.restore(), 2)
+        relay.transport.post.side_effect = ConnectionRefusedError()
+        relay.forward()
+        relay.save()
+        self.assertEqual(len(relay.spool.entries()), 2)
+
+        relay = self.new_relay()
+        relay.restore()
+        self.assertEqual(relay.forward(), 2)
+        self.assertEqual(relay.spool.entries(), [])
+
+    def test_agents_behind_the_relay_send_full_reports(self):
+        server = self.relay.listen(('127.0.0.1', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        agent = client_transport.Transport('127.0.0.1', server.server_address[1], timeout=5)
+        self.addCleanup(agent.close)
+        data = make_report()
+        with mock.patch.dict(client_settings.DELTA, enabled=True, path=os.path.join(self.tmp, 'last_report.json')), \
+                mock.patch.object(agent, 'post', wraps=agent.post) as post:
+            for run in range(3):
+                self.assertEqual(handler.ArgvHandler.post_report(agent, data),
+                                 'Asset info has been queued by the relay!')
+        # no delta the relay could only refuse
+        self.assertEqual([call[0][0] for call in post.call_args_list], [client_settings.Params['url']] * 3)
+        self.assertEqual(list(self.relay.pending), [data['sn']])
+
+    def test_agent_does_not_import_the_relay(self):
+        code = 'import sys; from core import handler; print("core.relay" in sys.modules, "http.server" in sys.modules)'
+        output = subprocess.run([sys.executable, '-c', code], cwd=CLIENT_DIR, stdout=subprocess.PIPE, check=True,
+                                env=dict(os.environ, PYTHONPATH=CLIENT_DIR)).stdout
+        self.assertEqual(output.split(), [b'False', b'False'])
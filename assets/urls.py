@@ -4,5 +4,10 @@ from assets import views
 app_name = 'assets'
 
 urlpatterns = [
-    path('report/', views.report, name='report')
-]
\ No newline at end of file
+    path('report/', views.report, name='report'),
+    path('report/delta/', views.report_delta, name='report_delta'),
+    path('report/batch/', views.report_batch, name='report_batch'),
+    path('report/spool/', views.spool_stats, name='spool_stats'),
+    path('profile/', views.collector_profiles, name='collector_profiles'),
+    path('metrics/', views.metrics_view, name='metrics'),
+]
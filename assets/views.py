@@ -1,36 +1,231 @@
 from django.shortcuts import render
 from django.shortcuts import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.conf import settings
+from django.db.models import Avg, Count, Max, Sum
 import json
+import zlib
 from assets import models
 from assets import asset_handler
+from assets import metrics
+from assets import report_spool
 
 
 # Create your views here.
 
+# the legacy clients post the report JSON as the asset_data form field
+FORM_CONTENT_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+
+def request_body(request):
+    """
+    The raw body, decompressed when the client sent Content-Encoding: gzip or deflate.
+    The decompressed size is capped by DATA_UPLOAD_MAX_MEMORY_SIZE, a small compressed body can not blow up in memory.
+    :raise ValueError: unsupported encoding, corrupt or too large data
+    """
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', 'identity').strip().lower()
+    if encoding == 'identity':
+        return request.body
+    if encoding not in ('gzip', 'deflate'):
+        raise ValueError("Unsupported Content-Encoding: %s" % encoding)
+
+    raw = request.body
+    if encoding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    elif raw[:1] and raw[0] & 0x0f == 8:
+        # deflate is meant to be zlib wrapped, some clients send a raw stream though
+        wbits = zlib.MAX_WBITS
+    else:
+        wbits = -zlib.MAX_WBITS
+
+    limit = settings.DATA_UPLOAD_MAX_MEMORY_SIZE or 0
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        body = decompressor.decompress(raw, limit)
+    except zlib.error as e:
+        raise ValueError("Corrupt %s data: %s" % (encoding, e))
+    if decompressor.unconsumed_tail:
+        raise ValueError("Decompressed data is larger than %s bytes" % limit)
+    if not decompressor.eof:
+        raise ValueError("Truncated %s data" % encoding)
+    return body
+
+
+def report_response(request, status, message, token=None, **kwargs):
+    """
+    Plain text message for the legacy clients, JSON with the version token for clients which accept it
+    """
+    if 'application/json' in request.META.get('HTTP_ACCEPT', ''):
+        return JsonResponse({'status': status, 'message': message, 'token': token}, **kwargs)
+    return HttpResponse(message, **kwargs)
+
 
 @csrf_exempt
+@metrics.instrument_view('report')
 def report(request):
+    """
+    One report, as a JSON body (optionally gzip or deflate compressed) or the legacy asset_data form field.
+    A client sending Accept: application/json gets {"status", "message", "token"} back,
+    the token is the base of its next delta report.
+    """
+    if request.method == "POST":
+        try:
+            if request.content_type in FORM_CONTENT_TYPES:
+                asset_data = request.POST.get('asset_data', '')
+            else:
+                asset_data = request_body(request).decode()
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        try:
+            data = json.loads(asset_data)
+        except ValueError:
+            return HttpResponseBadRequest("Data should be JSON")
+        error = asset_handler.check_report(data)
+        if error:
+            return report_response(request, 'failed', error)
+
+        if report_spool.spool_enabled():
+            report_spool.get_spool().put(data)
+            return report_response(request, 'queued', "Asset info has been queued!", status=202)
+
+        status, message = asset_handler.apply_report(request, data)
+        return report_response(request, status, message, asset_handler.report_token(status, data))
+
+    return HttpResponse('200 ok')
+
+
+@csrf_exempt
+@metrics.instrument_view('report_delta')
+def report_delta(request):
+    """
+    Only what changed since the report named by the version token, see asset_handler.apply_delta.
+    409 asks the agent for a full report.
+    """
+    if request.method == "POST":
+        try:
+            delta = json.loads(request_body(request).decode())
+        except ValueError as e:
+            return HttpResponseBadRequest("Data should be JSON: %s" % e)
+        if not isinstance(delta, dict) or not delta.get('sn'):
+            return HttpResponseBadRequest("Asset SN number not founded, Please check your data!")
+        if report_spool.spool_enabled():
+            # the spool keeps full reports only, the agent sends one
+            return JsonResponse({'status': 'resync', 'message': "Please send the full report!", 'token': None},
+                                status=409)
+
+        try:
+            status, message, token = asset_handler.apply_delta(request, delta)
+        except (ValueError, TypeError, AttributeError) as e:
+            return HttpResponseBadRequest("Malformed delta: %s" % e)
+        return JsonResponse({'status': status, 'message': message, 'token': token},
+                            status=409 if status == 'resync' else 200)
+
+    return HttpResponse('200 ok')
+
+
+@csrf_exempt
+@metrics.instrument_view('report_batch')
+def report_batch(request):
+    """
+    Many reports in one POST.
+    The body is a JSON list of reports, or {"reports": [...]}, optionally gzip compressed;
+    the legacy asset_data form field is accepted as well.
+    The response lists one result per SN, a bad report does not fail the others.
+    """
     if request.method == "POST":
-        asset_data = request.POST.get('asset_data')
-        data = json.loads(asset_data)
-        if not data:
-            return HttpResponse("No Data")
-
-        if not issubclass(dict, type(data)):
-            return HttpResponse("Data type should be Dictionary")
-
-        sn = data.get('sn', None)
-        if sn:
-            asset_obj = models.Asset.objects.filter(sn=sn)
-            if asset_obj:
-                update_asset = asset_handler.UpdateAsset(request, asset_obj[0], data)
-                return HttpResponse("Asset info has been updated!")
+        try:
+            if request.content_type in FORM_CONTENT_TYPES:
+                raw = request.POST.get('asset_data', '')
             else:
-                obj = asset_handler.NewAsset(request, data)
-                response = obj.add_to_new_assets_zone()
-                return HttpResponse(response)
-        else:
-            return HttpResponse("Asset SN number not founded, Please check your data!")
+                raw = request_body(request).decode()
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        try:
+            reports = json.loads(raw)
+        except ValueError:
+            return HttpResponseBadRequest("Data should be JSON")
+
+        if isinstance(reports, dict):
+            reports = reports.get('reports')
+        if not isinstance(reports, list):
+            return HttpResponseBadRequest("Data type should be List")
+
+        if report_spool.spool_enabled():
+            results = []
+            queued = []
+            for index, data in enumerate(reports):
+                error = asset_handler.check_report(data)
+                if error:
+                    sn = data.get('sn') if isinstance(data, dict) else None
+                    results.append({'index': index, 'sn': sn, 'status': 'failed', 'message': error})
+                else:
+                    queued.append(data)
+                    results.append({'sn': data['sn'], 'status': 'queued', 'message': 'Asset info has been queued!'})
+            report_spool.get_spool().put_many(queued)
+            return JsonResponse({'results': results}, status=202)
+
+        results = asset_handler.BatchReport(request, reports).process()
+        return JsonResponse({'results': results})
 
     return HttpResponse('200 ok')
+
+
+def spool_stats(request):
+    """
+    Queue depth and lag of the report spool, plain text
+    """
+    if not report_spool.spool_enabled():
+        return HttpResponse("report spool is disabled\n", content_type='text/plain')
+    stats = report_spool.get_spool().stats()
+    lines = ['report_spool_depth %(depth)s', 'report_spool_assets %(assets)s',
+             'report_spool_claimed %(claimed)s', 'report_spool_lag_seconds %(lag).3f']
+    return HttpResponse('\n'.join(lines) % stats + '\n', content_type='text/plain')
+
+
+def collector_profiles(request):
+    """
+    Cost of the client collectors over all assets which report with --profile:
+    per collector average / maximum time, and the assets with the slowest collections (?limit=, default 20)
+    """
+    try:
+        limit = min(int(request.GET.get('limit', 20)), 500)
+    except ValueError:
+        return HttpResponseBadRequest("limit should be a number")
+
+    profiles = models.CollectorProfile.objects
+    # collectors served from the client's fact cache did not run
+    collectors = profiles.exclude(collector=models.CollectorProfile.TOTAL).filter(cached=False) \
+        .values('collector').annotate(
+        assets=Count('asset'), avg_wall_ms=Avg('wall_ms'), max_wall_ms=Max('wall_ms'), avg_cpu_ms=Avg('cpu_ms'),
+        commands=Sum('commands'),
+    ).order_by('-avg_wall_ms')
+
+    slowest = []
+    for total in profiles.filter(collector=models.CollectorProfile.TOTAL).select_related('asset') \
+            .defer('asset__report').order_by('-wall_ms')[:limit]:
+        slowest.append({'sn': total.asset.sn, 'name': total.asset.name, 'wall_ms': total.wall_ms,
+                        'cpu_ms': total.cpu_ms, 'commands': total.commands, 'reported': total.m_time})
+
+    slowest_collectors = []
+    for profile in profiles.exclude(collector=models.CollectorProfile.TOTAL).select_related('asset') \
+            .defer('asset__report').order_by('-wall_ms')[:limit]:
+        slowest_collectors.append({'sn': profile.asset.sn, 'collector': profile.collector,
+                                   'wall_ms': profile.wall_ms, 'cpu_ms': profile.cpu_ms,
+                                   'commands': profile.commands, 'command_ms': profile.command_ms})
+
+    return JsonResponse({'collectors': list(collectors), 'slowest_assets': slowest,
+                         'slowest_collectors': slowest_collectors})
+
+
+def metrics_view(request):
+    """
+    Histograms of the report phases of this process, plus the spool gauges, plain text
+    """
+    text = metrics.render()
+    if report_spool.spool_enabled():
+        stats = report_spool.get_spool().stats()
+        text += ('# TYPE report_spool_depth gauge\nreport_spool_depth %(depth)s\n'
+                 '# TYPE report_spool_lag_seconds gauge\nreport_spool_lag_seconds %(lag).3f\n') % stats
+    return HttpResponse(text, content_type='text/plain; version=0.0.4')